@@ -1,7 +1,93 @@
-from .datasets import *
-from .dset import *
-from .fetch import *
-from .localdata import *
-from .synthetic import *
-from .utils import *
+import importlib
 
+# Submodules are only imported when one of their names is first used,
+# so that e.g. fetching data does not pay for importing image libraries.
+# Each list must match the submodule's `__all__` (see test_lazy_imports.py).
+_SUBMODULE_EXPORTS = {
+    '.cache': ['DatasetCache'],
+    '.datasets': [
+        'add_dataset_by_urllist',
+        'add_dataset_from_function',
+        'add_dataset_metadata',
+        'available_datasets',
+        'build_dataset_dict',
+        'fetch_and_unpack',
+        'generate_synthetic_dataset_opts',
+        'get_dataset_filename',
+        'get_default_metadata',
+        'load_dataset',
+        'new_dataset',
+        'read_datasets',
+        'unknown_function',
+        'write_datasets',
+    ],
+    '.dset': ['Dataset'],
+    '.fetch': [
+        'available_hashes',
+        'fetch_file',
+        'fetch_files',
+        'fetch_text_file',
+        'hash_file',
+        'hash_files',
+        'cached_hash_file',
+        'unpack',
+        'unpack_files',
+    ],
+    '.intrinsic_dim': [
+        'available_id_estimators',
+        'estimate_intrinsic_dimension',
+        'knn_distances',
+        'mle_intrinsic_dimension',
+        'order_n_components',
+        'twonn_intrinsic_dimension',
+    ],
+    '.mirror': ['RawMirror', 'get_raw_mirror', 'set_raw_mirror'],
+    '.localdata': [
+        'process_coil',
+        'process_frey_faces',
+        'process_hiva',
+        'process_lvq_pak',
+        'process_mnist',
+        'process_orl_faces',
+        'process_shuttle_statlog',
+    ],
+    '.synthetic': [
+        'helix',
+        'sample_ball',
+        'sample_sphere_surface',
+        'synthetic_blocks',
+        'synthetic_data',
+        'write_synthetic_dataset',
+    ],
+    '.utils': [
+        'hash_array',
+        'head_file',
+        'list_dir',
+        'nested_subsample_order',
+        'normalize_labels',
+        'partial_call_signature',
+        'read_idx',
+        'read_idx_header',
+        'read_numeric_matrix',
+        'read_space_delimited',
+    ],
+}
+
+_LAZY_ATTRIBUTES = {name: module
+                    for module, names in _SUBMODULE_EXPORTS.items()
+                    for name in names}
+
+__all__ = list(_LAZY_ATTRIBUTES)
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module = importlib.import_module(_LAZY_ATTRIBUTES[name], __name__)
+    value = getattr(module, name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
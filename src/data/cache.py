@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+import click
+import json
+import os
+import pathlib
+import re
+import tempfile
+import time
+
+from ..paths import interim_data_path
+from ..logging import logger
+
+__all__ = ['DatasetCache']
+
+_INDEX_FILE = 'dataset_cache.json'
+
+# `load_dataset` names its cache entries by the sha1 hash of its arguments
+_CACHE_KEY = re.compile(r'^[0-9a-f]{40}$')
+
+
+class DatasetCache:
+    def __init__(self, cache_dir=None, max_bytes=None):
+        """
+        Size-bounded LRU manager for the datasets cached by `load_dataset`.
+
+        A cache entry is the group of `{file_base}.*` files written by
+        `Dataset.dump` (`.dataset`, `.metadata` and any `.npy` arrays).
+        Access times, dataset names and pins are recorded in an index file
+        (`dataset_cache.json`) in the cache directory. Entries that were
+        never recorded fall back to the modification time of their files.
+        The index also maps the keys of processed raw data (see
+        `record_source`) to the entries holding it.
+
+        cache_dir: path (default: `interim_data_path`)
+            Directory holding the cached datasets
+        max_bytes: int or None
+            Byte budget for the cache. If None, use the budget stored in
+            the index (see `set_budget`); if there is none, the cache is
+            unbounded.
+        """
+        if cache_dir is None:
+            cache_dir = interim_data_path
+        self.cache_dir = pathlib.Path(cache_dir)
+        self._max_bytes = max_bytes
+
+    @property
+    def index_file(self):
+        return self.cache_dir / _INDEX_FILE
+
+    def _read_index(self):
+        try:
+            with open(self.index_file, 'r') as fr:
+                index = json.load(fr)
+        except (FileNotFoundError, json.JSONDecodeError):
+            index = {}
+        index.setdefault('entries', {})
+        index.setdefault('pinned', [])
+        index.setdefault('max_bytes', None)
+        index.setdefault('sources', {})
+        return index
+
+    def _write_index(self, index):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as fw:
+                json.dump(index, fw, indent=2, sort_keys=True)
+            os.replace(tmp_name, self.index_file)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+
+    @property
+    def max_bytes(self):
+        if self._max_bytes is not None:
+            return self._max_bytes
+        return self._read_index()['max_bytes']
+
+    def set_budget(self, max_bytes):
+        """Store a default byte budget (None for unbounded) in the index"""
+        index = self._read_index()
+        index['max_bytes'] = max_bytes
+        self._write_index(index)
+
+    def entries(self):
+        """Describe every entry in the cache
+
+        Returns
+        -------
+        dict keyed by file_base, of dicts containing:
+            files, size, last_access, dataset_name, pinned
+        """
+        index = self._read_index()
+        pinned = set(index['pinned'])
+        entries = {}
+        if not self.cache_dir.exists():
+            return entries
+        for dir_entry in os.scandir(self.cache_dir):
+            if not dir_entry.is_file():
+                continue
+            file_base = dir_entry.name.split('.', 1)[0]
+            if not _CACHE_KEY.match(file_base):
+                continue
+            stat = dir_entry.stat()
+            entry = entries.setdefault(file_base, {'files': [], 'size': 0,
+                                                   'mtime': 0})
+            entry['files'].append(dir_entry.name)
+            entry['size'] += stat.st_size
+            entry['mtime'] = max(entry['mtime'], stat.st_mtime)
+
+        for file_base, entry in entries.items():
+            recorded = index['entries'].get(file_base, {})
+            mtime = entry.pop('mtime')
+            entry['last_access'] = recorded.get('last_access', mtime)
+            entry['dataset_name'] = recorded.get('dataset_name', None)
+            entry['pinned'] = (file_base in pinned or
+                               entry['dataset_name'] in pinned)
+        return entries
+
+    @property
+    def size(self):
+        """Total size (in bytes) of the cached datasets"""
+        return sum(e['size'] for e in self.entries().values())
+
+    def touch(self, file_base, dataset_name=None):
+        """Record an access to the entry `file_base`"""
+        index = self._read_index()
+        entry = index['entries'].setdefault(file_base, {})
+        entry['last_access'] = time.time()
+        if dataset_name is not None:
+            entry['dataset_name'] = dataset_name
+        self._write_index(index)
+
+    def record_source(self, source_key, file_base):
+        """Record that the entry `file_base` holds the data identified by
+        `source_key` (e.g. the output of a dataset's processing function)
+        """
+        index = self._read_index()
+        index['sources'][source_key] = file_base
+        self._write_index(index)
+
+    def lookup_source(self, source_key):
+        """The entry holding the data identified by `source_key`, or None
+        if there is none (or it has since been evicted)
+        """
+        file_base = self._read_index()['sources'].get(source_key, None)
+        if file_base is None or \
+           not (self.cache_dir / f'{file_base}.dataset').exists():
+            return None
+        return file_base
+
+    def pin(self, name):
+        """Exempt a dataset (by dataset name or cache file_base) from eviction
+        """
+        index = self._read_index()
+        if name not in index['pinned']:
+            index['pinned'].append(name)
+            self._write_index(index)
+
+    def unpin(self, name):
+        """Make a pinned dataset (or cache entry) evictable again"""
+        index = self._read_index()
+        if name in index['pinned']:
+            index['pinned'].remove(name)
+            self._write_index(index)
+
+    def remove(self, file_base):
+        """Delete every file belonging to the entry `file_base`"""
+        for file_name in self.entries().get(file_base, {}).get('files', []):
+            try:
+                os.unlink(self.cache_dir / file_name)
+            except FileNotFoundError:
+                pass
+        index = self._read_index()
+        sources = {k: v for k, v in index['sources'].items() if v != file_base}
+        if index['entries'].pop(file_base, None) is not None or \
+           len(sources) != len(index['sources']):
+            index['sources'] = sources
+            self._write_index(index)
+
+    def prune(self, max_bytes=None, keep=None):
+        """Evict least recently used, unpinned entries until the cache fits
+        in its budget.
+
+        max_bytes: int or None
+            Budget to enforce. If None, use `self.max_bytes`
+        keep: list of file_base or None
+            Entries that must not be evicted this time (e.g. the dataset
+            that was just written)
+
+        Returns
+        -------
+        list of evicted file_bases
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        if max_bytes is None:
+            return []
+        keep = set(keep or [])
+        entries = self.entries()
+        total = sum(e['size'] for e in entries.values())
+        evicted = []
+        by_age = sorted(entries.items(), key=lambda kv: kv[1]['last_access'])
+        for file_base, entry in by_age:
+            if total <= max_bytes:
+                break
+            if entry['pinned'] or file_base in keep:
+                continue
+            self.remove(file_base)
+            total -= entry['size']
+            evicted.append(file_base)
+            logger.debug(f"Evicted {file_base} ({entry['dataset_name']}) "
+                         "from dataset cache")
+        if total > max_bytes:
+            logger.warning(f"Dataset cache is {total} bytes, over its budget "
+                           f"of {max_bytes} bytes, but everything left is "
+                           "pinned")
+        return evicted
+
+
+@click.command()
+@click.argument('action', type=click.Choice(['info', 'prune', 'pin', 'unpin',
+                                            'budget']))
+@click.argument('names', nargs=-1)
+@click.option('--max-bytes', '-m', type=int, default=None,
+              help='Byte budget to prune to, or to store with `budget`')
+@click.option('--cache-dir', type=click.Path(), default=None)
+def main(action, names, max_bytes=None, cache_dir=None):
+    """Inspect and manage the interim dataset cache
+
+    action: {'info', 'prune', 'pin', 'unpin', 'budget'}
+
+    info: list cached datasets, least recently used first
+    prune: evict least recently used datasets until the cache fits in
+        `--max-bytes` (or the stored budget)
+    pin/unpin NAMES: protect (or stop protecting) datasets, by dataset name
+        or cache key, from eviction
+    budget: store `--max-bytes` as the default budget (omit it for unbounded)
+    """
+    cache = DatasetCache(cache_dir=cache_dir)
+    if action == 'info':
+        entries = cache.entries()
+        by_age = sorted(entries.items(), key=lambda kv: kv[1]['last_access'])
+        for file_base, entry in by_age:
+            last_access = time.strftime('%Y-%m-%d %H:%M',
+                                        time.localtime(entry['last_access']))
+            pin = 'pinned' if entry['pinned'] else ''
+            click.echo(f"{file_base}  {entry['size']:>12}  {last_access}  "
+                       f"{entry['dataset_name'] or '?'}  {pin}")
+        click.echo(f"{len(entries)} datasets, {cache.size} bytes "
+                   f"(budget: {cache.max_bytes})")
+    elif action == 'prune':
+        evicted = cache.prune(max_bytes=max_bytes)
+        logger.info(f"Evicted {len(evicted)} datasets")
+    elif action == 'pin':
+        for name in names:
+            cache.pin(name)
+    elif action == 'unpin':
+        for name in names:
+            cache.unpin(name)
+    elif action == 'budget':
+        cache.set_budget(max_bytes)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,21 @@
+import copy
 from functools import partial
 import importlib
 import sys
 import joblib
 import joblib.func_inspect as jfi
 import json
+import numpy as np
 import os
 import pathlib
-from sklearn.preprocessing import StandardScaler, MinMaxScaler
 
+from .cache import DatasetCache
 from .dset import Dataset
-from .fetch import unpack
-from .utils import normalize_labels, partial_call_signature
+from .fetch import unpack, unpack_files
+from .utils import (nested_subsample_order, normalize_labels,
+                    partial_call_signature)
 from ..paths import raw_data_path, interim_data_path
-from .fetch import fetch_files, fetch_file
+from .fetch import fetch_files, fetch_file, cached_hash_file
 from ..logging import logger
 
 __all__ = [
@@ -35,7 +38,45 @@ __all__ = [
 _MODULE = sys.modules[__name__]
 _MODULE_DIR = pathlib.Path(os.path.dirname(os.path.abspath(__file__)))
 
-jlmem = joblib.Memory(cachedir=str(interim_data_path), verbose=0)
+
+def _raw_file_digests(dset_opts):
+    """Digests of the raw files a (fetched) dataset is processed from
+
+    Digests come from the hash index kept alongside the raw files, so
+    this only rehashes files that have changed on disk.
+
+    Returns
+    -------
+    list of (file_name, hash_type, hex digest)
+    """
+    fetch_list = dset_opts.get('url_list', None) or [dset_opts]
+    digests = []
+    for fetch_dict in fetch_list:
+        file_name = get_dataset_filename(fetch_dict)
+        hash_type = fetch_dict.get('hash_type', None) or 'sha1'
+        digest = cached_hash_file(raw_data_path / file_name,
+                                  algorithm=hash_type)
+        digests.append((file_name, hash_type, digest))
+    return digests
+
+
+def _processing_key(load_function, raw_digests, kwargs):
+    """Key identifying the output of a dataset's processing function
+
+    Covers the (partial) function, its source, its arguments, and the
+    digests of the raw files it reads, so the key changes whenever the
+    code or the raw files do.
+    """
+    func_code, _, _ = jfi.get_func_code(load_function.func)
+    return joblib.hash({
+        'function': jfi.get_func_name(load_function.func),
+        'func_code': func_code,
+        'args': load_function.args,
+        'keywords': load_function.keywords,
+        'kwargs': kwargs,
+        'raw_digests': raw_digests,
+    }, hash_name='sha1')
+
 
 def get_default_metadata(*, dataset_name):
     """Create default metatada for a dataset.
@@ -183,8 +224,8 @@ def fetch_and_unpack(dataset_name, do_unpack=True):
             logger.error(f"Failed to retrieve all data files: {results}")
             raise Exception("Failed to retrieve all data files")
         if do_unpack:
-            for _, filename, _ in results:
-                unpack(filename, dst_dir=interim_dataset_path)
+            unpack_files([filename for _, filename, _ in results],
+                         dst_dir=interim_dataset_path)
     else:
         single_file = True
         status, filename, hashval = fetch_file(dst_dir=raw_data_path,
@@ -205,32 +246,84 @@ def fetch_and_unpack(dataset_name, do_unpack=True):
         return filename
     return raw_data_path
 
+
+class _DatasetOptions(dict):
+    """Options for a single dataset, as read from `datasets.json`
+
+    The callable `load_function` is only resolved (importing its module
+    if necessary) when it is first accessed.
+    """
+    def __missing__(self, key):
+        if key != 'load_function' or 'load_function_name' not in self:
+            raise KeyError(key)
+        func = _make_load_function(self)
+        self['load_function'] = func
+        return func
+
+    def __contains__(self, key):
+        if key == 'load_function' and 'load_function_name' in self:
+            return True
+        return super().__contains__(key)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+
+def _make_load_function(dset_opts):
+    """Build the (partial) load function described by a dataset's options"""
+    args = dset_opts.get('load_function_args', {})
+    kwargs = dset_opts.get('load_function_kwargs', {})
+    fail_func = partial(unknown_function, dset_opts['load_function_name'])
+    func_mod_name = dset_opts.get('load_function_module', None)
+    if func_mod_name:
+        func_mod = importlib.import_module(func_mod_name)
+    else:
+        func_mod = _MODULE
+    func_name = getattr(func_mod, dset_opts['load_function_name'], fail_func)
+    return partial(func_name, *args, **kwargs)
+
+
+# parsed dataset files, keyed by path: (mtime_ns, size, parsed json)
+_DATASET_REGISTRY = {}
+
+
+def _invalidate_registry(path=None):
+    """Forget the parsed contents of a dataset file (or all of them)"""
+    if path is None:
+        _DATASET_REGISTRY.clear()
+    else:
+        _DATASET_REGISTRY.pop(str(path), None)
+
+
 def read_datasets(path=None, filename="datasets.json"):
     """Read the serialized (JSON) dataset list
+
+    The file is only re-parsed when its modification time or size changes.
+    Each call returns a fresh copy that the caller is free to modify, and
+    each dataset's `load_function` is resolved only when it is accessed.
     """
     if path is None:
         path = _MODULE_DIR
     else:
         path = pathlib.Path(path)
 
-    with open(path / filename, 'r') as fr:
-        ds = json.load(fr)
-
-    # make the functions callable
-    for _, dset_opts in ds.items():
-        args = dset_opts.get('load_function_args', {})
-        kwargs = dset_opts.get('load_function_kwargs', {})
-        fail_func = partial(unknown_function, dset_opts['load_function_name'])
-        func_mod_name = dset_opts.get('load_function_module', None)
-        if func_mod_name:
-            func_mod = importlib.import_module(func_mod_name)
-        else:
-            func_mod = _MODULE
-        func_name = getattr(func_mod, dset_opts['load_function_name'], fail_func)
-        func = partial(func_name, *args, **kwargs)
-        dset_opts['load_function'] = func
+    fq_path = path / filename
+    stat = os.stat(fq_path)
+    key = str(fq_path)
+    cached = _DATASET_REGISTRY.get(key, None)
+    if cached is None or cached[:2] != (stat.st_mtime_ns, stat.st_size):
+        with open(fq_path, 'r') as fr:
+            parsed = json.load(fr)
+        _DATASET_REGISTRY[key] = (stat.st_mtime_ns, stat.st_size, parsed)
+        logger.debug(f"Parsed dataset list {fq_path}")
+    else:
+        parsed = cached[2]
+
+    return {name: _DatasetOptions(copy.deepcopy(dset_opts))
+            for name, dset_opts in parsed.items()}
 
-    return ds
 
 def unknown_function(args, **kwargs):
     """Placeholder for unknown function_name"""
@@ -249,6 +342,10 @@ def write_datasets(ds, path=None, filename="datasets.json", indent=4, sort_keys=
     for key, entry in ds.items():
         action = entry.get('action', 'fetch_and_process')
         entry['action'] = action
+        if 'load_function' not in entry.keys() and \
+           'load_function_name' in entry:
+            # never resolved, so the serialized form is still current
+            continue
         func = entry.get('load_function', None)
         if func is None:
             if action == 'fetch_and_process':
@@ -266,6 +363,8 @@ def write_datasets(ds, path=None, filename="datasets.json", indent=4, sort_keys=
 
     with open(path / filename, 'w') as fw:
         json.dump(ds, fw, indent=indent, sort_keys=sort_keys)
+    _invalidate_registry(path / filename)
+
 
 def add_dataset_by_urllist(dataset_name, url_list, action="fetch_and_process"):
     """Add a new dataset by specifying a url_list
@@ -361,9 +460,11 @@ def generate_synthetic_dataset_opts(dataset_name, func, use_docstring=True, resc
         raise Exception(f"Unexpected number of parameters from {func}. Got {len(tup)}.")
     metadata['dataset_name'] = dataset_name
     if rescale == 'minmax':
+        from sklearn.preprocessing import MinMaxScaler
         scaler = MinMaxScaler()
         X = scaler.fit_transform(X)
     elif rescale == 'standard':
+        from sklearn.preprocessing import StandardScaler
         scaler = StandardScaler()
         X = scaler.fit_transform(X)
     elif rescale is not None:
@@ -384,21 +485,165 @@ def generate_synthetic_dataset_opts(dataset_name, func, use_docstring=True, resc
     }
     return ds_opts
 
+
+def _create_dataset(dataset_name, dset_opts, force=False, dataset_cache=None,
+                    **kwargs):
+    """Generate, or fetch and process, a dataset (see `load_dataset`)
+
+    For fetched datasets, if `dataset_cache` already holds the output of
+    the same processing (see `_processing_key`), it is loaded from there
+    rather than reprocessed (unless `force`).
+
+    Returns
+    -------
+    (Dataset, processing key or None)
+    """
+    action = dset_opts['action']
+    processing_key = None
+    if action == 'generate':
+        func = partial(dset_opts['load_function'], **kwargs)
+        rescale = dset_opts.get('rescale', None)
+        ds_opts = generate_synthetic_dataset_opts(dataset_name, func,
+                                                  rescale=rescale)
+    elif action == 'fetch_and_process':
+        fetch_and_unpack(dataset_name)
+        metadata = get_default_metadata(dataset_name=dataset_name)
+        supplied_metadata = kwargs.pop('metadata', {})
+        kwargs['metadata'] = {**metadata, **supplied_metadata}
+        load_function = dset_opts['load_function']
+        if dataset_cache is not None:
+            processing_key = _processing_key(
+                load_function, _raw_file_digests(dset_opts), kwargs)
+            file_base = (None if force
+                         else dataset_cache.lookup_source(processing_key))
+            if file_base is not None:
+                logger.debug(f"Reusing processed {dataset_name} from "
+                             f"{file_base}")
+                dset = Dataset.load(file_base,
+                                    data_path=dataset_cache.cache_dir,
+                                    mmap_mode='r')
+                return dset, processing_key
+        ds_opts = load_function(**kwargs)
+    else:
+        raise Exception(f"Unknown action: {action} for dataset: "
+                        f"{dataset_name}")
+    return Dataset(**ds_opts), processing_key
+
+
+def _subsample_spec(subsample):
+    """Normalize a subsample spec (see `load_dataset`) into a dict"""
+    if isinstance(subsample, int):
+        subsample = {'size': subsample}
+    unknown = set(subsample) - {'size', 'stratify', 'seed'}
+    if unknown or 'size' not in subsample:
+        raise Exception(f"Subsample spec needs a `size` (and optionally "
+                        f"`stratify` and `seed`). Got: {subsample}")
+    return {'size': int(subsample['size']),
+            'stratify': bool(subsample.get('stratify', True)),
+            'seed': subsample.get('seed', 0)}
+
+
+def _is_categorical(target):
+    """True if `target` holds class labels (integers, booleans, strings or
+    categories) rather than continuous values"""
+    kind = getattr(getattr(target, 'dtype', None), 'kind', None)
+    return kind in ('b', 'i', 'u', 'U', 'S', 'O')
+
+
+def _take_subsample(dset, subsample):
+    """Nested random subsample of `dset` (see `load_dataset`)"""
+    if subsample['size'] > dset.n_points:
+        raise Exception(f"Subsample of {subsample['size']} points requested "
+                        f"from {dset.n_points} points")
+    labels = None
+    if subsample['stratify'] and dset.has_target:
+        if _is_categorical(dset.target):
+            labels = dset.target
+        else:
+            logger.debug(f"{dset.name} target is continuous. "
+                         "Subsampling without stratification")
+    order = nested_subsample_order(dset.n_points, labels=labels,
+                                   random_state=subsample['seed'])
+    subsampled = dset.subset(np.sort(order[:subsample['size']]))
+    subsampled.metadata['subsample'] = subsample
+    return subsampled
+
+
+def _load_cached(dataset_name, meta_hash, dataset_cache, mmap_mode=None):
+    """The dataset cached as `meta_hash`, or None if there isn't one"""
+    try:
+        dset = Dataset.load(meta_hash, data_path=dataset_cache.cache_dir,
+                            mmap_mode=mmap_mode)
+    except FileNotFoundError:
+        logger.debug("No Cached Dataset found. Re-creating")
+        return None
+    logger.debug(f"Found cached dataset for {dataset_name}: {meta_hash}")
+    dataset_cache.touch(meta_hash, dataset_name=dataset_name)
+    return dset
+
+
+def _map_labels(dset):
+    """Replace the target of `dset` by integer labels, adding a `label_map`
+    to its metadata"""
+    if dset.metadata.get('label_map', None) is not None:
+        raise Exception("label_map already present in dataset")
+    mapped_target, label_map = normalize_labels(dset.target)
+    dset.metadata['label_map'] = label_map
+    dset.target = mapped_target
+
+
+def _build_and_cache(dataset_name, dset_opts, meta_hash, dataset_cache,
+                     force=False, subset=None, subsample=None, **kwargs):
+    """Create a dataset (or a subset or subsample of one), and add it to
+    the dataset cache as `meta_hash`
+    """
+    cache_dir = dataset_cache.cache_dir
+    processing_key = None
+    if subsample is not None:
+        parent = load_dataset(dataset_name, force=force, cache_dir=cache_dir,
+                              mmap_mode='r', subset=subset, **kwargs)
+        dset = _take_subsample(parent, subsample)
+    elif subset is not None:
+        parent = load_dataset(dataset_name, force=force, cache_dir=cache_dir,
+                              mmap_mode='r', **kwargs)
+        dset = parent.subset(subset)
+    else:
+        dset, processing_key = _create_dataset(dataset_name, dset_opts,
+                                               force=force,
+                                               dataset_cache=dataset_cache,
+                                               **kwargs)
+    dset.dump(data_path=cache_dir, file_base=meta_hash)
+    dataset_cache.touch(meta_hash, dataset_name=dataset_name)
+    if processing_key is not None:
+        dataset_cache.record_source(processing_key, meta_hash)
+    dataset_cache.prune(keep=[meta_hash])
+    return dset
+
+
 def load_dataset(dataset_name, return_X_y=False, map_labels=False, force=False,
-                 cache_dir=None, **kwargs):
+                 cache_dir=None, mmap_mode=None, subset=None, subsample=None,
+                 **kwargs):
 
     '''Loads a Dataset object by name.
 
     Dataset will be cached after creation. Subsequent calls with matching call
-    signature will return this cached object.
+    signature will return this cached object. The cache is kept within its
+    byte budget (if any) by evicting least recently used datasets;
+    see `DatasetCache`.
+
+    For fetched datasets, the cache also records which entry holds the
+    output of each processing function, by its arguments and the digests
+    of the raw files, so variants of a dataset that differ only in options
+    applied after processing (such as `map_labels`) do not reparse the raw
+    data.
 
     Parameters
     ----------
     dataset_name:
         Name of dataset to load. see `available_datasets()` for the current list
     force: boolean
-        If True, always regenerate the dataset. If false, a cached result can
-        be returned (if available)
+        If True, always regenerate (and reprocess) the dataset. If false, a
+        cached result can be returned (if available)
     cache_dir: path
         Directory to search for cache files
     map_labels: boolean
@@ -406,6 +651,28 @@ def load_dataset(dataset_name, return_X_y=False, map_labels=False, force=False,
         dictionary will be added to the dataset metadata)
     return_X_y: boolean, default=False
         if True, returns (data, target) instead of a `Dataset` object
+    mmap_mode: {None, 'r', 'r+', 'c'}
+        If not None, a cached dataset's arrays are memory-mapped with this mode
+        rather than read into memory (see `Dataset.load`)
+    subset: None, slice, boolean mask or array of indices
+        If given, load only these rows of the dataset (see `Dataset.subset`).
+        The subset is cached separately from the full dataset, which is
+        memory-mapped to extract it.
+    subsample: None, int, or dict
+        If given, load a random subsample (taken after `subset`, if any).
+        A dict may contain:
+            size: int (required)
+                Number of points
+            stratify: boolean (default True)
+                If True, and the target holds class labels (integers,
+                booleans, strings or categories), labels occur in the same
+                proportions as in the full target. Continuous targets are
+                never stratified
+            seed: int (default 0)
+                Seed for the random ordering
+        An int is taken to be the size. Subsamples with the same `stratify`
+        and `seed` are nested: smaller ones are contained in larger ones
+        (see `nested_subsample_order`). Each is cached separately.
     '''
     if cache_dir is None:
         cache_dir = interim_data_path
@@ -419,39 +686,26 @@ def load_dataset(dataset_name, return_X_y=False, map_labels=False, force=False,
         'map_labels': map_labels,
         **kwargs
     }
+    if subset is not None:
+        cached_meta['subset'] = subset
+    if subsample is not None:
+        subsample = _subsample_spec(subsample)
+        cached_meta['subsample'] = subsample
     meta_hash = joblib.hash(cached_meta, hash_name='sha1')
 
+    dataset_cache = DatasetCache(cache_dir=cache_dir)
     dset = None
     if force is False:
-        try:
-            dset = Dataset.load(meta_hash, data_path=cache_dir)
-            logger.debug(f"Found cached dataset for {dataset_name}: {meta_hash}")
-        except FileNotFoundError:
-            logger.debug("No Cached Dataset found. Re-creating")
+        dset = _load_cached(dataset_name, meta_hash, dataset_cache,
+                            mmap_mode=mmap_mode)
 
     if dset is None:
-        action = dataset_list[dataset_name]['action']
-        if action == 'generate':
-            func = partial(dataset_list[dataset_name]['load_function'], **kwargs)
-            rescale = dataset_list[dataset_name].get('rescale', None)
-            dset_opts = generate_synthetic_dataset_opts(dataset_name, func, rescale=rescale)
-        elif action == 'fetch_and_process':
-            fetch_and_unpack(dataset_name)
-            metadata = get_default_metadata(dataset_name=dataset_name)
-            supplied_metadata = kwargs.pop('metadata', {})
-            kwargs['metadata'] = {**metadata, **supplied_metadata}
-            dset_opts = dataset_list[dataset_name]['load_function'](**kwargs)
-        else:
-            raise Exception(f"Unknown action: {action} for dataset: {dataset_name}")
-        dset = Dataset(**dset_opts)
-        dset.dump(data_path=cache_dir, file_base=meta_hash)
+        dset = _build_and_cache(dataset_name, dataset_list[dataset_name],
+                                meta_hash, dataset_cache, force=force,
+                                subset=subset, subsample=subsample, **kwargs)
 
     if map_labels:
-        if dset.metadata.get('label_map', None) is not None:
-            raise Exception("label_map already present in dataset")
-        mapped_target, label_map = normalize_labels(dset.target)
-        dset.metadata['label_map'] = label_map
-        dset.target = mapped_target
+        _map_labels(dset)
 
     if return_X_y:
         return dset.data, dset.target
@@ -1,10 +1,14 @@
 import joblib
 import logging
+import mmap
+import numpy as np
 import os
 import pathlib
 import sys
+import tempfile
 from sklearn.datasets.base import Bunch
 
+from .utils import hash_array
 from ..paths import processed_data_path
 from ..logging import logger
 
@@ -13,7 +17,233 @@ _MODULE_DIR = pathlib.Path(os.path.dirname(os.path.abspath(__file__)))
 
 __all__ = ['Dataset']
 
-class Dataset(Bunch):
+_STORAGE_FORMATS = ['joblib', 'npy']
+
+
+def _is_raw_array(value):
+    """True if value can be stored as (and memory-mapped from) a raw .npy
+    file"""
+    return isinstance(value, np.ndarray) and not value.dtype.hasobject
+
+
+def _maps_whole_file(array, filename):
+    """True if `array` is a memory map of all of the .npy file `filename`
+
+    Slices and other views of a memory map keep its `filename`, so the
+    map itself (and its layout) must be checked, not just the name.
+    """
+    if not isinstance(array, np.memmap) or \
+       array.mode not in ('r', 'r+', 'w+') or array.filename is None or \
+       os.path.abspath(array.filename) != os.path.abspath(filename):
+        return False
+    if not isinstance(array.base, mmap.mmap) or \
+       not array.flags.c_contiguous:
+        return False
+    try:
+        on_disk = np.load(filename, mmap_mode='r')
+    except (OSError, ValueError):
+        return False
+    return (array.offset == on_disk.offset and
+            array.shape == on_disk.shape and array.dtype == on_disk.dtype)
+
+
+def _atomic_save_array(filename, array):
+    """Save an array to a .npy file via a temporary file and a rename.
+
+    Renaming (rather than overwriting in place) keeps any existing memory
+    maps of the old file valid. Arrays that already map the whole of
+    `filename` (e.g. generated in place) are just flushed.
+    """
+    if _maps_whole_file(array, filename):
+        array.flush()
+        return
+    fd, tmp_name = tempfile.mkstemp(dir=filename.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fo:
+            np.save(fo, array, allow_pickle=False)
+        os.replace(tmp_name, filename)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
+# Recorded (as `hash_format`) with the digests written by `dump`. Digests
+# without it were computed by pickling, and are never reused by `digest`.
+_HASH_FORMAT = 'raw'
+
+# raw-array metadata entries at least this large are stored in their own file
+_LAZY_METADATA_BYTES = 2**20
+
+
+class _ArrayFile:
+    """Placeholder for an array stored in its own .npy file.
+
+    Only the file name is pickled; the directory (and mmap_mode) are filled
+    in when the containing dataset or metadata is loaded.
+    """
+    def __init__(self, file_name, data_path=None, mmap_mode=None):
+        self.file_name = file_name
+        self.data_path = data_path
+        self.mmap_mode = mmap_mode
+
+    def __reduce__(self):
+        return (_ArrayFile, (self.file_name,))
+
+    def bind(self, data_path, mmap_mode=None):
+        return _ArrayFile(self.file_name, data_path=data_path,
+                          mmap_mode=mmap_mode)
+
+    @property
+    def shape(self):
+        return np.load(self.data_path / self.file_name, mmap_mode='r').shape
+
+    def load(self):
+        return np.load(self.data_path / self.file_name,
+                       mmap_mode=self.mmap_mode, allow_pickle=False)
+
+
+def _take_rows(value, index):
+    """Rows `index` (a slice or integer array) of an array, sparse matrix
+    or pandas object. Slices of arrays are views.
+    """
+    if hasattr(value, 'iloc'):
+        return value.iloc[index].reset_index(drop=True)
+    return value[index]
+
+
+class _ArrayTake:
+    """Placeholder for the rows `index` of `source`, gathered on first access
+    """
+    def __init__(self, source, index):
+        self.source = source
+        self.index = index
+
+    @property
+    def shape(self):
+        return (len(self.index), *self.source.shape[1:])
+
+    def load(self):
+        return _take_rows(self.source, self.index)
+
+
+_PLACEHOLDERS = (_ArrayFile, _ArrayTake)
+
+
+def _row_index(selection, n_rows):
+    """Normalize a row selection (slice, boolean mask or integer indices)
+
+    Integer indices in a regular (increasing) progression are converted to
+    a slice, so that selecting them produces a view.
+
+    Returns
+    -------
+    slice or integer array
+    """
+    if isinstance(selection, slice):
+        return slice(*selection.indices(n_rows))
+    selection = np.asarray(selection)
+    if selection.dtype == bool:
+        if selection.shape != (n_rows,):
+            raise Exception(f"Mask has shape {selection.shape}; "
+                            f"expected ({n_rows},)")
+        index = np.flatnonzero(selection)
+    else:
+        index = selection.astype(np.intp).reshape(-1)
+        if index.size and (index.min() < -n_rows or index.max() >= n_rows):
+            raise Exception(f"Indices out of range for {n_rows} rows")
+        index = np.where(index < 0, index + n_rows, index)
+    if index.size == 0:
+        return slice(0, 0)
+    if index.size == 1:
+        return slice(index[0], index[0] + 1)
+    steps = np.diff(index)
+    if steps[0] > 0 and (steps == steps[0]).all():
+        return slice(index[0], index[-1] + 1, steps[0])
+    return index
+
+
+class _LazyItemsMixin:
+    """Resolve placeholders such as `_ArrayFile` (and cache the result) on
+    first access
+    """
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        if isinstance(value, _PLACEHOLDERS):
+            value = value.load()
+            super().__setitem__(key, value)
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def _load_all(self):
+        for key in self.keys():
+            self[key]
+
+    def items(self):
+        self._load_all()
+        return super().items()
+
+    def values(self):
+        self._load_all()
+        return super().values()
+
+    def is_loaded(self, key):
+        """True if the entry `key` is present and has been loaded into
+        memory"""
+        return key in self and not isinstance(dict.__getitem__(self, key),
+                                              _PLACEHOLDERS)
+
+
+class _LazyDict(_LazyItemsMixin, dict):
+    """Metadata dict whose large array entries are loaded on first access"""
+    def copy(self):
+        return _LazyDict(self)
+
+
+def _bind_placeholders(d, data_path, mmap_mode=None):
+    """Point every `_ArrayFile` placeholder in `d` at `data_path`"""
+    for key in list(d.keys()):
+        value = dict.__getitem__(d, key)
+        if isinstance(value, _ArrayFile):
+            dict.__setitem__(d, key,
+                             value.bind(data_path, mmap_mode=mmap_mode))
+    return d
+
+
+def _split_large_arrays(d, data_path, file_prefix):
+    """Copy of `d` with its large raw-array entries written to
+    `{file_prefix}.{key}.npy` files and replaced by `_ArrayFile` placeholders
+    """
+    split = {}
+    for key in d.keys():
+        value = d[key]
+        if _is_raw_array(value) and value.nbytes >= _LAZY_METADATA_BYTES:
+            file_name = f'{file_prefix}.{key}.npy'
+            _atomic_save_array(data_path / file_name, value)
+            value = _ArrayFile(file_name)
+        split[key] = value
+    return split
+
+
+def _refuse_overwrite(metadata_fq, metadata):
+    """Raise an Exception about an existing metadata file"""
+    logger.warning(f"Existing metatdata file found: {metadata_fq}")
+    cached_metadata = joblib.load(metadata_fq)
+    # are we a subset of the cached metadata? (Py3+ only)
+    if metadata.items() <= cached_metadata.items():
+        raise Exception('Dataset with matching metadata exists already. '
+                        'Use `force=True` to overwrite, or change one of '
+                        '`dataset.metadata` or `file_base`')
+    raise Exception(f'Metadata file {metadata_fq.name} exists '
+                    'but metadata has changed. '
+                    'Use `force=True` to overwrite, or change '
+                    '`file_base`')
+
+
+class Dataset(_LazyItemsMixin, Bunch):
     def __init__(self, dataset_name=None, data=None, target=None, metadata=None,
                  license_txt=None, descr_txt=None, license_file=None, descr_file=None,
                  **kwargs):
@@ -84,32 +314,57 @@ class Dataset(Bunch):
             super().__setattr__(key, value)
 
     def __str__(self):
+        # use the raw entries, so as not to trigger lazy loading
         s = f"<Dataset: {self.name}"
-        if self.get('data', None) is not None:
-            shape = getattr(self.data, 'shape', 'Unknown')
+        if dict.get(self, 'data', None) is not None:
+            shape = getattr(dict.get(self, 'data'), 'shape', 'Unknown')
             s += f", data.shape={shape}"
-        if self.get('target', None) is not None:
-            shape = getattr(self.target, 'shape', 'Unknown')
+        if dict.get(self, 'target', None) is not None:
+            shape = getattr(dict.get(self, 'target'), 'shape', 'Unknown')
             s += f", target.shape={shape}"
-        meta = self.get('metadata', {})
+        meta = dict.get(self, 'metadata', {})
         if meta:
             s += f", metadata={list(meta.keys())}"
 
         s += ">"
         return s
 
+    @property
+    def _digests(self):
+        """Digests of the items, keyed by (key, hash_type); see `digest`"""
+        return self.__dict__.setdefault('_digests', {})
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        digests = self.__dict__.get('_digests', {})
+        for digest_key in [k for k in digests if k[0] == key]:
+            del digests[digest_key]
+
     @property
     def name(self):
         return self['metadata'].get('dataset_name', None)
 
     @property
     def has_target(self):
-        return self['target'] is not None
+        return dict.get(self, 'target', None) is not None
 
     @classmethod
-    def load(cls, file_base, data_path=None, metadata_only=False):
+    def load(cls, file_base, data_path=None, metadata_only=False,
+             mmap_mode=None, lazy=False):
         """Load a dataset
-        must be present in dataset.json"""
+        must be present in dataset.json
+
+        metadata_only: boolean
+            If True, return only the (standalone) metadata dict
+        mmap_mode: {None, 'r', 'r+', 'c'}
+            For datasets dumped with `storage='npy'`, memory-map the array
+            files using this mode (see `numpy.load`). If None, arrays are
+            read into memory. Ignored for datasets stored with joblib.
+        lazy: boolean
+            For datasets dumped with `storage='npy'`, don't read `data`,
+            `target` (or any large metadata arrays) until they are first
+            accessed. Ignored for datasets stored with joblib.
+        """
 
         if data_path is None:
             data_path = processed_data_path
@@ -120,11 +375,128 @@ class Dataset(Bunch):
             metadata_fq = data_path / f'{file_base}.metadata'
             with open(metadata_fq, 'rb') as fd:
                 meta = joblib.load(fd)
-            return meta
+            return _bind_placeholders(_LazyDict(meta), data_path, mmap_mode)
 
         with open(data_path / f'{file_base}.dataset', 'rb') as fd:
             ds = joblib.load(fd)
-        return ds
+        if isinstance(ds, Dataset):
+            # joblib storage: everything was pickled together
+            ds._restore_digests()
+            return ds
+
+        items = ds['items']
+        items['metadata'] = _bind_placeholders(_LazyDict(items['metadata']),
+                                               data_path, mmap_mode)
+        for key in ds['arrays']:
+            array_file = _ArrayFile(f'{file_base}.{key}.npy',
+                                    data_path=data_path, mmap_mode=mmap_mode)
+            items[key] = array_file if lazy else array_file.load()
+        if not lazy:
+            items['metadata']._load_all()
+        dset = cls(**items)
+        dset._restore_digests()
+        return dset
+
+    def digest(self, key, hash_type='sha1'):
+        """Hex digest of the item `key` (e.g. 'data' or 'target')
+
+        The digest is computed (see `hash_array`) at most once, and is
+        forgotten if the item is replaced. Digests written by `dump` are
+        reused when a dataset is loaded, without reading its arrays.
+        Items are assumed not to be modified in place.
+        """
+        digest = self._digests.get((key, hash_type), None)
+        if digest is None:
+            digest = hash_array(self[key], hash_type=hash_type)
+            self._digests[(key, hash_type)] = digest
+        return digest
+
+    def _restore_digests(self):
+        """Reuse the digests recorded in the metadata by `dump`"""
+        metadata = dict.get(self, 'metadata', None) or {}
+        hash_type = metadata.get('hash_type', None)
+        if (hash_type is None
+                or metadata.get('hash_format', None) != _HASH_FORMAT):
+            return
+        for key in self.keys():
+            digest = metadata.get(f'{key}_hash', None)
+            if key != 'metadata' and digest is not None:
+                self._digests[(key, hash_type)] = digest
+
+    @property
+    def n_points(self):
+        """Number of rows in `data`"""
+        return dict.get(self, 'data').shape[0]
+
+    def subset(self, selection, dataset_name=None):
+        """Dataset made up of a subset of the rows of this one
+
+        Rows are selected from `data`, `target` and any other items or
+        metadata entries (such as per-point file names) with one entry per
+        row, so they stay aligned. Where possible, the subset is a view:
+        slices (and indices in a regular progression) of in-memory or
+        memory-mapped arrays are not copied, and other selections are only
+        gathered when an item is first accessed.
+
+        The selection is recorded in `metadata['subset']`, along with the
+        digests of the selected indices and of this dataset's data, so
+        subsets can be identified (and cached) by their provenance.
+
+        selection: slice, boolean mask or array of integer indices
+            Rows to select
+        dataset_name: string or None
+            Name of the new dataset. By default, this dataset's name
+
+        >>> ds = Dataset('ten', data=np.arange(20).reshape(10, 2),
+        ...              target=np.arange(10))
+        >>> sub = ds.subset(slice(2, 5))
+        >>> sub.target, np.shares_memory(sub.data, ds.data)
+        (array([2, 3, 4]), True)
+        >>> ds.subset(ds.target % 3 == 0).target
+        array([0, 3, 6, 9])
+        >>> ds.subset([7, 1]).data
+        array([[14, 15],
+               [ 2,  3]])
+        """
+        n_rows = self.n_points
+        index = _row_index(selection, n_rows)
+        if isinstance(index, slice):
+            index_array = np.arange(n_rows)[index]
+        else:
+            index_array = index
+
+        def select(value, lazy):
+            if getattr(value, 'shape', None) is None or \
+               len(value.shape) == 0 or value.shape[0] != n_rows:
+                return value
+            if lazy and not isinstance(index, slice):
+                return _ArrayTake(value, index)
+            return _take_rows(value, index)
+
+        stale = ({'hash_type', 'hash_format', 'subset'}
+                 | {f'{k}_hash' for k in self.keys()})
+        metadata = {k: select(v, lazy=False)
+                    for k, v in self['metadata'].items() if k not in stale}
+        if dataset_name is not None:
+            metadata['dataset_name'] = dataset_name
+        metadata['subset'] = {
+            'parent_name': self.name,
+            'hash_type': 'sha1',
+            'parent_data_hash': self.digest('data', hash_type='sha1'),
+            'index_hash': hash_array(index_array.astype(np.int64),
+                                     hash_type='sha1'),
+            'n_points': len(index_array),
+        }
+        if isinstance(index, slice):
+            metadata['subset']['slice'] = (int(index.start), int(index.stop),
+                                           int(index.step))
+        if 'subset' in self['metadata']:
+            metadata['subset']['parent_subset'] = self['metadata']['subset']
+
+        items = {k: select(self[k], lazy=True)
+                 for k in self.keys() if k != 'metadata'}
+        items['metadata'] = metadata
+        return Dataset(**items)
 
     def get_data_hashes(self, exclude_list=None, hash_type='sha1'):
         """Compute a the hash of data items
@@ -133,21 +505,21 @@ class Dataset(Bunch):
             List of attributes to skip.
             if None, skips ['metadata']
 
-        hash_type: {'sha1', 'md5', 'sha256'}
-            Algorithm to use for hashing
+        hash_type: {'blake2b', 'sha1', 'md5', 'sha256'}
+            Algorithm to use for hashing (see `digest`)
         """
         if exclude_list is None:
             exclude_list = ['metadata']
 
-        ret = {'hash_type': hash_type}
-        for key, value in self.items():
+        ret = {'hash_type': hash_type, 'hash_format': _HASH_FORMAT}
+        for key in self.keys():
             if key in exclude_list:
                 continue
-            ret[f"{key}_hash"] = joblib.hash(value, hash_name=hash_type)
+            ret[f"{key}_hash"] = self.digest(key, hash_type=hash_type)
         return ret
 
     def dump(self, file_base=None, data_path=None, hash_type='sha1',
-             force=True, create_dirs=True, dump_metadata=True):
+             force=True, create_dirs=True, dump_metadata=True, storage='npy'):
         """Dump a dataset.
 
         Note, this dumps a separate metadata structure, so that dataset
@@ -158,7 +530,7 @@ class Dataset(Bunch):
             in the (potentially large) dataset itself
         file_base: string
             Filename stem. By default, just the dataset name
-        hash_type: {'sha1', 'md5'}
+        hash_type: {'blake2b', 'sha1', 'md5'}
             Hash function to use for hashing data/labels
         data_path: path. (default: `processed_data_path`)
             Directory where data will be dumped.
@@ -167,8 +539,17 @@ class Dataset(Bunch):
             If True, overwrite any existing files
         create_dirs: boolean
             If True, `data_path` will be created (if necessary)
+        storage: {'npy', 'joblib'}
+            If 'npy', numeric arrays (e.g. `data` and `target`) are written
+            as raw `{file_base}.{key}.npy` files beside a small `.dataset`
+            file holding everything else, so they can later be loaded with
+            `mmap_mode`. If 'joblib', the whole dataset is pickled into the
+            `.dataset` file. Any items of a lazily loaded dataset are read
+            into memory first.
 
         """
+        if storage not in _STORAGE_FORMATS:
+            raise Exception(f"Unknown storage format: {storage}")
         if data_path is None:
             data_path = processed_data_path
         data_path = pathlib.Path(data_path)
@@ -176,6 +557,12 @@ class Dataset(Bunch):
         if file_base is None:
             file_base = self.name
 
+        if storage == 'joblib':
+            # placeholders only pickle a file name, so read them in first
+            self._load_all()
+            if isinstance(self['metadata'], _LazyDict):
+                self['metadata']._load_all()
+
         metadata = self['metadata']
 
         metadata_filename = file_base + '.metadata'
@@ -183,32 +570,51 @@ class Dataset(Bunch):
         metadata_fq = data_path / metadata_filename
 
         data_hashes = self.get_data_hashes(hash_type=hash_type)
-        self['metadata'] = {**self['metadata'], **data_hashes}
+        self['metadata'] = _LazyDict({**self['metadata'], **data_hashes})
 
         # check for a cached version
         if metadata_fq.exists() and force is not True:
-            logger.warning(f"Existing metatdata file found: {metadata_fq}")
-            cached_metadata = joblib.load(metadata_fq)
-            # are we a subset of the cached metadata? (Py3+ only)
-            if metadata.items() <= cached_metadata.items():
-                raise Exception(f'Dataset with matching metadata exists already. '
-                                'Use `force=True` to overwrite, or change one of '
-                                '`dataset.metadata` or `file_base`')
-            else:
-                raise Exception(f'Metadata file {metadata_filename} exists '
-                                'but metadata has changed. '
-                                'Use `force=True` to overwrite, or change '
-                                '`file_base`')
+            _refuse_overwrite(metadata_fq, metadata)
 
         if create_dirs:
             os.makedirs(metadata_fq.parent, exist_ok=True)
 
+        if storage == 'npy':
+            # large metadata arrays go in their own files, so they can be
+            # lazy-loaded
+            full_metadata = _split_large_arrays(self['metadata'], data_path,
+                                                f'{file_base}.metadata')
+            to_pickle = self._dump_arrays(data_path, file_base)
+            to_pickle['items']['metadata'] = full_metadata
+        else:
+            full_metadata = self['metadata']
+            to_pickle = self
+
         if dump_metadata:
+            # written after the digests are added, so it matches the pickle
             with open(metadata_fq, 'wb') as fo:
-                joblib.dump(metadata, fo)
+                joblib.dump(full_metadata, fo)
             logger.debug(f'Wrote {metadata_filename}')
 
         dataset_fq = data_path / dataset_filename
         with open(dataset_fq, 'wb') as fo:
-            joblib.dump(self, fo)
+            joblib.dump(to_pickle, fo)
         logger.debug(f'Wrote {dataset_filename}')
+
+    def _dump_arrays(self, data_path, file_base):
+        """Write raw array items to `{file_base}.{key}.npy` files
+
+        Returns
+        -------
+        The contents of an 'npy' format `.dataset` file
+        """
+        array_keys = [key for key, value in self.items()
+                      if _is_raw_array(value)]
+        for key in array_keys:
+            _atomic_save_array(data_path / f'{file_base}.{key}.npy',
+                               self[key])
+        return {
+            'storage': 'npy',
+            'arrays': array_keys,
+            'items': {k: v for k, v in self.items() if k not in array_keys},
+        }
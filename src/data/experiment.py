@@ -1,4 +1,3 @@
-import joblib
 import logging
 import os
 import pathlib
@@ -7,7 +6,7 @@ import time
 
 from ..paths import processed_data_path
 from ..utils import record_time_interval
-from .dset import Dataset
+from .dset import Dataset, _HASH_FORMAT
 from ..logging import logger
 
 _MODULE = sys.modules[__name__]
@@ -39,7 +38,8 @@ def run_algorithm(dataset, algorithm_object=None, algorithm_name=None,
     run_number: (int) attempt number via the same parameters
     data_path: (path) base path for save the output datset to
     force: (boolean) force re-running the algorithm and overwriting
-        any existing data.
+        any existing data. Experiments whose hashes were computed in an
+        older format are always re-run.
 
     Returns
     -------
@@ -63,8 +63,9 @@ def run_algorithm(dataset, algorithm_object=None, algorithm_name=None,
         'algorithm_name': algorithm_name,
         'algorithm_object': algorithm_repr,
         'hash_type': hash_type,
-        'data_hash': joblib.hash(dataset.data, hash_name=hash_type),
-        'target_hash': joblib.hash(dataset.target, hash_name=hash_type),
+        'hash_format': _HASH_FORMAT,
+        'data_hash': dataset.digest('data', hash_type=hash_type),
+        'target_hash': dataset.digest('target', hash_type=hash_type),
         'run_number': run_number,
         }
 
@@ -72,9 +73,13 @@ def run_algorithm(dataset, algorithm_object=None, algorithm_name=None,
 
     if metadata_fq.exists() and force is False:
         cached_metadata = Dataset.load(file_base, data_path=data_path, metadata_only=True)
-        if experiment.items() <= cached_metadata['experiment'].items():
+        cached_experiment = cached_metadata['experiment']
+        if cached_experiment.get('hash_format', None) != _HASH_FORMAT:
+            logger.info("Cached experiment predates the current hash format. "
+                        "Re-running")
+        elif experiment.items() <= cached_experiment.items():
             logger.info("Experiment has already been run. Returning Cached Result")
-            return Dataset.load(file_base, data_path=data_path)
+            return Dataset.load(file_base, data_path=data_path, lazy=True)
         else:
             raise Exception(f'An Experiment with this name exists already, '
                             'but metadata has changed. '
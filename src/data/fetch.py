@@ -1,14 +1,19 @@
 import hashlib
 import gzip
+import json
 import os
 import pathlib
 import shutil
 import tarfile
+import tempfile
+import threading
 import zipfile
 import zlib
+from concurrent.futures import ThreadPoolExecutor
 import requests
 
 from ..paths import raw_data_path, interim_data_path
+from .mirror import get_raw_mirror
 from ..logging import logger
 
 __all__ = [
@@ -17,7 +22,10 @@ __all__ = [
     'fetch_files',
     'fetch_text_file',
     'hash_file',
-    'unpack'
+    'hash_files',
+    'cached_hash_file',
+    'unpack',
+    'unpack_files',
 ]
 
 _HASH_FUNCTION_MAP = {
@@ -26,6 +34,54 @@ _HASH_FUNCTION_MAP = {
     'sha256': hashlib.sha256,
 }
 
+# Files are read in chunks of this size when hashing
+_HASH_BLOCK_SIZE = 2**20
+
+# Sidecar file recording the digests of the files in a directory
+_HASH_INDEX = '.file_hashes.json'
+_HASH_INDEX_LOCK = threading.Lock()
+
+# Record of what `unpack` extracted into a directory, and from which archive
+_UNPACK_MANIFEST = '.unpack_manifest.json'
+_UNPACK_MANIFEST_LOCK = threading.Lock()
+
+# Downloads are streamed to disk in chunks of this size
+_CHUNK_SIZE = 2**20
+
+# Default number of concurrent downloads in `fetch_files`
+_FETCH_WORKERS = 4
+
+# seconds to wait for a server to respond (connect, or between chunks)
+_FETCH_TIMEOUT = 60
+
+# times an interrupted download is resumed before giving up
+_FETCH_RETRIES = 3
+
+_RETRYABLE_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.Timeout,
+)
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+
+def _get_session():
+    '''Shared requests Session, so connections to a host are pooled and reused
+    '''
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_maxsize=_FETCH_WORKERS)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _SESSION = session
+        return _SESSION
+
+
 def available_hashes():
     """Valid Hash Functions
 
@@ -50,7 +106,8 @@ def available_hashes():
     """
     return _HASH_FUNCTION_MAP
 
-def hash_file(fname, algorithm="sha1", block_size=4096):
+
+def hash_file(fname, algorithm="sha1", block_size=_HASH_BLOCK_SIZE):
     '''Compute the hash of an on-disk file
 
     algorithm: {'md5', sha1', 'sha256'}
@@ -62,15 +119,113 @@ def hash_file(fname, algorithm="sha1", block_size=4096):
         Hashlib object
     '''
     hashval = _HASH_FUNCTION_MAP[algorithm]()
-    with open(fname, "rb") as fd:
-        for chunk in iter(lambda: fd.read(block_size), b""):
-            hashval.update(chunk)
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    with open(fname, "rb", buffering=0) as fd:
+        for n_bytes in iter(lambda: fd.readinto(buffer), 0):
+            hashval.update(view[:n_bytes])
     return hashval
 
-def fetch_files(force=False, dst_dir=None, **kwargs):
+
+def _file_signature(stat):
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+            'inode': stat.st_ino}
+
+
+def _read_json(path):
+    try:
+        with open(path, 'r') as fr:
+            return json.load(fr)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _write_json(path, obj):
+    """Atomically replace `path` with the JSON serialization of `obj`"""
+    path = pathlib.Path(path)
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as fw:
+            json.dump(obj, fw, indent=2, sort_keys=True)
+        os.replace(tmp_name, path)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
+def _read_hash_index(directory):
+    return _read_json(pathlib.Path(directory) / _HASH_INDEX)
+
+
+def _record_hash(fname, algorithm, digest):
+    """Add the digest of `fname` to the hash index in its directory"""
+    fname = pathlib.Path(fname)
+    entry = _file_signature(os.stat(fname))
+    with _HASH_INDEX_LOCK:
+        index = _read_hash_index(fname.parent)
+        old_entry = index.get(fname.name, {})
+        digests = {}
+        if {k: old_entry.get(k) for k in entry} == entry:
+            digests = old_entry.get('digests', {})
+        digests[algorithm] = digest
+        index[fname.name] = {**entry, 'digests': digests}
+        _write_json(fname.parent / _HASH_INDEX, index)
+
+
+def cached_hash_file(fname, algorithm="sha1"):
+    '''Hex digest of an on-disk file, using the directory's hash index
+
+    Digests are recorded in a sidecar index file (`.file_hashes.json`)
+    in the file's directory, along with the size, modification time and
+    inode of the file. A file is only rehashed if one of these changed.
+
+    Returns:
+        hex digest (string)
+    '''
+    fname = pathlib.Path(fname)
+    entry = _read_hash_index(fname.parent).get(fname.name, {})
+    signature = _file_signature(os.stat(fname))
+    digest = entry.get('digests', {}).get(algorithm)
+    if digest is not None and \
+       {k: entry.get(k) for k in signature} == signature:
+        return digest
+    digest = hash_file(fname, algorithm=algorithm).hexdigest()
+    _record_hash(fname, algorithm, digest)
+    return digest
+
+
+def hash_files(file_list, algorithm="sha1", n_workers=None):
+    '''Hex digests of several on-disk files, hashed concurrently
+
+    Digests are looked up in (and added to) the hash index, as in
+    `cached_hash_file`.
+
+    file_list: list of paths
+    algorithm: {'md5', sha1', 'sha256'}
+    n_workers: int or None
+        Maximum number of files to hash at once (default 4)
+
+    Returns:
+        list of hex digests, in `file_list` order
+    '''
+    if n_workers is None:
+        n_workers = _FETCH_WORKERS
+    file_list = list(file_list)
+    if not file_list:
+        return []
+    n_workers = max(1, min(n_workers, len(file_list)))
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        return list(pool.map(
+            lambda f: cached_hash_file(f, algorithm=algorithm), file_list))
+
+
+def fetch_files(force=False, dst_dir=None, n_workers=None, **kwargs):
     '''
     fetches a list of files via URL
 
+    Up to `n_workers` files are downloaded concurrently. Results are
+    returned in `url_list` order.
+
     url_list: list of dicts, each containing:
         url:
             url to be downloaded
@@ -84,6 +239,8 @@ def fetch_files(force=False, dst_dir=None, **kwargs):
         raw_file:
             output file name. If not specified, use the last
             component of the URL
+    n_workers: int or None
+        Maximum number of concurrent downloads (default 4)
 
     Examples
     --------
@@ -95,13 +252,19 @@ def fetch_files(force=False, dst_dir=None, **kwargs):
     url_list = kwargs.get('url_list', None)
     if not url_list:
         return fetch_file(force=force, dst_dir=dst_dir, **kwargs)
-    result_list = []
-    for url_dict in url_list:
+    if n_workers is None:
+        n_workers = _FETCH_WORKERS
+
+    def _fetch(url_dict):
         name = url_dict.get('name', None)
         if name is None:
             name = url_dict.get('url', 'dataset')
         logger.debug(f"Ready to fetch {name}")
-        result_list.append(fetch_file(force=force, dst_dir=dst_dir, **url_dict))
+        return fetch_file(force=force, dst_dir=dst_dir, **url_dict)
+
+    n_workers = max(1, min(n_workers, len(url_list)))
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        result_list = list(pool.map(_fetch, url_list))
     return all([r[0] for r in result_list]), result_list
 
 def fetch_text_file(url, file_name=None, dst_dir=None, force=True, **kwargs):
@@ -146,6 +309,16 @@ def fetch_file(url=None, contents=None,
 
     if `file_name` already exists, compute the hash of the on-disk file
 
+    If a raw mirror is configured (see `RawMirror`), files with a known
+    `hash_value` are taken from the mirror before going to the network,
+    and verified downloads are added to it.
+
+    Downloads are resumable: an interrupted download is kept in `dst_dir`
+    as `{file_name}.part` and continued (via an HTTP Range request, if the
+    server supports them) by the next call. An existing `file_name` with a
+    bad hash is likewise treated as incomplete and continued, before
+    falling back to a fresh download.
+
     contents:
         contents of file to be created
     url:
@@ -188,109 +361,568 @@ def fetch_file(url=None, contents=None,
             raise Exception('One of `file_name` or `url` is required')
         file_name = url.split("/")[-1]
     dl_data_path = pathlib.Path(dst_dir)
-
-    if not os.path.exists(dl_data_path):
-        os.makedirs(dl_data_path)
+    os.makedirs(dl_data_path, exist_ok=True)
 
     raw_data_file = dl_data_path / file_name
 
+    resume_file = False
     if raw_data_file.exists():
-        raw_file_hash = hash_file(raw_data_file, algorithm=hash_type).hexdigest()
-        if hash_value is not None:
-            if raw_file_hash == hash_value:
-                if force is False:
-                    logger.debug(f"{file_name} already exists and hash is valid")
-                    return True, raw_data_file, raw_file_hash
-            else:
-                logger.warning(f"{file_name} exists but has bad hash {raw_file_hash}."
-                               " Re-downloading")
-        else:
-            if force is False:
-                logger.debug(f"{file_name} exists, but no hash to check")
-                return True, raw_data_file, raw_file_hash
+        raw_file_hash, usable = _check_raw_file(raw_data_file, hash_type,
+                                                hash_value, force)
+        if usable:
+            return True, raw_data_file, raw_file_hash
+        # a bad file may just be incomplete; try to fetch only what's missing
+        resume_file = url is not None and \
+            hash_value not in (None, raw_file_hash)
+
+    if hash_value is not None and force is False and \
+       _get_mirrored(raw_data_file, hash_type, hash_value):
+        return True, raw_data_file, hash_value
+    # a bad mirrored copy replaces (and takes with it) any partial file
+    resume_file = resume_file and raw_data_file.exists()
 
     if url is None and contents is None:
-        raise Exception("One of `url` or `contents` must be specified if `file_name` doesn't yet exist")
+        raise Exception("One of `url` or `contents` must be specified if "
+                        "`file_name` doesn't yet exist")
 
     if url is not None:
-        # Download the file
-        try:
-            results = requests.get(url)
-            results.raise_for_status()
-            raw_file_hash = _HASH_FUNCTION_MAP[hash_type](results.content).hexdigest()
-            if hash_value is not None:
-                if raw_file_hash != hash_value:
-                    print(f"Invalid hash on downloaded {file_name}"
-                          f" ({hash_type}:{raw_file_hash}) != {hash_type}:{hash_value}")
-                    return False, None, raw_file_hash
-            logger.debug(f"Writing {raw_data_file}")
-            with open(raw_data_file, "wb") as code:
-                code.write(results.content)
-        except requests.exceptions.HTTPError as err:
-            return False, err, None
+        return _download_raw_file(url, raw_data_file, hash_type=hash_type,
+                                  hash_value=hash_value,
+                                  resume_file=resume_file)
     elif contents is not None:
         with open(raw_data_file, 'w') as fw:
             fw.write(contents)
-        raw_file_hash = hash_file(raw_data_file, algorithm=hash_type).hexdigest()
+        raw_file_hash = cached_hash_file(raw_data_file, algorithm=hash_type)
         return True, raw_data_file, raw_file_hash
     else:
         raise Exception('One of `url` or `contents` must be specified')
 
-    return results.status_code, raw_data_file, raw_file_hash
 
-def unpack(filename, dst_dir=None, create_dst=True):
+def _check_raw_file(raw_data_file, hash_type, hash_value, force):
+    """Hash an existing raw file, and check it against `hash_value`
+
+    Returns
+    -------
+    (hexdigest, usable), where usable is True if the file can be used as is
+    """
+    file_name = raw_data_file.name
+    raw_file_hash = cached_hash_file(raw_data_file, algorithm=hash_type)
+    if hash_value is None:
+        if force is False:
+            logger.debug(f"{file_name} exists, but no hash to check")
+        return raw_file_hash, force is False
+    if raw_file_hash != hash_value:
+        logger.warning(f"{file_name} exists but has bad hash "
+                       f"{raw_file_hash}. Re-downloading")
+        return raw_file_hash, False
+    if force is False:
+        logger.debug(f"{file_name} already exists and hash is valid")
+        _mirror_put(hash_type, hash_value, raw_data_file)
+    return raw_file_hash, force is False
+
+
+def _get_mirrored(raw_data_file, hash_type, hash_value):
+    """Place a copy of a raw file from the raw mirror, if it has one
+
+    The mirror is shared, so the copy is checked against `hash_value`.
+    A bad copy is removed, and evicted from the mirror.
+
+    Returns
+    -------
+    True if `raw_data_file` now holds a good copy
+    """
+    mirror = get_raw_mirror()
+    if mirror is None or not mirror.get(hash_type, hash_value, raw_data_file):
+        return False
+    placed_hash = hash_file(raw_data_file, algorithm=hash_type).hexdigest()
+    if placed_hash == hash_value:
+        _record_hash(raw_data_file, hash_type, hash_value)
+        return True
+    logger.warning(f"Mirrored copy of {raw_data_file.name} has bad hash "
+                   f"{placed_hash}. Evicting it from the raw mirror")
+    os.unlink(raw_data_file)
+    try:
+        mirror.remove(hash_type, hash_value)
+    except OSError as err:
+        logger.warning(f"Could not evict {hash_type}:{hash_value} "
+                       f"from raw mirror: {err}")
+    return False
+
+
+def _download_raw_file(url, raw_data_file, hash_type, hash_value,
+                       resume_file):
+    """Download `url` to `raw_data_file`, adding it to the raw mirror if
+    its hash is good
+
+    Returns
+    -------
+    As for `fetch_file`
+    """
+    try:
+        status_code, raw_file_hash = _download(url, raw_data_file,
+                                               hash_type=hash_type,
+                                               hash_value=hash_value,
+                                               resume_file=resume_file)
+    except requests.exceptions.HTTPError as err:
+        return False, err, None
+    if hash_value is not None:
+        if raw_file_hash != hash_value:
+            logger.warning(f"Invalid hash on downloaded {raw_data_file.name}"
+                           f" ({hash_type}:{raw_file_hash}) != "
+                           f"{hash_type}:{hash_value}")
+            return False, None, raw_file_hash
+        _mirror_put(hash_type, hash_value, raw_data_file)
+    return status_code, raw_data_file, raw_file_hash
+
+
+def _mirror_put(hash_type, hash_value, raw_data_file):
+    '''Add a verified raw file to the raw mirror, if one is configured'''
+    mirror = get_raw_mirror()
+    if mirror is not None:
+        try:
+            mirror.put(hash_type, hash_value, raw_data_file)
+        except OSError as err:
+            logger.warning(f"Could not add {raw_data_file} to raw mirror: "
+                           f"{err}")
+
+
+def _content_range_total(content_range):
+    """Complete length from a `Content-Range` header, or None if unknown
+
+    >>> _content_range_total('bytes */1234')
+    1234
+    >>> _content_range_total('bytes 0-9/*') is None
+    True
+    """
+    if content_range is None:
+        return None
+    total = content_range.rsplit('/', 1)[-1].strip()
+    return int(total) if total.isdigit() else None
+
+
+class _PartialDownload:
+    """A download in progress, kept as `{dst_file}.part` until complete
+
+    Download progress (the URL, and the server's validators for the
+    resource) is recorded in `{dst_file}.part.json`, so an interrupted
+    download can be resumed later, by this or another process, with an
+    HTTP `Range` request. Bytes are hashed as they arrive; on resuming,
+    the bytes already on disk are hashed once.
+    """
+    def __init__(self, url, dst_file, hash_type="sha1"):
+        self.url = url
+        self.dst_file = pathlib.Path(dst_file)
+        self.part_file = self.dst_file.with_name(f'{self.dst_file.name}.part')
+        self.progress_file = self.dst_file.with_name(
+            f'{self.dst_file.name}.part.json')
+        self.hash_type = hash_type
+        self.progress = {'url': url}
+        self.offset = 0
+        self.hashval = _HASH_FUNCTION_MAP[hash_type]()
+
+        try:
+            with open(self.progress_file, 'r') as fr:
+                progress = json.load(fr)
+        except (FileNotFoundError, json.JSONDecodeError):
+            progress = {}
+        if progress.get('url') == url and self.part_file.exists():
+            self.progress = progress
+            self.hashval = hash_file(self.part_file, algorithm=hash_type)
+            self.offset = self.part_file.stat().st_size
+            logger.debug(f"Resuming download of {self.dst_file.name} "
+                         f"at byte {self.offset}")
+
+    @classmethod
+    def from_file(cls, url, dst_file, hash_type="sha1"):
+        """Treat an existing (e.g. truncated) `dst_file` as a partial download
+        """
+        download = cls(url, dst_file, hash_type=hash_type)
+        if os.stat(download.dst_file).st_nlink > 1:
+            # shared with another copy (e.g. a raw mirror entry), which
+            # appending to it in place would change too
+            shutil.copyfile(download.dst_file, download.part_file)
+            os.unlink(download.dst_file)
+        else:
+            os.replace(download.dst_file, download.part_file)
+        download._write_progress()
+        return cls(url, dst_file, hash_type=hash_type)
+
+    def _write_progress(self):
+        with open(self.progress_file, 'w') as fw:
+            json.dump(self.progress, fw)
+
+    def restart(self):
+        """Throw away any partial data"""
+        self.discard()
+        self.progress = {'url': self.url}
+        self.offset = 0
+        self.hashval = _HASH_FUNCTION_MAP[self.hash_type]()
+
+    def discard(self):
+        """Remove the partial download files"""
+        for path in [self.part_file, self.progress_file]:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def fetch(self):
+        """Download (the rest of) the file
+
+        If the server rejects the range as unsatisfiable (416), the partial
+        file is kept if its size matches the length the server reports, and
+        otherwise discarded and downloaded again in full.
+
+        Returns
+        -------
+        HTTP status code
+        """
+        headers = {}
+        if self.offset > 0:
+            headers['Range'] = f'bytes={self.offset}-'
+            validator = self.progress.get('etag') or \
+                self.progress.get('last_modified')
+            if validator:
+                headers['If-Range'] = validator
+        with _get_session().get(self.url, stream=True, timeout=_FETCH_TIMEOUT,
+                                headers=headers) as results:
+            if self.offset > 0 and results.status_code == 416:
+                # the range starts at (or past) the end of the resource
+                total = _content_range_total(
+                    results.headers.get('Content-Range'))
+                if total == self.offset:
+                    logger.debug(f"{self.part_file.name} is already complete")
+                    return requests.codes.ok
+                logger.debug(f"Server rejected resuming {self.url} at byte "
+                             f"{self.offset}. Restarting download")
+                self.restart()
+                return self.fetch()
+            results.raise_for_status()
+            if self.offset > 0 and results.status_code != 206:
+                logger.debug(f"Server sent all of {self.url}. "
+                             "Restarting download")
+                self.restart()
+            self.progress['etag'] = results.headers.get('ETag')
+            self.progress['last_modified'] = \
+                results.headers.get('Last-Modified')
+            self._write_progress()
+            with open(self.part_file, 'r+b' if self.offset else 'wb') as fw:
+                # drop anything written beyond what has been hashed
+                fw.truncate(self.offset)
+                fw.seek(self.offset)
+                for chunk in results.iter_content(chunk_size=_CHUNK_SIZE):
+                    fw.write(chunk)
+                    self.hashval.update(chunk)
+                    self.offset += len(chunk)
+        return results.status_code
+
+    def finish(self):
+        """Move the completed download into place"""
+        logger.debug(f"Writing {self.dst_file}")
+        os.replace(self.part_file, self.dst_file)
+        os.unlink(self.progress_file)
+
+
+def _download(url, dst_file, hash_type="sha1", hash_value=None,
+              resume_file=False):
+    '''Stream `url` into `dst_file`, hashing it on the way
+
+    The download is written to `{dst_file}.part`, which is only renamed
+    into place once complete (and, if `hash_value` is given, only if the
+    hash matches), so a failed download never leaves a truncated or
+    corrupt `dst_file` behind. Interrupted downloads are resumed
+    (up to `_FETCH_RETRIES` times), as are partial files left behind by
+    earlier calls.
+
+    resume_file: boolean
+        If True, an existing `dst_file` is assumed to be an incomplete
+        copy of `url` and the download continues from its end
+
+    Returns
+    -------
+    (HTTP status code, hexdigest of the downloaded file)
+    '''
+    if resume_file:
+        download = _PartialDownload.from_file(url, dst_file,
+                                              hash_type=hash_type)
+    else:
+        download = _PartialDownload(url, dst_file, hash_type=hash_type)
+    resumed = download.offset > 0
+    if resumed and hash_value is not None and \
+       download.hashval.hexdigest() == hash_value:
+        # the partial file turns out to be complete
+        download.finish()
+        _record_hash(dst_file, hash_type, hash_value)
+        return requests.codes.ok, hash_value
+
+    attempt = 0
+    while True:
+        try:
+            status_code = download.fetch()
+        except _RETRYABLE_ERRORS as err:
+            if attempt >= _FETCH_RETRIES:
+                raise
+            attempt += 1
+            logger.warning(f"Download of {url} interrupted at byte "
+                           f"{download.offset} ({err}). Resuming")
+            continue
+        digest = download.hashval.hexdigest()
+        if hash_value is None or digest == hash_value:
+            break
+        download.discard()
+        if not resumed:
+            return status_code, digest
+        # the earlier partial data may have been bad. Try from scratch
+        logger.warning(f"Resumed download of {url} has a bad hash. Restarting")
+        download.restart()
+        resumed = False
+    download.finish()
+    _record_hash(dst_file, hash_type, digest)
+    return status_code, digest
+
+
+def _read_lzw_header(f_in):
+    """Maximum code width, and whether block mode is on, from a .Z header"""
+    header = f_in.read(3)
+    if header[:2] != b'\x1f\x9d':
+        raise Exception("Not a .Z (LZW compressed) file")
+    max_bits = header[2] & 0x1f
+    block_mode = header[2] & 0x80
+    if max_bits < 9 or max_bits > 16:
+        raise Exception(f"Unsupported .Z maximum code width: {max_bits}")
+    return max_bits, block_mode
+
+
+def _lzw_entry(table, code, free_entry, old_code):
+    """String for `code`, which may be the entry about to be added"""
+    if code < free_entry:
+        return table[code]
+    if code == free_entry:
+        return table[old_code] + table[old_code][:1]
+    raise Exception("Corrupt .Z file")
+
+
+def _lzw_decompress(f_in, f_out):
+    '''Decompress a unix `compress` (.Z, LZW) stream
+
+    f_in: binary file object, positioned at the start of the .Z data
+    f_out: binary file object to write the decompressed data to
+
+    Codes are packed in groups of 8 (i.e. `n_bits` bytes at a time). When
+    the code width grows, or the table is cleared, `compress` skips to the
+    start of the next group, so input is read a group at a time.
+
+    >>> import io
+    >>> data = bytes.fromhex('1f9d9061c4041c2806')
+    >>> out = io.BytesIO()
+    >>> _lzw_decompress(io.BytesIO(data), out)
+    >>> out.getvalue()
+    b'abababab'
+    '''
+    max_bits, block_mode = _read_lzw_header(f_in)
+    max_max_code = 1 << max_bits
+
+    table = [bytes([i]) for i in range(256)] + [b''] * (max_max_code - 256)
+    n_bits = 9
+    max_code = (1 << n_bits) - 1
+    free_entry = 257 if block_mode else 256
+    old_code = None
+    out = bytearray()
+    while True:
+        group = f_in.read(n_bits)
+        if not group:
+            break
+        bits = int.from_bytes(group, 'little')
+        mask = (1 << n_bits) - 1
+        for i in range(len(group) * 8 // n_bits):
+            code = (bits >> (i * n_bits)) & mask
+            if old_code is None:
+                if code > 255:
+                    raise Exception("Corrupt .Z file")
+                out += table[code]
+                old_code = code
+                continue
+            if code == 256 and block_mode:
+                free_entry = 256
+                n_bits = 9
+                max_code = (1 << n_bits) - 1
+                break
+            entry = _lzw_entry(table, code, free_entry, old_code)
+            out += entry
+            if free_entry < max_max_code:
+                table[free_entry] = table[old_code] + entry[:1]
+                free_entry += 1
+            old_code = code
+            if free_entry > max_code:
+                # as in compress (and gzip), a 9-bit maximum still grows
+                # to 10 bits once the table is full
+                n_bits += 1
+                max_code = (max_max_code if n_bits == max_bits
+                            else (1 << n_bits) - 1)
+                break
+        if len(out) >= _CHUNK_SIZE:
+            f_out.write(out)
+            out = bytearray()
+    f_out.write(out)
+
+
+def _manifest_matches(entry, dst_dir, digest):
+    if entry.get('hash') != digest:
+        return False
+    for name, size in entry.get('files', {}).items():
+        try:
+            if os.stat(pathlib.Path(dst_dir) / name).st_size != size:
+                return False
+        except FileNotFoundError:
+            return False
+    return True
+
+
+def _record_unpack(dst_dir, archive_name, entry):
+    with _UNPACK_MANIFEST_LOCK:
+        manifest = _read_json(pathlib.Path(dst_dir) / _UNPACK_MANIFEST)
+        manifest[archive_name] = entry
+        _write_json(pathlib.Path(dst_dir) / _UNPACK_MANIFEST, manifest)
+
+
+def _stream_to_file(f_in, dst_file, decompress=None):
+    """Copy (or decompress) `f_in` into `dst_file` via a temporary file"""
+    dst_file = pathlib.Path(dst_file)
+    fd, tmp_name = tempfile.mkstemp(dir=dst_file.parent,
+                                    prefix=f'.{dst_file.name}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f_out:
+            if decompress is None:
+                shutil.copyfileobj(f_in, f_out, _CHUNK_SIZE)
+            else:
+                decompress(f_in, f_out)
+        os.replace(tmp_name, dst_file)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+    return dst_file.stat().st_size
+
+
+def _extract_zip(path, dst_dir):
+    """Extract a zip archive, returning the sizes of the extracted files"""
+    logger.debug(f"Extracting {pathlib.Path(path).name}")
+    files = {}
+    with zipfile.ZipFile(path, 'r') as f_in:
+        for info in f_in.infolist():
+            f_in.extract(info, path=dst_dir)
+            if not info.is_dir():
+                files[info.filename] = info.file_size
+    return files
+
+
+def _extract_tar(path, dst_dir):
+    """Extract a tar archive, returning the sizes of the extracted files"""
+    logger.debug(f"Extracting {pathlib.Path(path).name}")
+    extract_opts = {}
+    if hasattr(tarfile, 'data_filter'):
+        extract_opts['filter'] = 'data'
+    files = {}
+    with tarfile.open(path, 'r|*') as f_in:
+        for member in f_in:
+            f_in.extract(member, path=dst_dir, **extract_opts)
+            if member.isreg():
+                files[member.name] = member.size
+    return files
+
+
+def _decompress_file(path, dst_dir):
+    """Decompress (or copy) a single file, returning its name and size"""
+    if path.endswith('.gz'):
+        opener, decompress, outfile = gzip.open, None, path[:-3]
+    elif path.endswith('.Z'):
+        opener, decompress, outfile = open, _lzw_decompress, path[:-2]
+    else:
+        opener, decompress, outfile = open, None, path
+        logger.info("No compression detected. Copying...")
+    outfile = pathlib.Path(outfile).name
+    logger.info(f"Decompresing {outfile}")
+    with opener(path, 'rb') as f_in:
+        return {outfile: _stream_to_file(f_in, dst_dir / outfile,
+                                         decompress=decompress)}
+
+
+def unpack(filename, dst_dir=None, create_dst=True, hash_type='sha1',
+           force=False):
     '''Unpack a compressed file
 
+    Unpacking is idempotent: the files extracted from each archive (and
+    their sizes) are recorded, along with the archive's hash, in a
+    manifest (`.unpack_manifest.json`) in `dst_dir`. If the manifest
+    matches and the extracted files are intact, nothing is done.
+
+    Archive members are streamed to disk, and the raw file itself is
+    never modified.
+
     filename: path
         file to unpack
     dst_dir: path (default paths.interim_data_path)
         destination directory for the unpack
     create_dst: boolean
         create the destination directory if needed
+    hash_type: {'md5', 'sha1', 'sha256'}
+        hash used to identify the archive in the manifest
+    force: boolean
+        If True, unpack even if the manifest matches
+
+    Returns
+    -------
+    dict of extracted files (relative to `dst_dir`) and their sizes
     '''
     if dst_dir is None:
         dst_dir = interim_data_path
+    dst_dir = pathlib.Path(dst_dir)
 
     if create_dst:
         if not os.path.exists(dst_dir):
-            os.makedirs(dst_dir)
+            os.makedirs(dst_dir, exist_ok=True)
 
+    filename = pathlib.Path(filename)
     # in case it is a Path
     path = str(filename)
 
-    archive = False
+    digest = cached_hash_file(filename, algorithm=hash_type)
+    manifest = _read_json(dst_dir / _UNPACK_MANIFEST)
+    entry = manifest.get(filename.name, {})
+    if not force and entry.get('hash_type') == hash_type and \
+       _manifest_matches(entry, dst_dir, digest):
+        logger.debug(f"{filename.name} already unpacked")
+        return entry['files']
+
     if path.endswith('.zip'):
-        archive = True
-        opener, mode = zipfile.ZipFile, 'r'
-    elif path.endswith('.tar.gz') or path.endswith('.tgz'):
-        archive = True
-        opener, mode = tarfile.open, 'r:gz'
-    elif path.endswith('.tar.bz2') or path.endswith('.tbz'):
-        archive = True
-        opener, mode = tarfile.open, 'r:bz2'
-    elif path.endswith('.tar'):
-        archive = True
-        opener, mode = tarfile.open, 'r'
-    elif path.endswith('.gz'):
-        opener, mode = gzip.open, 'rb'
-        outfile, outmode = path[:-3], 'wb'
-    elif path.endswith('.Z'):
-        logger.warning(".Z files are only supported on systems that ship with gzip. Trying...")
-        os.system(f'gzip -f -d {path}')
-        opener, mode = open, 'rb'
-        path = path[:-2]
-        outfile, outmode = path, 'wb'
+        files = _extract_zip(path, dst_dir)
+    elif path.endswith(('.tar.gz', '.tgz', '.tar.bz2', '.tbz', '.tar')):
+        files = _extract_tar(path, dst_dir)
     else:
-        opener, mode = open, 'rb'
-        outfile, outmode = path, 'wb'
-        logger.info("No compression detected. Copying...")
+        files = _decompress_file(path, dst_dir)
 
-    with opener(path, mode) as f_in:
-        if archive:
-            logger.debug(f"Extracting {filename.name}")
-            f_in.extractall(path=dst_dir)
-        else:
-            outfile = pathlib.Path(outfile).name
-            logger.info(f"Decompresing {outfile}")
-            with open(pathlib.Path(dst_dir) / outfile, outmode) as f_out:
-                shutil.copyfileobj(f_in, f_out)
+    _record_unpack(dst_dir, filename.name, {'hash_type': hash_type,
+                                            'hash': digest, 'files': files})
+    return files
+
+
+def unpack_files(file_list, dst_dir=None, n_workers=None, **kwargs):
+    '''Unpack several compressed files (in parallel) into `dst_dir`
+
+    n_workers: int or None
+        Maximum number of files to unpack at once (default 4)
+
+    Any other keyword arguments are passed on to `unpack`.
+
+    Returns
+    -------
+    list of `unpack` results, in `file_list` order
+    '''
+    if n_workers is None:
+        n_workers = _FETCH_WORKERS
+    file_list = list(file_list)
+    if not file_list:
+        return []
+    n_workers = max(1, min(n_workers, len(file_list)))
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        return list(pool.map(lambda f: unpack(f, dst_dir=dst_dir, **kwargs),
+                             file_list))
@@ -0,0 +1,291 @@
+import json
+import os
+import pathlib
+import tempfile
+
+import numpy as np
+from joblib import Parallel, delayed
+from sklearn.neighbors import NearestNeighbors
+
+from ..logging import logger
+from ..paths import interim_data_path
+
+__all__ = [
+    'available_id_estimators',
+    'estimate_intrinsic_dimension',
+    'knn_distances',
+    'mle_intrinsic_dimension',
+    'order_n_components',
+    'twonn_intrinsic_dimension',
+]
+
+
+def knn_distances(data, n_neighbors=20, metric='euclidean',
+                  block_size=4096, n_jobs=None):
+    """Distances from every row of `data` to its `n_neighbors` nearest
+    neighbors (excluding itself), sorted in increasing order.
+
+    The neighbor queries are run block-wise, with blocks of `block_size`
+    rows handed out to `n_jobs` threads.
+
+    Returns
+    -------
+    np.array of shape (n_points, n_neighbors)
+    """
+    nbrs = NearestNeighbors(n_neighbors=n_neighbors + 1, metric=metric)
+    nbrs.fit(data)
+
+    def _query(start):
+        distances, _ = nbrs.kneighbors(data[start:start + block_size])
+        return distances[:, 1:]
+
+    starts = range(0, data.shape[0], block_size)
+    blocks = Parallel(n_jobs=n_jobs, prefer='threads')(
+        delayed(_query)(start) for start in starts)
+    return np.vstack(blocks)
+
+
+def mle_intrinsic_dimension(distances, n_neighbors=None):
+    """Levina-Bickel maximum likelihood estimate of intrinsic dimension
+
+    Per-point estimates are combined by averaging their inverses
+    (MacKay & Ghahramani's correction). Points with duplicates among
+    their neighbors are ignored.
+
+    distances: np.array
+        sorted nearest neighbor distances, as returned by `knn_distances`
+    n_neighbors: int or None
+        Number of neighbors to use. If None, use every column of `distances`
+
+    >>> distances = np.array([[1., 2., 3., 4.], [2., 4., 6., 8.]])
+    >>> round(mle_intrinsic_dimension(distances), 6)
+    1.267361
+    """
+    if n_neighbors is not None:
+        distances = distances[:, :n_neighbors]
+    distances = distances[np.all(distances > 0, axis=1)]
+    log_ratios = np.log(distances[:, -1:] / distances[:, :-1])
+    inverse_estimates = log_ratios.mean(axis=1)
+    return 1. / inverse_estimates.mean()
+
+
+def twonn_intrinsic_dimension(distances, n_neighbors=None):
+    """TwoNN estimate of intrinsic dimension (Facco et al., 2017)
+
+    Uses only the ratio of each point's second to first nearest neighbor
+    distance. Points with a duplicate neighbor are ignored.
+
+    n_neighbors: ignored
+        Present for signature compatibility with `mle_intrinsic_dimension`
+
+    >>> distances = np.array([[1., 2.], [1., 4.], [2., 4.]])
+    >>> round(twonn_intrinsic_dimension(distances), 6)
+    1.082021
+    """
+    distances = distances[:, :2]
+    distances = distances[np.all(distances > 0, axis=1)]
+    mu = distances[:, 1] / distances[:, 0]
+    return len(mu) / np.sum(np.log(mu))
+
+
+_ID_ESTIMATORS = {
+    'mle': mle_intrinsic_dimension,
+    'twonn': twonn_intrinsic_dimension,
+}
+
+
+def available_id_estimators():
+    """Valid intrinsic dimension estimators
+
+    This function simply returns the dict of known estimators.
+
+    It exists to allow for a description of the mapping for
+    each of the valid strings.
+
+    ============     ====================================
+    Estimator        Function
+    ============     ====================================
+    mle              mle_intrinsic_dimension
+    twonn            twonn_intrinsic_dimension
+    ============     ====================================
+
+    >>> list(available_id_estimators().keys())
+    ['mle', 'twonn']
+    """
+    return _ID_ESTIMATORS
+
+
+def _sidecar_base(cache_dir, dset):
+    """Path stem of the files persisting estimates for `dset`'s data
+
+    Files are named by the digest of the data, in the dataset cache
+    directory, so they are managed (and evicted) along with the cached
+    datasets by `DatasetCache`.
+    """
+    return pathlib.Path(cache_dir) / dset.digest('data', hash_type='sha1')
+
+
+def _read_estimates(sidecar_base):
+    try:
+        with open(f'{sidecar_base}.intrinsic_dim.json', 'r') as fr:
+            return json.load(fr)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _write_estimates(sidecar_base, estimates):
+    sidecar_base = pathlib.Path(sidecar_base)
+    os.makedirs(sidecar_base.parent, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=sidecar_base.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as fw:
+            json.dump(estimates, fw, indent=2, sort_keys=True)
+        os.replace(tmp_name, f'{sidecar_base}.intrinsic_dim.json')
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
+def _load_distances(sidecar_base, metric):
+    try:
+        return np.load(f'{sidecar_base}.knn_distances.{metric}.npy',
+                       mmap_mode='r')
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _save_distances(sidecar_base, metric, distances):
+    sidecar_base = pathlib.Path(sidecar_base)
+    os.makedirs(sidecar_base.parent, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=sidecar_base.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fo:
+            np.save(fo, distances, allow_pickle=False)
+        os.replace(tmp_name, f'{sidecar_base}.knn_distances.{metric}.npy')
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
+def _cached_distances(dset, sidecar_base, metric, n_neighbors):
+    """Neighbor distances held in the metadata, or persisted beside the
+    cached datasets, if there are at least `n_neighbors` of them
+    """
+    distances = None
+    if dset.metadata.get('knn_metric', 'euclidean') == metric:
+        distances = dset.metadata.get('knn_distances', None)
+    if distances is None and sidecar_base is not None:
+        distances = _load_distances(sidecar_base, metric)
+    if distances is None or distances.shape[1] < n_neighbors:
+        return None
+    return distances
+
+
+def estimate_intrinsic_dimension(dset, method='mle', n_neighbors=20,
+                                 metric='euclidean', block_size=4096,
+                                 n_jobs=None, cache_neighbors=False,
+                                 force=False, cache_dir=None):
+    """Estimate the intrinsic dimension of a Dataset
+
+    Estimates, and the nearest neighbor distances they are computed from,
+    are persisted beside the cached datasets, keyed by the digest of the
+    data (see `Dataset.digest`). Any later call on the same data (e.g. on
+    a freshly reloaded dataset) reuses them, as long as enough neighbors
+    were computed with the same metric. A neighbor graph already held in
+    the metadata (`knn_distances`) is also reused. The estimate is stored
+    in `dset.metadata['intrinsic_dimension']`.
+
+    dset: Dataset
+    method: {'mle', 'twonn'}
+        Estimator to use (see `available_id_estimators`)
+    n_neighbors: int
+        Number of neighbors used by the estimator
+    metric: string
+        Metric to use when computing nearest neighbors
+    block_size: int
+        Rows per block when computing nearest neighbors
+    n_jobs: int or None
+        Number of threads to use when computing nearest neighbors
+    cache_neighbors: boolean
+        If True, also store the neighbor distances in
+        `dset.metadata['knn_distances']`
+    force: boolean
+        If True, always recompute the estimate (and the neighbors)
+    cache_dir: path, or False
+        Where estimates and neighbor distances are persisted
+        (default: `interim_data_path`). If False, nothing is persisted
+
+    Returns
+    -------
+    float: the intrinsic dimension estimate
+    """
+    if method not in _ID_ESTIMATORS:
+        raise Exception(f"Unknown intrinsic dimension estimator: {method}")
+
+    params = {'method': method, 'n_neighbors': n_neighbors, 'metric': metric}
+    cached = dset.metadata.get('intrinsic_dimension', None)
+    if cached is not None and not force and params.items() <= cached.items():
+        return cached['estimate']
+
+    if cache_dir is None:
+        cache_dir = interim_data_path
+    sidecar_base = None
+    if cache_dir is not False and isinstance(metric, str):
+        sidecar_base = _sidecar_base(cache_dir, dset)
+    estimate_key = f'{method}:{n_neighbors}:{metric}'
+    estimates = {} if sidecar_base is None else _read_estimates(sidecar_base)
+    if estimate_key in estimates and not force:
+        estimate = estimates[estimate_key]
+        logger.debug(f"{dset.name}: reusing {method} intrinsic dimension "
+                     f"{estimate:.2f}")
+        dset.metadata['intrinsic_dimension'] = {**params, 'estimate': estimate}
+        return estimate
+
+    distances = None if force else _cached_distances(dset, sidecar_base,
+                                                     metric, n_neighbors)
+    if distances is not None:
+        logger.debug(f"Reusing cached neighbor graph for {dset.name}")
+    else:
+        distances = knn_distances(dset.data, n_neighbors=n_neighbors,
+                                  metric=metric, block_size=block_size,
+                                  n_jobs=n_jobs)
+        if sidecar_base is not None:
+            _save_distances(sidecar_base, metric, distances)
+    if cache_neighbors:
+        dset.metadata['knn_distances'] = np.asarray(distances)
+        dset.metadata['knn_metric'] = metric
+
+    estimate = float(_ID_ESTIMATORS[method](distances,
+                                            n_neighbors=n_neighbors))
+    logger.debug(f"{dset.name}: {method} intrinsic dimension {estimate:.2f}")
+    dset.metadata['intrinsic_dimension'] = {**params, 'estimate': estimate}
+    if sidecar_base is not None:
+        estimates = _read_estimates(sidecar_base)
+        estimates[estimate_key] = estimate
+        _write_estimates(sidecar_base, estimates)
+    return estimate
+
+
+def order_n_components(candidates, estimate, window=None):
+    """Order `n_components` candidates by distance from an intrinsic
+    dimension estimate, optionally dropping those too far away.
+
+    candidates: list of int
+    estimate: float
+        intrinsic dimension estimate
+    window: float or None
+        If not None, only keep candidates within this distance of
+        the estimate. The closest candidate is always kept.
+
+    >>> order_n_components([2, 3, 4, 8, 16], 3.4)
+    [3, 4, 2, 8, 16]
+    >>> order_n_components([2, 3, 4, 8, 16], 3.4, window=1)
+    [3, 4]
+    >>> order_n_components([8, 16], 3.4, window=1)
+    [8]
+    """
+    ordered = sorted(candidates, key=lambda n: (abs(n - estimate), n))
+    if window is None:
+        return ordered
+    kept = [n for n in ordered if abs(n - estimate) <= window]
+    return kept or ordered[:1]
@@ -1,13 +1,16 @@
-import cv2
-from ..paths import interim_data_path, processed_data_path
+from ..paths import interim_data_path, processed_data_path, raw_data_path
 import glob
-import pandas as pd
 import numpy as np
 import os
 import logging
-from scipy.io import loadmat
+import pathlib
 
-from .utils import read_space_delimited, normalize_labels
+# image, matlab and pandas readers are imported by the functions that
+# use them, as they are slow to import
+
+from .utils import (read_space_delimited, normalize_labels, read_idx,
+                    read_idx_header)
+from .utils import read_numeric_matrix
 from ..logging import logger
 
 __all__ = [
@@ -20,6 +23,88 @@ __all__ = [
     'process_shuttle_statlog',
 ]
 
+# Default number of threads used to decode images
+_IMAGE_WORKERS = 8
+
+
+def _read_image(filename, flags, shape=None):
+    """Read an image with `cv2.imread`, checking its shape if one is given"""
+    import cv2
+    im = cv2.imread(str(filename), flags)
+    if im is None:
+        raise Exception(f"Could not read image: {filename}")
+    if shape is not None and im.shape != shape:
+        raise Exception(f"{filename} has shape {im.shape}. Expected {shape}")
+    return im
+
+
+def _load_image_files(file_list, flags=None, preview_dir=None,
+                      preview_extension=None, n_workers=None):
+    """Decode a list of same-sized images into the rows of a uint8 array
+
+    The output array is allocated once (sized from the first image), and
+    images are decoded straight into its rows on a thread pool. Preview
+    images are written by a background thread, skipping any that already
+    exist.
+
+    file_list: list of paths
+    flags: int or None
+        `cv2.imread` flags. If None, images are loaded in color
+    preview_dir: path or None
+        Where to write preview images. If None, no previews are written
+    preview_extension: string
+        Image format (filename extension) to use for preview images
+    n_workers: int or None
+        Number of decoding threads (default 8)
+
+    Returns
+    -------
+    np.array of shape (len(file_list), n_pixels * n_channels), dtype uint8
+    """
+    import cv2
+    from concurrent.futures import ThreadPoolExecutor
+
+    if flags is None:
+        flags = cv2.IMREAD_COLOR
+    if n_workers is None:
+        n_workers = _IMAGE_WORKERS
+    file_list = list(file_list)
+    if not file_list:
+        raise Exception("No images to load")
+
+    first = _read_image(file_list[0], flags)
+    shape = first.shape
+    data = np.empty((len(file_list), first.size), dtype=np.uint8)
+
+    preview_writer = None
+    preview_jobs = []
+    if preview_dir is not None:
+        os.makedirs(preview_dir, exist_ok=True)
+        preview_writer = ThreadPoolExecutor(max_workers=1)
+
+    def _decode(row):
+        filename = file_list[row]
+        im = first if row == 0 else _read_image(filename, flags, shape=shape)
+        data[row] = im.reshape(-1)
+        if preview_writer is not None:
+            preview_file = pathlib.Path(preview_dir) / \
+                f"{pathlib.Path(filename).stem}.{preview_extension}"
+            if not preview_file.exists():
+                # the row is never modified again, so the writer can use a view
+                preview_jobs.append(preview_writer.submit(
+                    cv2.imwrite, str(preview_file), data[row].reshape(shape)))
+
+    try:
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            list(pool.map(_decode, range(len(file_list))))
+    finally:
+        if preview_writer is not None:
+            preview_writer.shutdown(wait=True)
+    for job in preview_jobs:
+        job.result()
+    return data
+
+
 def process_coil(dataset_name='coil-20', metadata=None, preview_extension=None,
               unpacked_path='processed_images', image_glob='*.pgm', colorspace='greyscale'):
     """Load a coil-style (image) dataset
@@ -38,49 +123,40 @@ def process_coil(dataset_name='coil-20', metadata=None, preview_extension=None,
         Create preview images (of this file type) in
         `processed_data_path / dataset_name / preview_extension`
         Must be a filename extension supported by the image library.
-        If None, no preview images are created
+        If None, no preview images are created. Existing preview images
+        are left alone.
     Additional metadata:
         filename: original filename
         rotation: rotation of target (extracted from filename)
     """
+    import cv2
+    import pandas as pd
 
-    if colorspace is not None:
-        if colorspace == 'greyscale':
-            colorspace = cv2.COLORSPACE_GRAY
-        elif colorspace == 'color':
-            colorspace = None
-        else:
-            raise Exception(f"Unknown colorspace: {colorspace}")
+    if colorspace == 'greyscale':
+        flags = cv2.IMREAD_GRAYSCALE
+    elif colorspace == 'color' or colorspace is None:
+        flags = cv2.IMREAD_COLOR
+    else:
+        raise Exception(f"Unknown colorspace: {colorspace}")
 
     if metadata is None:
         metadata = {}
-    feature_vectors = []
     glob_path = interim_data_path / dataset_name / unpacked_path
 
+    preview_dir = None
     if preview_extension is not None:
         logger.debug(f"creating {preview_extension}-format preview images")
         preview_dir = processed_data_path / dataset_name / preview_extension
-        if not preview_dir.exists():
-            os.makedirs(preview_dir)
 
-    filename_list = []
     logger.debug(f"Processing images in {unpacked_path} matching {image_glob}")
-    for filename in glob_path.glob(image_glob):
-        filename_list.append(filename.name)
-        if colorspace is not None:
-            im = cv2.imread(str(filename), colorspace)
-        else:
-            im = cv2.imread(str(filename))
-        feature_vectors.append(im.flatten())
-        if preview_extension is not None:
-            preview_file = preview_dir / f"{filename.stem}.{preview_extension}"
-            cv2.imwrite(str(preview_file), im)
+    file_list = sorted(glob_path.glob(image_glob))
+    data = _load_image_files(file_list, flags=flags, preview_dir=preview_dir,
+                             preview_extension=preview_extension)
 
-    metadata['filename'] = pd.Series(filename_list)
+    metadata['filename'] = pd.Series([filename.name for filename in file_list])
     metadata['rotation'] = metadata['filename'].str.extract("obj[0-9]+__([0-9]+)", expand=False)
     target = metadata['filename'].str.extract("obj([0-9]+)", expand=False)
-    data = np.vstack(feature_vectors)
-    logger.debug(f"Processed {len(feature_vectors)} images")
+    logger.debug(f"Processed {len(file_list)} images")
     dset_opts = {
         'dataset_name': dataset_name,
         'data': data,
@@ -90,27 +166,56 @@ def process_coil(dataset_name='coil-20', metadata=None, preview_extension=None,
 
     return dset_opts
 
+
+def _mnist_file(dataset_name, kind, contents):
+    """Locate an (unpacked, or else raw gzipped) MNIST-style IDX file"""
+    n_dims = 3 if contents == 'images' else 1
+    file_name = f"{kind}-{contents}-idx{n_dims}-ubyte"
+    path = interim_data_path / dataset_name / file_name
+    if not path.exists() and (raw_data_path / f"{file_name}.gz").exists():
+        path = raw_data_path / f"{file_name}.gz"
+    return path
+
+
 def process_mnist(dataset_name='mnist', kind='train', metadata=None):
     '''
     Load the MNIST dataset (or a compatible variant; e.g. F-MNIST)
 
     dataset_name: {'mnist', 'f-mnist'}
         Which variant to load
-    kind: {'train', 'test'}
+    kind: {'train', 'test', 'all'}
         Dataset comes pre-split into training and test data.
-        Indicates which dataset to load
+        Indicates which dataset to load. 'all' is the training data
+        followed by the test data
 
+    For a single split of unpacked data, `data` and `target` are
+    memory-mapped views of the IDX files. For 'all', both splits are read
+    directly into a single array.
     '''
-    if kind == 'test':
-        kind = 't10k'
-
-    label_path = interim_data_path / dataset_name / f"{kind}-labels-idx1-ubyte"
-    with open(label_path, 'rb') as fd:
-        target = np.frombuffer(fd.read(), dtype=np.uint8, offset=8)
-    dataset_path = interim_data_path / dataset_name / f"{kind}-images-idx3-ubyte"
-    with open(dataset_path, 'rb') as fd:
-        data = np.frombuffer(fd.read(), dtype=np.uint8,
-                                       offset=16).reshape(len(target), 784)
+    if kind not in ['train', 'test', 'all']:
+        raise Exception(f"Unknown kind: {kind}")
+    parts = {'train': ['train'], 'test': ['t10k'],
+             'all': ['train', 't10k']}[kind]
+
+    if len(parts) == 1:
+        target = read_idx(_mnist_file(dataset_name, parts[0], 'labels'))
+        images = read_idx(_mnist_file(dataset_name, parts[0], 'images'))
+        data = images.reshape(images.shape[0], -1)
+    else:
+        headers = [read_idx_header(_mnist_file(dataset_name, part, 'images'))
+                   for part in parts]
+        n_rows = [shape[0] for _, shape, _ in headers]
+        n_pixels = int(np.prod(headers[0][1][1:]))
+        data = np.empty((sum(n_rows), n_pixels), dtype=np.uint8)
+        target = np.empty(sum(n_rows), dtype=np.uint8)
+        start = 0
+        for part, n in zip(parts, n_rows):
+            read_idx(_mnist_file(dataset_name, part, 'images'),
+                     out=data[start:start + n])
+            read_idx(_mnist_file(dataset_name, part, 'labels'),
+                     out=target[start:start + n])
+            start += n
+
     dset_opts = {
         'dataset_name': dataset_name,
         'data': data,
@@ -124,24 +229,23 @@ def process_orl_faces(dataset_name='orl-faces', metadata=None):
 
         Consists of 92x112, 8-bit greyscale images of 40 total subjects
     """
+    import cv2
+
     extract_dir = interim_data_path / dataset_name
 
     if metadata is None:
         metadata = {}
-    filename = []
+    file_list = []
     target = []
-    feature_vectors = []
-    for subject_dir in extract_dir.iterdir():
+    for subject_dir in sorted(extract_dir.iterdir()):
         if subject_dir.is_dir():
             subject = subject_dir.name[1:]
-            for file in subject_dir.iterdir():
-                filename.append(file.name)
+            for file in sorted(subject_dir.iterdir()):
+                file_list.append(file)
                 target.append(subject)
-                im = cv2.imread(str(file), cv2.COLORSPACE_GRAY)
-                feature_vectors.append(im.flatten())
     target = np.array(target)
-    data = np.vstack(feature_vectors)
-    metadata['filename'] = np.array(filename)
+    data = _load_image_files(file_list, flags=cv2.IMREAD_GRAYSCALE)
+    metadata['filename'] = np.array([file.name for file in file_list])
 
     dset_opts = {
         'dataset_name': dataset_name,
@@ -151,27 +255,60 @@ def process_orl_faces(dataset_name='orl-faces', metadata=None):
     }
     return dset_opts
 
-def process_hiva(dataset_name='hiva', kind='train', metadata=None):
+
+def _read_hiva_part(hiva_dir, kind, dtype=np.int8, sparse=False):
+    data = read_numeric_matrix(hiva_dir / f'hiva_{kind}.data', dtype=dtype,
+                               sparse=sparse)
+    if kind == 'train':
+        labels = read_numeric_matrix(hiva_dir / f'hiva_{kind}.labels',
+                                     dtype=np.int8)[:, 0]
+    else:
+        labels = np.zeros(data.shape[0], dtype=np.int8)
+    return data, labels
+
+
+def process_hiva(dataset_name='hiva', kind='train', metadata=None,
+                 dtype='int8', sparse=False, n_jobs=None):
     """Load the HIVA dataset
 
-    kind: {'train', 'test', 'valid'}
+    kind: {'train', 'test', 'valid', 'all'}
         if 'test' or 'valid', empty labels will be generated.
-        Labels are generated only if 'train' is specified
+        Labels are generated only if 'train' is specified.
+        'all' is the train, valid and test data (in that order), which
+        are parsed in parallel
+    dtype: dtype
+        dtype of the (binary) features
+    sparse: boolean
+        If True, `data` is a scipy.sparse CSR matrix
+    n_jobs: int or None
+        Number of processes used to parse the files when `kind` is 'all'
+        (default: one per file)
     """
-    if kind not in ['train', 'test', 'valid']:
+    if kind not in ['train', 'test', 'valid', 'all']:
         raise Exception(f"Unknown kind: {kind}")
 
     hiva_dir = interim_data_path / dataset_name / 'HIVA'
 
-    data = np.genfromtxt(hiva_dir / f'hiva_{kind}.data')
-
-    if kind == 'train':
-        labels = np.genfromtxt(hiva_dir / f'hiva_{kind}.labels')
+    if kind == 'all':
+        from joblib import Parallel, delayed
+        parts = ['train', 'valid', 'test']
+        results = Parallel(n_jobs=n_jobs or len(parts))(
+            delayed(_read_hiva_part)(hiva_dir, part, dtype=dtype,
+                                     sparse=sparse)
+            for part in parts)
+        if sparse:
+            import scipy.sparse
+            data = scipy.sparse.vstack([r[0] for r in results], format='csr')
+        else:
+            data = np.concatenate([r[0] for r in results])
+        target = np.concatenate([r[1] for r in results])
+        if metadata is None:
+            metadata = {}
+        metadata['split_sizes'] = {part: r[1].shape[0]
+                                   for part, r in zip(parts, results)}
     else:
-        labels = np.zeros(data.shape[0])
-
-    data = data
-    target = labels
+        data, target = _read_hiva_part(hiva_dir, kind, dtype=dtype,
+                                       sparse=sparse)
 
     dset_opts = {
         'dataset_name': dataset_name,
@@ -188,6 +325,7 @@ def process_frey_faces(dataset_name='frey-faces', filename='frey_rawface.mat', m
     Note, there are no labels associated with this dataset; i.e.
     `target` is a vector of all zeros
     '''
+    from scipy.io import loadmat
 
     frey_file = interim_data_path / dataset_name / filename
 
@@ -243,12 +381,19 @@ def process_lvq_pak(dataset_name='lvq-pak', kind='all', numeric_labels=True, met
     }
     return dset_opts
 
-def process_shuttle_statlog(dataset_name='shuttle-statlog', kind='train', metadata=None):
+
+def process_shuttle_statlog(dataset_name='shuttle-statlog', kind='train',
+                            numeric_labels=False, metadata=None):
     """Load the shuttle dataset
 
     This is a 9-dimensional dataset with class labels split into training and test sets
 
     kind: {'train', 'test'}
+    numeric_labels: boolean (default: False)
+        if set, target is a vector of integers, and label_map is created in
+        the metadata to reflect the mapping to the string targets. The
+        mapping is built from the labels present in `kind`, so may differ
+        between splits
     """
     filename_map = {
         'train': f'shuttle.trn',
@@ -259,6 +404,11 @@ def process_shuttle_statlog(dataset_name='shuttle-statlog', kind='train', metada
 
     data, target = read_space_delimited(extract_dir / filename_map[kind])
 
+    if numeric_labels:
+        if metadata is None:
+            metadata = {}
+        target, metadata['label_map'] = normalize_labels(target)
+
     dset_opts = {
         'dataset_name': dataset_name,
         'data': data,
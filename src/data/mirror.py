@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+import click
+import os
+import pathlib
+import shutil
+import stat
+import threading
+import time
+
+from ..logging import logger
+
+__all__ = [
+    'RawMirror',
+    'get_raw_mirror',
+    'set_raw_mirror',
+]
+
+# Environment variables configuring the default mirror (see `get_raw_mirror`)
+_MIRROR_ENV = 'RAW_DATA_MIRROR'
+_MIRROR_MAX_BYTES_ENV = 'RAW_DATA_MIRROR_MAX_BYTES'
+
+# Linux ioctl for a copy-on-write clone of a file (cp --reflink)
+_FICLONE = 0x40049409
+
+_UNSET = object()
+_RAW_MIRROR = _UNSET
+
+
+def _reflink(src, dst):
+    import fcntl
+    with open(src, 'rb') as f_src, open(dst, 'wb') as f_dst:
+        fcntl.ioctl(f_dst.fileno(), _FICLONE, f_src.fileno())
+
+
+def _place(src, dst):
+    """Atomically make `dst` a copy of `src`, as cheaply as possible
+
+    Tries, in order: a hardlink, a reflink (copy-on-write clone) and a
+    plain copy.
+
+    Returns
+    -------
+    string: how the file was placed ('hardlink', 'reflink' or 'copy')
+    """
+    dst = pathlib.Path(dst)
+    tmp_name = dst.with_name(
+        f'.{dst.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    try:
+        try:
+            os.link(src, tmp_name)
+            method = 'hardlink'
+        except OSError:
+            try:
+                _reflink(src, tmp_name)
+                method = 'reflink'
+            except (OSError, ImportError):
+                shutil.copyfile(src, tmp_name)
+                method = 'copy'
+        os.replace(tmp_name, dst)
+    except BaseException:
+        if os.path.lexists(tmp_name):
+            os.unlink(tmp_name)
+        raise
+    return method
+
+
+def _used_marker(path):
+    """Hidden file beside a mirror entry, touched when the entry is used by
+    someone who doesn't own it"""
+    path = pathlib.Path(path)
+    return path.with_name(f'.{path.name}.used')
+
+
+def _mark_used(path):
+    """Record an access to a mirror entry
+
+    A no-op chmod updates the inode change time (ctime) without touching
+    the contents or mtime, which hardlinked copies (and their entries in
+    the hash index) depend on. Creating a hardlink also updates ctime.
+
+    Only the owner of a file may chmod it, so other users of a shared
+    mirror touch a marker file (see `_used_marker`) instead. Failing to
+    record an access only affects the eviction order, so is not an error.
+    """
+    try:
+        os.chmod(path, stat.S_IMODE(os.stat(path).st_mode))
+        return
+    except OSError:
+        pass
+    marker = _used_marker(path)
+    try:
+        with open(marker, 'a'):
+            pass
+        os.utime(marker)
+    except OSError as err:
+        logger.debug(f"Could not record use of mirrored {path}: {err}")
+
+
+def _last_used(path, stat_result):
+    """Time (in ns) of the latest recorded access to a mirror entry"""
+    try:
+        marked = os.stat(_used_marker(path)).st_mtime_ns
+    except OSError:
+        marked = 0
+    return max(stat_result.st_ctime_ns, marked)
+
+
+class RawMirror:
+    def __init__(self, mirror_dir, max_bytes=None):
+        """
+        Content-addressed store of raw data files, shareable between
+        checkouts (and users) on the same machine.
+
+        Files are stored as `{mirror_dir}/{hash_type}/{hash_value}`, so the
+        same download is only ever stored once, whatever it is called.
+        `fetch_file` consults the mirror before going to the network, and
+        adds verified downloads to it.
+
+        Files are placed into (and out of) the mirror by hardlink where
+        possible, then by reflink, and only then by copying. The least
+        recently used entries are evicted once the mirror grows beyond
+        `max_bytes`.
+
+        mirror_dir: path
+            Directory holding the mirror
+        max_bytes: int or None
+            Size limit for the mirror. If None, the mirror is unbounded
+
+        >>> import tempfile
+        >>> tmp_dir = pathlib.Path(tempfile.mkdtemp())
+        >>> _ = (tmp_dir / 'data.txt').write_text('hello')
+        >>> mirror = RawMirror(tmp_dir / 'mirror')
+        >>> mirror.put('sha1', 'aaf4c6', tmp_dir / 'data.txt')
+        >>> mirror.get('sha1', 'aaf4c6', tmp_dir / 'copy.txt')
+        True
+        >>> (tmp_dir / 'copy.txt').read_text()
+        'hello'
+        >>> mirror.get('sha1', 'f00d', tmp_dir / 'other.txt')
+        False
+        """
+        self.mirror_dir = pathlib.Path(mirror_dir)
+        self.max_bytes = max_bytes
+
+    def path(self, hash_type, hash_value):
+        """Location of the entry keyed by `hash_type:hash_value`"""
+        return self.mirror_dir / hash_type / hash_value
+
+    def __contains__(self, key):
+        hash_type, hash_value = key.split(':', 1)
+        return self.path(hash_type, hash_value).exists()
+
+    def _entries(self):
+        if not self.mirror_dir.exists():
+            return []
+        entries = []
+        for type_dir in os.scandir(self.mirror_dir):
+            if not type_dir.is_dir():
+                continue
+            entries += [e for e in os.scandir(type_dir.path)
+                        if e.is_file() and not e.name.startswith('.')]
+        return entries
+
+    def __len__(self):
+        return len(self._entries())
+
+    @property
+    def size(self):
+        """Total size (in bytes) of the mirrored files"""
+        return sum(e.stat().st_size for e in self._entries())
+
+    def get(self, hash_type, hash_value, dst_file):
+        """Place the file with the given hash at `dst_file`
+
+        Returns
+        -------
+        True if the mirror held the file, False otherwise
+        """
+        path = self.path(hash_type, hash_value)
+        try:
+            method = _place(path, dst_file)
+        except FileNotFoundError:
+            return False
+        _mark_used(path)
+        logger.debug(f"Retrieved {pathlib.Path(dst_file).name} from raw "
+                     f"mirror ({hash_type}:{hash_value}, {method})")
+        return True
+
+    def remove(self, hash_type, hash_value):
+        """Delete an entry (e.g. one found to be corrupt) from the mirror"""
+        path = self.path(hash_type, hash_value)
+        for file_path in [path, _used_marker(path)]:
+            try:
+                os.unlink(file_path)
+            except FileNotFoundError:
+                pass
+
+    def put(self, hash_type, hash_value, src_file):
+        """Atomically add `src_file` (whose hash must already have been
+        checked) to the mirror, then enforce the size limit
+        """
+        path = self.path(hash_type, hash_value)
+        if path.exists():
+            _mark_used(path)
+            return
+        os.makedirs(path.parent, exist_ok=True)
+        method = _place(src_file, path)
+        logger.debug(f"Added {pathlib.Path(src_file).name} to raw mirror "
+                     f"({hash_type}:{hash_value}, {method})")
+        self.prune()
+
+    def prune(self, max_bytes=None):
+        """Remove least recently used entries until the mirror fits in
+        `max_bytes` (default: the mirror's own limit)
+
+        Returns
+        -------
+        list of evicted entries, as `hash_type:hash_value` keys
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        if max_bytes is None:
+            return []
+        entries = []
+        for entry in self._entries():
+            try:
+                stat_result = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((_last_used(entry.path, stat_result),
+                            stat_result.st_size, pathlib.Path(entry.path)))
+        total = sum(e[1] for e in entries)
+        evicted = []
+        for _, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            self.remove(path.parent.name, path.name)
+            total -= size
+            evicted.append(f'{path.parent.name}:{path.name}')
+            logger.debug(f"Evicted {evicted[-1]} from raw mirror")
+        return evicted
+
+
+def set_raw_mirror(mirror):
+    """Set the mirror consulted by `fetch_file`
+
+    mirror: RawMirror or None
+        If None, no mirror is used
+    """
+    global _RAW_MIRROR
+    _RAW_MIRROR = mirror
+
+
+def get_raw_mirror():
+    """Return the mirror in use, or None if there isn't one
+
+    Unless set with `set_raw_mirror`, the mirror is configured by the
+    `RAW_DATA_MIRROR` environment variable (e.g. in `.env`), with an
+    optional size limit in `RAW_DATA_MIRROR_MAX_BYTES`.
+    """
+    global _RAW_MIRROR
+    if _RAW_MIRROR is _UNSET:
+        mirror_dir = os.environ.get(_MIRROR_ENV)
+        if mirror_dir:
+            _RAW_MIRROR = RawMirror(mirror_dir, max_bytes=_env_max_bytes())
+        else:
+            _RAW_MIRROR = None
+    return _RAW_MIRROR
+
+
+def _env_max_bytes():
+    max_bytes = os.environ.get(_MIRROR_MAX_BYTES_ENV)
+    return int(max_bytes) if max_bytes else None
+
+
+@click.command()
+@click.argument('action', type=click.Choice(['info', 'prune']))
+@click.option('--max-bytes', '-m', type=int, default=None,
+              help='Byte budget to prune to')
+@click.option('--mirror-dir', type=click.Path(), default=None)
+def main(action, max_bytes=None, mirror_dir=None):
+    """Inspect and prune the shared raw data mirror
+
+    action: {'info', 'prune'}
+
+    info: list mirrored files, least recently used first
+    prune: evict least recently used files until the mirror fits in
+        `--max-bytes` (or RAW_DATA_MIRROR_MAX_BYTES)
+
+    The mirror is `--mirror-dir`, or RAW_DATA_MIRROR if not given.
+    """
+    if mirror_dir is not None:
+        mirror = RawMirror(mirror_dir, max_bytes=_env_max_bytes())
+    else:
+        mirror = get_raw_mirror()
+    if mirror is None:
+        raise click.UsageError(
+            f"No mirror given, and {_MIRROR_ENV} is not set")
+
+    if action == 'info':
+        entries = sorted(mirror._entries(),
+                         key=lambda e: _last_used(e.path, e.stat()))
+        for entry in entries:
+            stat_result = entry.stat()
+            last_used = _last_used(entry.path, stat_result) / 1e9
+            last_access = time.strftime('%Y-%m-%d %H:%M',
+                                        time.localtime(last_used))
+            key = f'{pathlib.Path(entry.path).parent.name}:{entry.name}'
+            click.echo(f"{key}  {stat_result.st_size:>12}  {last_access}")
+        click.echo(f"{len(entries)} files, {mirror.size} bytes "
+                   f"(budget: {mirror.max_bytes})")
+    elif action == 'prune':
+        evicted = mirror.prune(max_bytes=max_bytes)
+        logger.info(f"Evicted {len(evicted)} files")
+
+
+if __name__ == '__main__':
+    from dotenv import find_dotenv, load_dotenv
+    load_dotenv(find_dotenv())
+    main()
@@ -1,12 +1,41 @@
-from  itertools import product
+import os
+import pathlib
+
 import numpy as np
+from scipy.special import gammaln
 from sklearn.utils import check_random_state
 
-__all__ = ['synthetic_data', 'sample_sphere_surface', 'sample_ball', 'helix']
+from ..paths import processed_data_path
+
+__all__ = [
+    'helix',
+    'sample_ball',
+    'sample_sphere_surface',
+    'synthetic_blocks',
+    'synthetic_data',
+    'write_synthetic_dataset',
+]
+
+# Largest number of candidate points drawn at once by `sample_ball`
+_MAX_BATCH_POINTS = 2**20
+
 
 def _combn(iterable, repeat):
-    """Equivalent of matlab's combn"""
-    return list(product(iterable, repeat=repeat))
+    """Equivalent of matlab's combn
+
+    Returns an array with one row per element of the cartesian product, in
+    the same order as `itertools.product(iterable, repeat=repeat)`
+
+    >>> _combn([0, 1], 2)
+    array([[0, 0],
+           [0, 1],
+           [1, 0],
+           [1, 1]])
+    """
+    values = np.asarray(iterable)
+    grids = np.meshgrid(*([values] * repeat), indexing='ij')
+    return np.stack(grids, axis=-1).reshape(-1, repeat)
+
 
 def _parameterized_swiss_roll(manifold_coords):
     """Given parameters t, y return a swiss roll
@@ -190,17 +219,17 @@ def synthetic_data(n_points=1000, noise=0.05,
         n_dims = kwargs.pop("n_dims", 5)
         points_per_dim = int(np.round(float(n_points ** (1.0 / n_dims))))
         l = np.linspace(0, 1, num=points_per_dim)
-        t = np.array(list(_combn(l, n_dims)))
-        X = np.vstack((np.cos(t[:,0]),
-                       np.tanh(3 * t[:,1]),
-                       t[:,0] + t[:,2],
-                       t[:,3] * np.sin(t[:,1]),
-                       np.sin(t[:,0] + t[:,4]),
-                       t[:,4] * np.cos(t[:,1]),
-                       t[:,4] + t[:,3],
-                       t[:,1],
-                       t[:,2] * t[:,3],
-                       t[:,0])).T
+        t = _combn(l, n_dims)
+        X = np.column_stack((np.cos(t[:, 0]),
+                             np.tanh(3 * t[:, 1]),
+                             t[:, 0] + t[:, 2],
+                             t[:, 3] * np.sin(t[:, 1]),
+                             np.sin(t[:, 0] + t[:, 4]),
+                             t[:, 4] * np.cos(t[:, 1]),
+                             t[:, 4] + t[:, 3],
+                             t[:, 1],
+                             t[:, 2] * t[:, 3],
+                             t[:, 0]))
         tt = 1 + np.round(t)
         # Generate labels for dataset (2x2x2x2x2 checkerboard pattern)
         labels = np.remainder(tt.sum(axis=1), 2)
@@ -240,21 +269,34 @@ def sample_sphere_surface(n_points, n_dim=3, random_state=0, noise=None):
 
     return X, color, metadata
 
+
+def _unit_ball_fraction(n_dim):
+    '''Fraction of the cube [-1, 1]^n_dim occupied by the unit ball'''
+    log_volume = (n_dim / 2.) * np.log(np.pi) - gammaln(n_dim / 2. + 1)
+    return np.exp(log_volume - n_dim * np.log(2.))
+
+
 def sample_ball(n_points, n_dim=3, random_state=0):
     '''Sample from a unit ball
 
-    Use rejection sampling on the unit cube
+    Use rejection sampling on the unit cube. Candidates are drawn in
+    batches, oversampled by the ratio of the cube and ball volumes.
     '''
-    np.random.seed(random_state)
-    points = []
-    labels = []
-    while len(points) < n_points:
-        pt = np.random.uniform(-1.0, 1.0, n_dim)
-        if np.linalg.norm(pt) < 1.0:
-            points.append(pt)
-            labels.append(np.linalg.norm(pt))
-    X = np.array(points)
-    t = np.array(labels)
+    generator = check_random_state(random_state)
+    acceptance = _unit_ball_fraction(n_dim)
+    X = np.empty((n_points, n_dim))
+    t = np.empty(n_points)
+    n_found = 0
+    while n_found < n_points:
+        n_needed = n_points - n_found
+        batch_size = int(np.ceil(1.1 * n_needed / acceptance)) + 16
+        batch_size = min(batch_size, max(_MAX_BATCH_POINTS // n_dim, 1))
+        candidates = generator.uniform(-1.0, 1.0, (batch_size, n_dim))
+        norms = np.linalg.norm(candidates, axis=1)
+        inside = np.flatnonzero(norms < 1.0)[:n_needed]
+        X[n_found:n_found + len(inside)] = candidates[inside]
+        t[n_found:n_found + len(inside)] = norms[inside]
+        n_found += len(inside)
     metadata = {
         "n_points": n_points,
         "n_dim": n_dim,
@@ -336,3 +378,230 @@ def helix(n_points=1000, random_state=None, noise=0.05,
         metadata['manifold_coords'] = labels
         labels = checkerboard(labels, scale_factors=2*np.pi, n_classes=n_classes, n_occur=n_occur)
     return X, labels, metadata
+
+
+# Default number of points generated per block by `synthetic_blocks`
+_BLOCK_POINTS = 2**18
+
+# `synthetic_data` kinds whose points are not generated independently
+# (e.g. they form a grid over the whole dataset), so can't be split into
+# blocks
+_UNBLOCKABLE_KINDS = {'difficult'}
+
+
+def _check_blockable(func, kwargs):
+    """Raise a ValueError if `func` (with `kwargs`) can't be generated in
+    blocks
+    """
+    kind = kwargs.get('kind', getattr(func, 'keywords', {}).get('kind', None))
+    if kind in _UNBLOCKABLE_KINDS:
+        raise ValueError(f"kind={kind!r} can't be generated in blocks: its "
+                         "points form a single grid over the whole dataset. "
+                         "Use synthetic_data instead")
+
+
+def _block_seeds(n_blocks, random_state):
+    """Independent integer seeds for each of `n_blocks` blocks
+
+    Derived from `random_state` (an int) with a SeedSequence, so a block's
+    seed depends only on `random_state` and the block number.
+    """
+    seed_seq = np.random.SeedSequence(random_state)
+    return [int(child.generate_state(1)[0])
+            for child in seed_seq.spawn(n_blocks)]
+
+
+def _block_bounds(n_points, block_size):
+    return [(start, min(start + block_size, n_points))
+            for start in range(0, n_points, block_size)]
+
+
+def _generate_block(func, n_points, seed, **kwargs):
+    """Generate one block of points from a generator such as `synthetic_data`
+
+    Returns
+    -------
+    (X, labels, manifold_coords, metadata); manifold_coords is None if not
+    generated
+    """
+    X, labels, metadata = func(n_points=n_points, random_state=seed, **kwargs)
+    manifold_coords = metadata.get('manifold_coords', None)
+    if manifold_coords is not None:
+        manifold_coords = np.asarray(manifold_coords)
+        if manifold_coords.shape[0] != n_points:
+            manifold_coords = None
+    return X, labels, manifold_coords, metadata
+
+
+def synthetic_blocks(func, n_points, block_size=_BLOCK_POINTS, random_state=0,
+                     **kwargs):
+    """Generate a synthetic dataset as a sequence of independent blocks
+
+    Each block is produced by calling `func` (e.g. `synthetic_data`,
+    `helix` or `sample_sphere_surface`) with its own seed, derived from
+    `random_state` and the block number. The output depends only on
+    `n_points`, `block_size` and `random_state`, no matter how (or where)
+    the blocks are generated. Generators that are not independent across
+    points (e.g. the grid used by `synthetic_data(kind='difficult')`)
+    are rejected with a ValueError.
+
+    func: function
+        Generator taking `n_points` and `random_state`, and returning
+        (X, labels, metadata)
+    n_points: int
+        Total number of points
+    block_size: int
+        Number of points per block (the last block may be smaller)
+    random_state: int
+        Seed from which the block seeds are derived
+    kwargs:
+        Passed to `func`
+
+    Returns
+    -------
+    iterator of (start, X, labels, manifold_coords), one per block, where
+    `start` is the index of the block's first point
+
+    >>> blocks = list(synthetic_blocks(helix, 10, block_size=4))
+    >>> [(start, X.shape) for start, X, _, _ in blocks]
+    [(0, (4, 3)), (4, (4, 3)), (8, (2, 3))]
+    """
+    _check_blockable(func, kwargs)
+    bounds = _block_bounds(n_points, block_size)
+    seeds = _block_seeds(len(bounds), random_state)
+
+    def blocks():
+        for (start, stop), seed in zip(bounds, seeds):
+            X, labels, manifold_coords, _ = _generate_block(func, stop - start,
+                                                            seed, **kwargs)
+            yield start, X, labels, manifold_coords
+    return blocks()
+
+
+def _write_block(func, start, stop, seed, array_files, kwargs):
+    """Generate a block, and write it into the memory-mapped output files"""
+    outputs = _generate_block(func, stop - start, seed, **kwargs)[:3]
+    for values, array_file in zip(outputs, array_files):
+        if array_file is None:
+            continue
+        out = np.load(array_file, mmap_mode='r+')
+        out[start:stop] = values
+        out.flush()
+        del out
+
+
+def _create_output_files(sample, array_files, n_points):
+    """Create a temporary `.npy` file, with room for `n_points`, for each
+    array of `sample` that is not None
+    """
+    tmp_files = []
+    for values, array_file in zip(sample, array_files):
+        if values is None:
+            tmp_files.append(None)
+            continue
+        tmp_file = array_file.with_name(f'.{array_file.name}.'
+                                        f'{os.getpid()}.tmp')
+        out = np.lib.format.open_memmap(tmp_file, mode='w+',
+                                        dtype=values.dtype,
+                                        shape=(n_points, *values.shape[1:]))
+        del out
+        tmp_files.append(tmp_file)
+    return tmp_files
+
+
+def _install_output_file(tmp_file, array_file):
+    """Move a completed output file into place, and map it"""
+    os.replace(tmp_file, array_file)
+    return np.load(array_file, mmap_mode='r+')
+
+
+def write_synthetic_dataset(dataset_name, func, n_points,
+                            block_size=_BLOCK_POINTS, random_state=0,
+                            n_jobs=None, data_path=None, file_base=None,
+                            **kwargs):
+    """Generate a (potentially very large) synthetic dataset straight to disk
+
+    Blocks (see `synthetic_blocks`) are generated in parallel worker
+    processes, and written directly into memory-mapped `.npy` files laid
+    out as by `Dataset.dump(storage='npy')`: the points are `data`, the
+    labels are `target`, and the manifold coordinates (if the generator
+    produces them) are `metadata['manifold_coords']`. The whole dataset
+    never needs to fit in memory, and the result is identical for any
+    number of workers.
+
+    dataset_name: string
+        Name of the generated dataset
+    func: function
+        Generator taking `n_points` and `random_state`, and returning
+        (X, labels, metadata), e.g. `synthetic_data` (with a `kind`) or `helix`
+    n_points: int
+        Total number of points
+    block_size: int
+        Number of points generated at once
+    random_state: int
+        Seed from which the block seeds are derived
+    n_jobs: int or None
+        Number of worker processes (default: one per CPU)
+    data_path: path (default: `processed_data_path`)
+        Directory where the dataset is written
+    file_base: string
+        Filename stem. By default, the dataset name
+    kwargs:
+        Passed to `func`. Generators that can't be split into blocks
+        (see `synthetic_blocks`) raise a ValueError
+
+    Returns
+    -------
+    The generated `Dataset`, with its arrays memory-mapped (read-only)
+    """
+    from joblib import Parallel, delayed
+    from .dset import Dataset, _LAZY_METADATA_BYTES
+
+    _check_blockable(func, kwargs)
+    if data_path is None:
+        data_path = processed_data_path
+    data_path = pathlib.Path(data_path)
+    if file_base is None:
+        file_base = dataset_name
+    os.makedirs(data_path, exist_ok=True)
+
+    # a small sample fixes the shapes and dtypes of the outputs
+    *sample, sample_metadata = _generate_block(func, 2, random_state, **kwargs)
+    array_files = [data_path / f'{file_base}.{key}.npy'
+                   for key in ['data', 'target', 'metadata.manifold_coords']]
+    tmp_files = _create_output_files(sample, array_files, n_points)
+
+    try:
+        bounds = _block_bounds(n_points, block_size)
+        seeds = _block_seeds(len(bounds), random_state)
+        Parallel(n_jobs=n_jobs or -1)(
+            delayed(_write_block)(func, start, stop, seed, tmp_files, kwargs)
+            for (start, stop), seed in zip(bounds, seeds))
+        arrays = [None if tmp_file is None else
+                  _install_output_file(tmp_file, array_file)
+                  for tmp_file, array_file in zip(tmp_files, array_files)]
+    except BaseException:
+        for tmp_file in tmp_files:
+            if tmp_file is not None and tmp_file.exists():
+                os.unlink(tmp_file)
+        raise
+
+    data, target, manifold_coords = arrays
+    metadata = {k: v for k, v in sample_metadata.items()
+                if k != 'manifold_coords'}
+    metadata.update({
+        'n_points': n_points,
+        'block_size': block_size,
+        'random_state': random_state,
+    })
+    if manifold_coords is not None:
+        if manifold_coords.nbytes < _LAZY_METADATA_BYTES:
+            # small enough to be stored with the rest of the metadata
+            manifold_coords = np.array(manifold_coords)
+            os.unlink(array_files[2])
+        metadata['manifold_coords'] = manifold_coords
+
+    dset = Dataset(dataset_name=dataset_name, data=data, target=target,
+                   metadata=metadata)
+    dset.dump(file_base=file_base, data_path=data_path)
+    return Dataset.load(file_base, data_path=data_path, mmap_mode='r')
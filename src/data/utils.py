@@ -1,8 +1,9 @@
+import gzip
+import hashlib
 import logging
 import os
 import pathlib
 import sys
-import pandas as pd
 import numpy as np
 from functools import partial
 from joblib import func_inspect as jfi
@@ -11,16 +12,70 @@ from ..paths import interim_data_path
 from ..logging import logger
 
 __all__ = [
+    'hash_array',
     'head_file',
     'list_dir',
+    'nested_subsample_order',
     'normalize_labels',
     'partial_call_signature',
+    'read_idx',
+    'read_idx_header',
+    'read_numeric_matrix',
     'read_space_delimited',
 ]
 
+# IDX type codes, and the (big-endian) dtypes they map to
+_IDX_DTYPES = {
+    0x08: np.dtype('u1'),
+    0x09: np.dtype('i1'),
+    0x0B: np.dtype('>i2'),
+    0x0C: np.dtype('>i4'),
+    0x0D: np.dtype('>f4'),
+    0x0E: np.dtype('>f8'),
+}
+
+# Arrays are fed to the hash function in pieces of (at most) this many bytes
+_HASH_BLOCK_BYTES = 2**24
+
 _MODULE = sys.modules[__name__]
 _MODULE_DIR = pathlib.Path(os.path.dirname(os.path.abspath(__file__)))
 
+
+def hash_array(value, hash_type='sha1'):
+    """Hex digest of an array (or any other picklable object)
+
+    Numeric arrays (including memory-mapped ones) are hashed straight from
+    their memory, together with their dtype and shape, without pickling or
+    copying. Anything else is hashed with joblib's hasher.
+
+    hash_type: string
+        Any algorithm supported by `hashlib` (e.g. 'blake2b', 'sha1', 'md5')
+
+    >>> a = np.arange(12).reshape(3, 4)
+    >>> hash_array(a[:, :2]) == hash_array(a[:, :2].copy())
+    True
+    >>> hash_array(a) == hash_array(a.reshape(4, 3))
+    False
+    """
+    if not isinstance(value, np.ndarray) or value.dtype.hasobject:
+        from joblib.hashing import NumpyHasher
+        return NumpyHasher(hash_name=hash_type).hash(value)
+
+    hasher = hashlib.new(hash_type)
+    hasher.update(f'{value.dtype.str}{value.shape}'.encode())
+    if value.flags.c_contiguous:
+        buffer = value.reshape(-1).view(np.uint8)
+        for start in range(0, buffer.shape[0], _HASH_BLOCK_BYTES):
+            hasher.update(buffer[start:start + _HASH_BLOCK_BYTES])
+    else:
+        row_bytes = max(value[:1].nbytes, 1)
+        block_rows = max(_HASH_BLOCK_BYTES // row_bytes, 1)
+        for start in range(0, value.shape[0], block_rows):
+            block = np.ascontiguousarray(value[start:start + block_rows])
+            hasher.update(block.reshape(-1).view(np.uint8))
+    return hasher.hexdigest()
+
+
 def head_file(filename, n=5):
     """Return the first `n` lines of a file
     """
@@ -49,26 +104,285 @@ def list_dir(path, fully_qualified=False, glob_pattern='*'):
 
     return [file.name for file in pathlib.Path(path).glob(glob_pattern)]
 
-def read_space_delimited(filename, skiprows=None, class_labels=True):
-    """Read an space-delimited file
+
+def _iter_line_chunks(filename, skiprows=None, chunk_rows=1024):
+    """Yield lists of (at most `chunk_rows`) non-blank lines from a file"""
+    skip = set(skiprows or [])
+    with open(filename, 'rb') as fd:
+        chunk = []
+        for i, line in enumerate(fd):
+            if i in skip or not line.strip():
+                continue
+            chunk.append(line)
+            if len(chunk) == chunk_rows:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def _parse_numeric_lines(lines, dtype, filename):
+    """Parse whitespace-delimited lines into a 2d array of `dtype`"""
+    n_cols = len(lines[0].split())
+    values = np.fromstring(b' '.join(lines), dtype=dtype, sep=' ')
+    if values.size != len(lines) * n_cols:
+        raise Exception(f"{filename}: could not parse a {len(lines)}x{n_cols} "
+                        f"block of {np.dtype(dtype)} values")
+    return values.reshape(len(lines), n_cols)
+
+
+def _compact_dtype(values):
+    """Smallest dtype that holds every value of a float array exactly
+
+    >>> _compact_dtype(np.array([0., 1., 1.]))
+    dtype('bool')
+    >>> _compact_dtype(np.array([-1., 1., 100.]))
+    dtype('int8')
+    >>> _compact_dtype(np.array([0.5, 1000.]))
+    dtype('float32')
+    >>> _compact_dtype(np.array([0.1, 1.]))
+    dtype('float64')
+    """
+    if values.size == 0:
+        return np.dtype(bool)
+    if not np.all(np.isfinite(values)) or np.any(values != np.round(values)):
+        if np.array_equal(values.astype(np.float32), values, equal_nan=True):
+            return np.dtype(np.float32)
+        return np.dtype(np.float64)
+    low, high = values.min(), values.max()
+    if low >= 0 and high <= 1:
+        return np.dtype(bool)
+    for int_type in (np.int8, np.int16, np.int32):
+        info = np.iinfo(int_type)
+        if info.min <= low and high <= info.max:
+            return np.dtype(int_type)
+    return np.dtype(np.int64)
+
+
+def read_numeric_matrix(filename, dtype=None, sparse=False, skiprows=None,
+                        chunk_rows=1024):
+    """Read a whitespace-delimited numeric matrix from a text file
+
+    The file is parsed `chunk_rows` lines at a time, and each chunk is
+    stored in a compact dtype (or as a sparse matrix) before the next one
+    is read, so memory use stays close to the size of the result.
+
+    dtype: dtype or None
+        dtype of the result. If None, the smallest dtype holding every
+        value exactly is used (bool, int8, ..., float32, float64).
+        Parsing is fastest when the dtype is given
+    sparse: boolean
+        If True, return a `scipy.sparse` CSR matrix
+    skiprows: list of int or None
+        Line numbers (from 0) to skip. Blank lines are always skipped
+    chunk_rows: int
+        Number of lines to parse at a time
+
+    Returns
+    -------
+    2d np.array, or scipy.sparse.csr_matrix
+
+    >>> import tempfile
+    >>> matrix_file = pathlib.Path(tempfile.mkdtemp()) / 'matrix.txt'
+    >>> _ = matrix_file.write_text('0 1 0 \\n1 1 0 \\n\\n-1 0 0 \\n')
+    >>> read_numeric_matrix(matrix_file, chunk_rows=2)
+    array([[ 0,  1,  0],
+           [ 1,  1,  0],
+           [-1,  0,  0]], dtype=int8)
+    >>> read_numeric_matrix(matrix_file, dtype=np.int8, sparse=True).nnz
+    4
+    """
+    if sparse:
+        import scipy.sparse
+    chunks = []
+    result_dtype = None if dtype is None else np.dtype(dtype)
+    for lines in _iter_line_chunks(filename, skiprows=skiprows,
+                                   chunk_rows=chunk_rows):
+        if dtype is None:
+            block = _parse_numeric_lines(lines, np.float64, filename)
+            block = block.astype(_compact_dtype(block))
+            result_dtype = _promote(result_dtype, block.dtype)
+        else:
+            block = _parse_numeric_lines(lines, result_dtype, filename)
+        if chunks and block.shape[1] != chunks[0].shape[1]:
+            raise Exception(f"{filename}: rows have differing numbers "
+                            "of columns")
+        if sparse:
+            block = scipy.sparse.csr_matrix(block)
+        chunks.append(block)
+
+    if result_dtype is None:
+        result_dtype = np.dtype(bool)
+    if sparse:
+        if not chunks:
+            return scipy.sparse.csr_matrix((0, 0), dtype=result_dtype)
+        return scipy.sparse.vstack(chunks, format='csr', dtype=result_dtype)
+    return _stack_chunks(chunks, result_dtype)
+
+
+def _promote(dtype, other):
+    """`np.promote_types`, where a `dtype` of None promotes to `other`"""
+    return other if dtype is None else np.promote_types(dtype, other)
+
+
+def _stack_chunks(chunks, dtype):
+    """Stack 2d array chunks, releasing each one as it is copied"""
+    if not chunks:
+        return np.empty((0, 0), dtype=dtype)
+    result = np.empty((sum(c.shape[0] for c in chunks), chunks[0].shape[1]),
+                      dtype=dtype)
+    start = 0
+    while chunks:
+        block = chunks.pop(0)
+        result[start:start + block.shape[0]] = block
+        start += block.shape[0]
+    return result
+
+
+def read_space_delimited(filename, skiprows=None, class_labels=True,
+                         dtype=np.float64, chunk_rows=1024):
+    """Read a space-delimited file of numeric features
+
+    The file is parsed `chunk_rows` lines at a time, with features going
+    straight into a numeric array.
 
     skiprows: list of rows to skip when reading the file.
 
     Note: we can't use automatic comment detection, as
     `#` characters are also used as data labels.
     class_labels: boolean
-        if true, the last column is treated as the class label
+        if true, the last column is treated as the class label,
+        and returned (as strings) separately from the features
+    dtype: {np.float32, np.float64} or other numeric dtype
+        dtype of the returned features
+
+    Returns
+    -------
+    (data, target)
+
+    >>> import tempfile
+    >>> data_file = pathlib.Path(tempfile.mkdtemp()) / 'data.dat'
+    >>> _ = data_file.write_text('2\\n1.5 2 A\\n-3 4e1 #\\n')
+    >>> data, target = read_space_delimited(data_file, skiprows=[0])
+    >>> data
+    array([[ 1.5,  2. ],
+           [-3. , 40. ]])
+    >>> target
+    array(['A', '#'], dtype='<U1')
     """
-    with open(filename, 'r') as fd:
-        df = pd.read_table(fd, skiprows=skiprows, skip_blank_lines=True, comment=None, header=None, sep=' ', dtype=str)
-        # targets are last column. Data is everything else
+    data_chunks = []
+    target_chunks = []
+    for lines in _iter_line_chunks(filename, skiprows=skiprows,
+                                   chunk_rows=chunk_rows):
         if class_labels is True:
-            target = df.loc[:, df.columns[-1]].values
-            data = df.loc[:, df.columns[:-1]].values
-        else:
-            data = df.values
-            target = np.zeros(data.shape[0])
-        return data, target
+            # targets are last column. Data is everything else
+            split_lines = [line.rsplit(None, 1) for line in lines]
+            lines = [fields[0] for fields in split_lines]
+            target_chunks.append(np.array([fields[-1].decode()
+                                           for fields in split_lines]))
+        data_chunks.append(_parse_numeric_lines(lines, dtype, filename))
+    data = np.concatenate(data_chunks)
+    if class_labels is True:
+        target = np.concatenate(target_chunks)
+    else:
+        target = np.zeros(data.shape[0])
+    return data, target
+
+
+def _open_idx(filename):
+    if str(filename).endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def _parse_idx_header(fd, filename):
+    magic = fd.read(4)
+    if (len(magic) != 4 or magic[:2] != b'\x00\x00'
+            or magic[2] not in _IDX_DTYPES):
+        raise Exception(f"{filename} is not an IDX file")
+    n_dims = magic[3]
+    dims = np.frombuffer(fd.read(4 * n_dims), dtype='>u4')
+    return _IDX_DTYPES[magic[2]], tuple(int(d) for d in dims), 4 + 4 * n_dims
+
+
+def read_idx_header(filename):
+    """Parse the header of an IDX file (e.g. MNIST), which may be gzipped
+
+    Returns
+    -------
+    (dtype, shape, header length in bytes)
+    """
+    with _open_idx(filename) as fd:
+        return _parse_idx_header(fd, filename)
+
+
+def read_idx(filename, mmap_mode='r', out=None, chunk_size=2**20):
+    """Read an IDX file (e.g. MNIST)
+
+    Uncompressed files are returned as an `np.memmap` view of the payload,
+    so nothing is read until it is used. Gzipped (`.gz`) files are
+    decompressed a chunk at a time, straight into the output array.
+
+    mmap_mode: {'r', 'r+', 'c'}
+        Mode used to memory-map uncompressed files
+    out: np.array or None
+        If given, the data is written into this (C-contiguous) array,
+        which must have as many elements as the file. Use this to fill
+        part of a larger array without an intermediate copy
+    chunk_size: int
+        Number of bytes to decompress at a time
+
+    Returns
+    -------
+    np.array (or np.memmap) with the shape given in the IDX header.
+    Multi-byte data is big-endian, as stored in the file.
+
+    >>> import tempfile
+    >>> header = bytes([0, 0, 0x08, 2])
+    >>> header += (2).to_bytes(4, 'big') + (3).to_bytes(4, 'big')
+    >>> idx_file = pathlib.Path(tempfile.mkdtemp()) / 'x-idx2-ubyte'
+    >>> _ = idx_file.write_bytes(header + bytes(range(6)))
+    >>> read_idx(idx_file)
+    memmap([[0, 1, 2],
+            [3, 4, 5]], dtype=uint8)
+    >>> gz_file = pathlib.Path(f'{idx_file}.gz')
+    >>> _ = gz_file.write_bytes(gzip.compress(header + bytes(range(6))))
+    >>> read_idx(f'{idx_file}.gz', chunk_size=4)
+    array([[0, 1, 2],
+           [3, 4, 5]], dtype=uint8)
+    """
+    with _open_idx(filename) as fd:
+        dtype, shape, offset = _parse_idx_header(fd, filename)
+        n_items = int(np.prod(shape))
+        if out is not None:
+            if out.size != n_items or not out.flags.c_contiguous:
+                raise Exception(f"`out` must be a contiguous array of "
+                                f"{n_items} items")
+            if out.dtype.newbyteorder('=') != dtype.newbyteorder('='):
+                raise Exception(f"`out` must have dtype {dtype}")
+        if not str(filename).endswith('.gz'):
+            data = np.memmap(filename, dtype=dtype, mode=mmap_mode,
+                             offset=offset, shape=shape)
+            if out is None:
+                return data
+            out.reshape(-1)[:] = data.reshape(-1)
+            return out.reshape(shape)
+
+        if out is None:
+            out = np.empty(shape, dtype=dtype)
+        raw = out.reshape(-1).view(np.uint8)
+        position = 0
+        while position < raw.size:
+            chunk = raw[position:position + chunk_size]
+            n_read = fd.readinto(memoryview(chunk))
+            if not n_read:
+                raise Exception(f"{filename} is truncated")
+            position += n_read
+        if out.dtype != dtype:
+            # `out` is in the other byte order
+            out.byteswap(inplace=True)
+        return out.reshape(shape)
+
 
 def normalize_labels(target):
     """Map an arbitary target vector to an integer vector
@@ -93,12 +407,57 @@ def normalize_labels(target):
     >>> all(np.vectorize(label_map.get)(mapped_target) == target)
     True
     """
-    label_map = {k:v for k, v in enumerate(np.unique(target))}
-    label_map_inv = {v:k for k, v in label_map.items()}
-    mapped_target = np.vectorize(label_map_inv.get)(target)
+    labels, mapped_target = np.unique(target, return_inverse=True)
+    mapped_target = mapped_target.reshape(np.shape(target))
+    label_map = {k: v for k, v in enumerate(labels)}
 
     return mapped_target, label_map
 
+
+def nested_subsample_order(n_points, labels=None, random_state=0):
+    """Random ordering of the points, such that every prefix is a subsample
+
+    Taking the first `k` entries gives a subsample of size `k`, so smaller
+    subsamples (for the same `labels` and `random_state`) are always
+    contained in larger ones. If `labels` is given, every prefix is also
+    stratified: each label occurs in proportion to its frequency (to within
+    a point or two).
+
+    labels: array-like or None
+        Labels to stratify by (e.g. a dataset's target)
+    random_state: int or RandomState
+        Seed for the ordering
+
+    Returns
+    -------
+    integer array: a permutation of range(n_points)
+
+    >>> labels = np.array([0] * 80 + [1] * 20)
+    >>> order = nested_subsample_order(100, labels=labels, random_state=1)
+    >>> np.bincount(labels[order[:10]])
+    array([8, 2])
+    >>> set(order[:10]) <= set(order[:50])
+    True
+    """
+    from sklearn.utils import check_random_state
+    generator = check_random_state(random_state)
+    permutation = generator.permutation(n_points)
+    if labels is None:
+        return permutation
+
+    _, codes = np.unique(np.asarray(labels), return_inverse=True)
+    codes = codes.reshape(-1)[permutation]
+    counts = np.bincount(codes)
+    # position of each point among the points with the same label
+    by_label = np.argsort(codes, kind='stable')
+    rank = np.empty(n_points)
+    first = np.repeat(np.cumsum(counts) - counts, counts)
+    rank[by_label] = np.arange(n_points) - first
+    # spread each label evenly over the ordering, breaking ties at random
+    position = (rank + generator.rand(n_points)) / counts[codes]
+    return permutation[np.argsort(position, kind='stable')]
+
+
 def partial_call_signature(func):
     """Return the fully qualified call signature for a (partial) function
     """
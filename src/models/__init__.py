@@ -1,6 +1,25 @@
-from .dr import available_algorithms
-from .meta import available_meta_estimators
-from .train import load_model
-from .train import save_model
-from .predict import run_model
+import importlib
 
+# Submodules are only imported when one of their names is first used
+_LAZY_ATTRIBUTES = {
+    'available_algorithms': '.dr',
+    'available_meta_estimators': '.meta',
+    'load_model': '.train',
+    'save_model': '.train',
+    'run_model': '.predict',
+}
+
+__all__ = list(_LAZY_ATTRIBUTES)
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module = importlib.import_module(_LAZY_ATTRIBUTES[name], __name__)
+    value = getattr(module, name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -1,29 +1,74 @@
+import importlib
+
 #from MulticoreTSNE import MulticoreTSNE as TSNE
-from sklearn.decomposition import PCA, KernelPCA
-from sklearn.manifold import MDS, Isomap, LocallyLinearEmbedding, SpectralEmbedding
-from sklearn.manifold import TSNE
-from umap import UMAP
+
+
+def lazy_estimator(module_name, class_name, **defaults):
+    """Factory for `module_name.class_name` estimators
+
+    The module is only imported when the factory is first called, and
+    every call returns a fresh instance, so callers are free to
+    `set_params` on it. Keyword arguments given to the factory override
+    `defaults`.
+
+    >>> make_pca = lazy_estimator('sklearn.decomposition', 'PCA',
+    ...                           n_components=2)
+    >>> make_pca().n_components
+    2
+    >>> make_pca(n_components=3).n_components
+    3
+    >>> make_pca() is make_pca()
+    False
+    """
+    def factory(*args, **params):
+        module = importlib.import_module(module_name)
+        return getattr(module, class_name)(*args, **{**defaults, **params})
+    factory.__name__ = class_name
+    factory.__qualname__ = class_name
+    factory.__doc__ = f"Build a new {module_name}.{class_name}"
+    return factory
+
+
+def unimplemented_estimator(name):
+    """Placeholder factory for an algorithm that has no estimator yet
+
+    >>> unimplemented_estimator('autoencoder')()
+    Traceback (most recent call last):
+      ...
+    NotImplementedError: No estimator is implemented for autoencoder
+    """
+    def factory(*args, **params):
+        raise NotImplementedError(f"No estimator is implemented for {name}")
+    factory.__name__ = name
+    factory.__qualname__ = name
+    return factory
 
 
 DR_ALGORITHMS = {
-    "autoencoder": None,
-    "HLLE": LocallyLinearEmbedding(method='hessian'),
-    "Isomap": Isomap(),
-    "KernelPCA": KernelPCA(),
-    "LaplacianEigenmaps": SpectralEmbedding(),
-    "LLE": LocallyLinearEmbedding(),
-    "LTSA": LocallyLinearEmbedding(method='ltsa'),
-    "MDS": MDS(),
-    "PCA": PCA(),
-    "TSNE": TSNE(),
-    "UMAP": UMAP(),
+    "autoencoder": unimplemented_estimator('autoencoder'),
+    "HLLE": lazy_estimator('sklearn.manifold', 'LocallyLinearEmbedding',
+                           method='hessian'),
+    "Isomap": lazy_estimator('sklearn.manifold', 'Isomap'),
+    "KernelPCA": lazy_estimator('sklearn.decomposition', 'KernelPCA'),
+    "LaplacianEigenmaps": lazy_estimator('sklearn.manifold',
+                                         'SpectralEmbedding'),
+    "LLE": lazy_estimator('sklearn.manifold', 'LocallyLinearEmbedding'),
+    "LTSA": lazy_estimator('sklearn.manifold', 'LocallyLinearEmbedding',
+                           method='ltsa'),
+    "MDS": lazy_estimator('sklearn.manifold', 'MDS'),
+    "PCA": lazy_estimator('sklearn.decomposition', 'PCA'),
+    "TSNE": lazy_estimator('sklearn.manifold', 'TSNE'),
+    "UMAP": lazy_estimator('umap', 'UMAP'),
 }
 
+
 def available_algorithms():
     """Valid Algorithms for dimension reduction applications
 
-    This function simply returns the list of known dimension reduction
-    algorithms.
+    This function simply returns the dict of known dimension reduction
+    algorithms, mapping each name to a factory. Call the factory to get
+    a new (unfitted) estimator, e.g. `available_algorithms()['PCA']()`.
+    Estimator modules are only imported when a factory is first called.
 
     It exists to allow for a description of the mapping for
     each of the valid strings.
@@ -33,7 +78,7 @@ def available_algorithms():
     ============     ====================================
     Algorithm        Function
     ============     ====================================
-    autoencoder
+    autoencoder      (not implemented yet)
     isomap
     MDS
     PCA
@@ -42,5 +87,3 @@ def available_algorithms():
     ============     ====================================
     """
     return DR_ALGORITHMS
-
-
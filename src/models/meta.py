@@ -1,7 +1,7 @@
-from sklearn.model_selection import GridSearchCV
+from .dr import lazy_estimator
 
 DR_META_ESTIMATORS = {
-    'grid_search': GridSearchCV
+    'grid_search': lazy_estimator('sklearn.model_selection', 'GridSearchCV')
 }
 
 def available_meta_estimators():
@@ -0,0 +1,437 @@
+import numpy as np
+from scipy import linalg
+from sklearn.base import clone
+from sklearn.manifold import TSNE, _t_sne
+from sklearn.utils import check_random_state
+from sklearn.utils._openmp_helpers import _openmp_effective_n_threads
+
+from .. import quality_measures as qm
+from ..logging import logger
+
+__all__ = [
+    'QualityMonitor',
+    'StoppingRule',
+    'monitored_fit_transform',
+]
+
+_LOWER_IS_BETTER = ['1nn-error']
+
+
+def _fast_rank_matrix(distance_matrix):
+    '''
+    Vectorized rank matrix. Ties are broken by column index.
+
+    >>> _fast_rank_matrix(np.array([[0, 1, 5, 3],\
+                                    [1, 0 , 3, 5],\
+                                    [5, 3, 0, 1],\
+                                    [3, 5, 1, 0]]))
+    array([[0, 1, 3, 2],
+           [1, 0, 2, 3],
+           [3, 2, 0, 1],
+           [2, 3, 1, 0]], dtype=int32)
+    '''
+    n_rows, n_cols = distance_matrix.shape
+    order = np.argsort(distance_matrix, axis=1, kind='stable')
+    ranks = np.empty((n_rows, n_cols), dtype='int32')
+    np.put_along_axis(ranks, order,
+                      np.arange(n_cols, dtype='int32')[np.newaxis, :],
+                      axis=1)
+    return ranks
+
+
+class StoppingRule:
+    def __init__(self, score='trustworthiness', tolerance=0.05, min_stage=1):
+        """
+        Abort runs whose score trajectory is clearly worse than the best
+        completed run seen so far.
+
+        score: {'trustworthiness', 'continuity', '1nn-error'}
+            Which monitored score to compare
+        tolerance: float
+            A run is aborted once its score at a given stage is worse than
+            the best run's score at the same stage by more than this amount
+        min_stage: int
+            Never abort before this stage (stages are numbered from 0)
+
+        """
+        self.score = score
+        self.tolerance = tolerance
+        self.min_stage = min_stage
+        self.best = None
+
+    def _sign(self):
+        return -1 if self.score in _LOWER_IS_BETTER else 1
+
+    def should_stop(self, history):
+        """Decide whether the run that produced `history` should be aborted
+        """
+        if self.best is None or not history:
+            return False
+        stage = len(history) - 1
+        if stage < self.min_stage or stage >= len(self.best):
+            return False
+        sign = self._sign()
+        current = sign * history[-1][self.score]
+        return current < sign * self.best[stage] - self.tolerance
+
+    def update(self, history):
+        """Record a completed run, keeping it if it beats the current best
+        """
+        if not history:
+            return
+        trajectory = [h[self.score] for h in history]
+        sign = self._sign()
+        if self.best is None or sign * trajectory[-1] > sign * self.best[-1]:
+            self.best = trajectory
+
+
+class QualityMonitor:
+    def __init__(self, high_data, classes=None, n_neighbors=10, n_probe=500,
+                 metric='euclidean', random_state=0, stopping_rule=None):
+        """
+        Cheap embedding quality checks for use during iterative optimisation.
+
+        A fixed, seeded probe subset of the points is chosen up front and
+        its high-space neighbourhoods are precomputed. Each call then only
+        needs the low-space distances between the probe points, so
+        trustworthiness, continuity and the 1-NN error can be estimated in
+        a few milliseconds.
+
+        high_data: np.array
+            The data being embedded
+        classes: 1d np.array or None
+            Class of each row of `high_data`. If None, the 1-NN error is
+            not computed
+        n_neighbors: int
+            Neighbourhood size used for trustworthiness and continuity
+        n_probe: int
+            Number of points in the probe subset
+        metric: string
+            Metric to use in the high space (see `quality_measures`)
+        random_state: int, RandomState instance or None
+            Seed used to choose the probe subset
+        stopping_rule: StoppingRule or None
+            If given, consulted by `should_stop`
+
+        >>> X = np.random.RandomState(0).rand(50, 5)
+        >>> monitor = QualityMonitor(X, n_neighbors=5, n_probe=20)
+        >>> scores = monitor(X[:, :2], stage=0)
+        >>> probe = monitor.probe
+        >>> np.isclose(scores['trustworthiness'],
+        ...            qm.trustworthiness(high_data=X[probe],
+        ...                               low_data=X[probe, :2],
+        ...                               n_neighbors=5))
+        True
+        >>> np.isclose(scores['continuity'],
+        ...            qm.continuity(high_data=X[probe],
+        ...                          low_data=X[probe, :2],
+        ...                          n_neighbors=5))
+        True
+        >>> monitor(X, stage=1)['trustworthiness']
+        1.0
+        """
+        generator = check_random_state(random_state)
+        n_points = high_data.shape[0]
+        n_probe = min(n_probe, n_points)
+        if n_neighbors >= n_probe:
+            raise ValueError(f"n_neighbors ({n_neighbors}) must be smaller "
+                             f"than n_probe ({n_probe})")
+
+        self.probe = np.sort(generator.choice(n_points, n_probe,
+                                              replace=False))
+        self.n_neighbors = n_neighbors
+        self.stopping_rule = stopping_rule
+        self.history = []
+
+        high_distances = qm.pairwise_distances(
+            np.asarray(high_data)[self.probe], metric=metric)
+        self._high_rank = _fast_rank_matrix(high_distances)
+        self._high_knn = self._high_rank <= n_neighbors
+        self._G_K = qm._trustworthiness_normalizating_factor(n_neighbors,
+                                                             n_probe)
+        if classes is None:
+            self._classes = None
+        else:
+            self._classes = np.asarray(classes)[self.probe]
+
+    def __call__(self, low_data, stage=None):
+        """Score an embedding of the full dataset, and record the result
+
+        Returns
+        -------
+        dict of scores, keyed by quality measure name
+        """
+        low_probe = np.asarray(low_data)[self.probe]
+        low_distances = qm.pairwise_distances(low_probe)
+        low_rank = _fast_rank_matrix(low_distances)
+        low_knn = low_rank <= self.n_neighbors
+
+        untrust = (low_knn & ~self._high_knn) * (self._high_rank -
+                                                 self.n_neighbors)
+        discont = (self._high_knn & ~low_knn) * (low_rank - self.n_neighbors)
+        scores = {
+            'stage': len(self.history) if stage is None else stage,
+            'trustworthiness': 1 - 2 * untrust.sum() / self._G_K,
+            'continuity': 1 - 2 * discont.sum() / self._G_K,
+        }
+        if self._classes is not None:
+            np.fill_diagonal(low_distances, np.inf)
+            nearest = np.argmin(low_distances, axis=1)
+            scores['1nn-error'] = np.mean(self._classes[nearest] !=
+                                          self._classes)
+        self.history.append(scores)
+        return scores
+
+    def reset(self):
+        """Forget the history of the current run"""
+        self.history = []
+
+    def should_stop(self):
+        """True if the stopping rule says to abort the current run"""
+        if self.stopping_rule is None:
+            return False
+        return self.stopping_rule.should_stop(self.history)
+
+    def finish(self):
+        """Mark the current run as complete, updating the stopping rule"""
+        if self.stopping_rule is not None:
+            self.stopping_rule.update(self.history)
+
+
+class _AbortRun(Exception):
+    """Raised from inside an optimiser to abandon the run"""
+
+
+def _tsne_n_iter(estimator):
+    '''Iteration budget of a TSNE estimator (`max_iter` in newer sklearn)'''
+    params = estimator.get_params()
+    if isinstance(params.get('max_iter', None), int):
+        return params['max_iter']
+    return params['n_iter']
+
+
+class _MonitoredTSNE(TSNE):
+    """TSNE that calls `iteration_callback(embedding, iteration)` before
+    every gradient step
+
+    TSNE has no callback API, so `_tsne` is overridden: it runs the same
+    two-phase optimisation (early exaggeration, then the main run) with
+    the same gradient descent with momentum and gains as sklearn, but in
+    a loop of its own. Nothing in sklearn is patched, so other (e.g.
+    concurrent) TSNE fits are unaffected.
+    """
+    iteration_callback = None
+
+    def _tsne(self, P, degrees_of_freedom, n_samples, X_embedded,
+              neighbors=None, skip_num_points=0):
+        objective_kwargs = {
+            'P': P,
+            'degrees_of_freedom': degrees_of_freedom,
+            'n_samples': n_samples,
+            'n_components': self.n_components,
+            'skip_num_points': skip_num_points,
+        }
+        if self.method == 'barnes_hut':
+            objective = _t_sne._kl_divergence_bh
+            objective_kwargs.update(angle=self.angle, verbose=self.verbose,
+                                    num_threads=_openmp_effective_n_threads())
+        else:
+            objective = _t_sne._kl_divergence
+        n_exploration = self._EXPLORATION_N_ITER
+        n_iter = _tsne_n_iter(self)
+
+        P *= self.early_exaggeration
+        params, kl_divergence, it = self._descend(
+            objective, objective_kwargs, X_embedded.ravel(), 0,
+            n_exploration, momentum=0.5,
+            n_iter_without_progress=n_exploration)
+        P /= self.early_exaggeration
+        if it < n_exploration or n_iter > n_exploration:
+            params, kl_divergence, it = self._descend(
+                objective, objective_kwargs, params, it + 1, n_iter,
+                momentum=0.8,
+                n_iter_without_progress=self.n_iter_without_progress)
+
+        self.n_iter_ = it
+        self.kl_divergence_ = kl_divergence
+        return params.reshape(n_samples, self.n_components)
+
+    def _descend(self, objective, objective_kwargs, p0, it, n_iter,
+                 momentum, n_iter_without_progress, min_gain=0.01):
+        """Gradient descent with momentum and individual gains, as in
+        sklearn's `_gradient_descent`
+
+        Returns
+        -------
+        (parameters, error, last iteration)
+        """
+        p = p0.copy().ravel()
+        update = np.zeros_like(p)
+        gains = np.ones_like(p)
+        error = best_error = np.finfo(float).max
+        best_iter = i = it
+        for i in range(it, n_iter):
+            if self.iteration_callback is not None:
+                self.iteration_callback(p.reshape(-1, self.n_components), i)
+            check_convergence = (i + 1) % self._N_ITER_CHECK == 0
+            error, grad = objective(
+                p, compute_error=check_convergence or i == n_iter - 1,
+                **objective_kwargs)
+
+            inc = update * grad < 0.0
+            gains[inc] += 0.2
+            gains[~inc] *= 0.8
+            np.clip(gains, min_gain, np.inf, out=gains)
+            grad *= gains
+            update = momentum * update - self.learning_rate_ * grad
+            p += update
+
+            if check_convergence:
+                if error < best_error:
+                    best_error = error
+                    best_iter = i
+                elif i - best_iter > n_iter_without_progress:
+                    break
+                if linalg.norm(grad) <= self.min_grad_norm:
+                    break
+        return p, error, i
+
+
+def _copy_fitted_attributes(source, estimator):
+    """Give `estimator` the fitted attributes (e.g. `embedding_`) of `source`
+    """
+    for key, value in vars(source).items():
+        if key.endswith('_') and not key.startswith('_'):
+            setattr(estimator, key, value)
+
+
+def _staged_n_epochs(estimator, X):
+    """Epoch budget of an estimator such as UMAP, whose default (None)
+    depends on the size of the data"""
+    n_epochs = estimator.get_params()['n_epochs']
+    if n_epochs is None:
+        n_epochs = 500 if X.shape[0] <= 10000 else 200
+    return n_epochs
+
+
+def _monitored_tsne(estimator, X, monitor, n_stages, name):
+    n_iter = _tsne_n_iter(estimator)
+    if not 1 <= n_stages <= n_iter:
+        raise ValueError(f"n_stages must be between 1 and the iteration "
+                         f"budget ({n_iter}). Got {n_stages}")
+    stage_length = n_iter // n_stages
+    state = {'stage': 0}
+
+    def check(embedding, iteration):
+        # `embedding` is the result of `iteration` gradient steps
+        if iteration == (state['stage'] + 1) * stage_length and \
+           state['stage'] < n_stages - 1:
+            scores = monitor(embedding, stage=state['stage'])
+            logger.debug(f"{name} iteration {iteration}: {scores}")
+            if monitor.should_stop():
+                state['embedding'] = embedding.copy()
+                state['iteration'] = iteration
+                raise _AbortRun()
+            state['stage'] += 1
+
+    monitored = _MonitoredTSNE(**estimator.get_params())
+    monitored.iteration_callback = check
+    try:
+        embedding = monitored.fit_transform(X)
+    except _AbortRun:
+        logger.info(f"Aborting {name} after {state['iteration']} iterations: "
+                    "trajectory is worse than the current best")
+        return state['embedding'], False
+    _copy_fitted_attributes(monitored, estimator)
+
+    scores = monitor(embedding, stage=state['stage'])
+    logger.debug(f"{name} final: {scores}")
+    return embedding, True
+
+
+def _monitored_stages(estimator, X, monitor, n_stages, name):
+    n_epochs = _staged_n_epochs(estimator, X)
+    if not 1 <= n_stages <= n_epochs:
+        raise ValueError(f"n_stages must be between 1 and the epoch "
+                         f"budget ({n_epochs}). Got {n_stages}")
+    stage_length = n_epochs // n_stages
+    init = estimator.get_params()['init']
+    for stage in range(n_stages):
+        length = stage_length
+        if stage == n_stages - 1:
+            length = n_epochs - stage * stage_length
+        stage_estimator = clone(estimator).set_params(n_epochs=length,
+                                                      init=init)
+        embedding = stage_estimator.fit_transform(X)
+        init = embedding
+        scores = monitor(embedding, stage=stage)
+        logger.debug(f"{name} epoch {(stage + 1) * stage_length}: {scores}")
+        if stage < n_stages - 1 and monitor.should_stop():
+            logger.info(f"Aborting {name} after {stage + 1} of {n_stages} "
+                        "stages: trajectory is worse than the current best")
+            return embedding, False
+    _copy_fitted_attributes(stage_estimator, estimator)
+    return embedding, True
+
+
+def monitored_fit_transform(estimator, X, *, monitor, n_stages=4):
+    '''
+    Fit an iterative estimator, checking the embedding quality as it goes.
+
+    For sklearn's TSNE, the (single) optimisation run is scored at
+    `n_stages` evenly spaced points of its iteration budget, the last
+    being the final embedding, and is abandoned as soon as the monitor's
+    stopping rule fires. Apart from the checks, the run is the one
+    `estimator.fit_transform(X)` would perform (see `_MonitoredTSNE`).
+
+    Estimators with `n_epochs` and `init` parameters (e.g. UMAP) are run
+    in `n_stages` consecutive fits, each continuing from the previous
+    embedding, for an equal share of the epochs, and are scored (and
+    possibly abandoned) after each. Every fit restarts the optimiser's
+    learning rate schedule, so the result is close to, but not the same
+    as, a single fit.
+
+    Other estimators give no access to an optimisation in progress, so the
+    monitor can only be used as a between-run probe: the estimator is fit
+    once, and only its final embedding is scored. For these, `n_stages`
+    must be 1.
+
+    Parameters
+    ----------
+    estimator: sklearn-style estimator
+        The estimator to fit. If the run completes, it is left fitted
+    X: np.array
+        Data to embed
+    monitor: QualityMonitor
+        Monitor to call at each stage. Its history is reset first.
+    n_stages: int
+        Number of checks to make during the run. At most the estimator's
+        iteration (or epoch) budget
+
+    Returns
+    -------
+    (embedding, completed): the last embedding, and False if the run
+    was aborted by the stopping rule
+    '''
+    name = type(estimator).__name__
+    monitor.reset()
+
+    if isinstance(estimator, TSNE):
+        embedding, completed = _monitored_tsne(estimator, X, monitor,
+                                               n_stages, name)
+    elif {'n_epochs', 'init'} <= set(estimator.get_params()):
+        embedding, completed = _monitored_stages(estimator, X, monitor,
+                                                 n_stages, name)
+    else:
+        if n_stages != 1:
+            raise ValueError(f"{name} can only be monitored between runs. "
+                             "Use n_stages=1")
+        embedding = estimator.fit_transform(X)
+        scores = monitor(embedding, stage=0)
+        logger.debug(f"{name}: {scores}")
+        completed = True
+
+    if not completed or monitor.should_stop():
+        return embedding, False
+    monitor.finish()
+    return embedding, True
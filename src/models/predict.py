@@ -1,10 +1,10 @@
-import joblib
 import json
 import os
 import pathlib
 import time
 
-from ..data import Dataset, datasets
+from ..data import Dataset, datasets, hash_array
+from ..data.dset import _HASH_FORMAT
 from ..logging import logger
 from ..paths import model_output_path
 from ..utils import record_time_interval
@@ -46,6 +46,8 @@ def run_model(dataset_opts=None,
         attempt number via the same parameters
     force: (boolean)
         force re-running the algorithm and overwriting any existing data.
+        Experiments whose hashes were computed in an older format are
+        always re-run.
 
     Returns
     -------
@@ -76,9 +78,10 @@ def run_model(dataset_opts=None,
         'dataset_opts': dataset_opts,
         'run_number': run_number,
         'hash_type': hash_type,
-        'data_hash': joblib.hash(dataset.data, hash_name=hash_type),
-        'target_hash': joblib.hash(dataset.target, hash_name=hash_type),
-        'model_hash': joblib.hash(model, hash_name=hash_type),
+        'hash_format': _HASH_FORMAT,
+        'data_hash': dataset.digest('data', hash_type=hash_type),
+        'target_hash': dataset.digest('target', hash_type=hash_type),
+        'model_hash': hash_array(model, hash_type=hash_type),
     }
 
     metadata_fq = output_path / f'{file_base}.metadata'
@@ -86,9 +89,13 @@ def run_model(dataset_opts=None,
     if metadata_fq.exists() and force is False:
         cached_metadata = Dataset.load(file_base, data_path=output_path,
                                        metadata_only=True)
-        if experiment.items() <= cached_metadata['experiment'].items():
+        cached_experiment = cached_metadata['experiment']
+        if cached_experiment.get('hash_format', None) != _HASH_FORMAT:
+            logger.info("Cached experiment predates the current hash format. "
+                        "Re-running")
+        elif experiment.items() <= cached_experiment.items():
             logger.info("Experiment has already been run. Returning Cached Result")
-            return Dataset.load(file_base, data_path=output_path)
+            return Dataset.load(file_base, data_path=output_path, lazy=True)
         else:
             raise Exception(f'An Experiment with this name exists already, '
                             'but metadata has changed. '
@@ -23,7 +23,8 @@ from . import run_model
 @click.command()
 @click.argument('model_list')
 @click.option('--output_file', '-o', nargs=1, type=str)
-@click.option('--hash-type', '-H', type=click.Choice(['md5', 'sha1']), default='sha1')
+@click.option('--hash-type', '-H',
+              type=click.Choice(['blake2b', 'md5', 'sha1']), default='sha1')
 def main(model_list, output_file='predictions.json', hash_type='sha1'):
     logger.info(f'Executing models from {model_list}')
 
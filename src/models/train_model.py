@@ -1,29 +1,105 @@
 # -*- coding: utf-8 -*-
 import click
 import json
-import joblib
 import os
 from pathlib import Path
 from dotenv import find_dotenv, load_dotenv
 from functools import partial
 
 import numpy as np
-import pandas as pd
 
 from ..logging import logger
 from ..paths import model_path, trained_model_path
 from ..data import datasets
+from ..data.dset import _HASH_FORMAT
+from ..data.intrinsic_dim import (estimate_intrinsic_dimension,
+                                  order_n_components)
 from ..utils import save_json
 from .. import quality_measures as qm
+from ..score_cache import ScoreCache, set_score_cache
 from .train import save_model
 from .dr import available_algorithms
 from .meta import available_meta_estimators
+from .monitor import QualityMonitor, StoppingRule, monitored_fit_transform
+
+
+def _monitored_fit(alg, ds, monitor_opts, stopping_rules):
+    """Fit `alg` to `ds` with a `QualityMonitor`
+    (see `monitored_fit_transform`)
+
+    Runs on the same data with the same stopping rule options share a
+    `StoppingRule`, so later runs are abandoned once they fall behind the
+    best earlier one.
+
+    Returns
+    -------
+    (completed, history): False if the run was aborted, and the scores
+    at each stage
+    """
+    monitor_opts = monitor_opts.copy()
+    n_stages = monitor_opts.pop('n_stages', 4)
+    rule_opts = {k: monitor_opts.pop(k)
+                 for k in ['score', 'tolerance', 'min_stage']
+                 if k in monitor_opts}
+    rule_key = json.dumps([ds.name, ds.digest('data'), rule_opts],
+                          sort_keys=True)
+    stopping_rule = stopping_rules.setdefault(rule_key,
+                                              StoppingRule(**rule_opts))
+    monitor = QualityMonitor(ds.data, classes=ds.target,
+                             stopping_rule=stopping_rule, **monitor_opts)
+    _, completed = monitored_fit_transform(alg, ds.data, monitor=monitor,
+                                           n_stages=n_stages)
+    history = [{k: v if k == 'stage' else float(v) for k, v in scores.items()}
+               for scores in monitor.history]
+    return completed, history
+
+
+def _check_training_dicts(training_dicts, dataset_list, dr_algorithm_list,
+                          quality_measures, meta_est_list):
+    """Check the entries of a model list, keying them by model_key
+
+    (see `main`). `run_number` defaults to 0.
+    """
+    metadata_dict = {}
+    for td in training_dicts:
+        ds_name = td.get('dataset', None)
+        assert ds_name in dataset_list, f'Unknown Dataset: {ds_name}'
+
+        alg_name = td.get('algorithm', None)
+        assert alg_name in dr_algorithm_list, \
+            f'Unknown Algorithm: {alg_name}'
+
+        score_name = td.get('score', None)
+        assert score_name in quality_measures, f'Unknown Score: {score_name}'
+
+        meta_name = td.get('meta', None)
+        if meta_name is not None:
+            assert meta_name in meta_est_list, \
+                f'Unknown meta-estimator: {meta_name}'
+            if td.get('monitor', None) is not None:
+                raise Exception("`monitor` can't be combined with a "
+                                f"meta-estimator ({meta_name})")
+
+        run_number = td.get('run_number', 0)
+        model_key = f"{td['algorithm']}_{td['dataset']}_{td['score']}_" \
+            f"{run_number}"
+        if model_key in metadata_dict:
+            raise Exception("{id_base} already exists. Give a unique "
+                            "`run_number` to avoid collisions.")
+        else:
+            td['run_number'] = run_number
+            metadata_dict[model_key] = td
+    return metadata_dict
+
 
 @click.command()
 @click.argument('model_list')
 @click.option('--output_file', '-o', nargs=1, type=str)
-@click.option('--hash-type', '-H', type=click.Choice(['md5', 'sha1']), default='sha1')
-def main(model_list, output_file='experiments.json', hash_type='sha1'):
+@click.option('--hash-type', '-H',
+              type=click.Choice(['blake2b', 'md5', 'sha1']), default='sha1')
+@click.option('--score-cache/--no-score-cache', default=True)
+def main(model_list, output_file='experiments.json', hash_type='sha1',
+         score_cache=True):
     """Trains models speficied in the supplied `model_list` file
 
     output is a dictionary of trained model metadata, keyed by
@@ -51,17 +127,30 @@ def main(model_list, output_file='experiments.json', hash_type='sha1'):
     ----------
     model_list:
         json file specifying list of meta-estimators, algorithms, and score functions to
-        combine into a model
+        combine into a model. If an entry has an `intrinsic_dimension` dict
+        (e.g. {"method": "mle", "window": 2}), its `n_components` candidates
+        are ordered by distance from the dataset's estimated intrinsic
+        dimension, and those further than `window` away are dropped. If an
+        entry without a `meta` estimator has a `monitor` dict (e.g.
+        {"n_stages": 4, "score": "trustworthiness", "tolerance": 0.05}), the
+        fit is monitored (see `monitored_fit_transform`); runs that fall
+        behind the best earlier run on the same data are abandoned, and not
+        saved.
     output_file:
         name of json file to write metadata to
     hash_name:
         type of hash to use for caching
+    score_cache:
+        if True, quality measure results are cached on disk
+        (see `ScoreCache`), so unchanged embeddings are not re-scored
 
 
     """
     logger.info(f'Building models from {model_list}')
 
     os.makedirs(trained_model_path, exist_ok=True)
+    if score_cache:
+        set_score_cache(ScoreCache())
 
     with open(model_path / model_list) as f:
         training_dicts = json.load(f)
@@ -72,41 +161,36 @@ def main(model_list, output_file='experiments.json', hash_type='sha1'):
     dr_algorithm_list = available_algorithms()
     meta_est_list = available_meta_estimators()
 
-    metadata_dict = {}
+    metadata_dict = _check_training_dicts(training_dicts, dataset_list,
+                                          dr_algorithm_list,
+                                          quality_measures, meta_est_list)
+    stopping_rules = {}
     saved_meta = {}
-    for td in training_dicts:
-        ds_name = td.get('dataset', None)
-        assert ds_name in dataset_list, f'Unknown Dataset: {ds_name}'
-
-        alg_name = td.get('algorithm', None)
-        assert alg_name in dr_algorithm_list, f'Unknown Algorithm: {alg_name}'
-
-        score_name = td.get('score', None)
-        assert score_name in quality_measures, f'Unknown Score: {score_name}'
-
-        meta_name = td.get('meta', None)
-        if meta_name is not None:
-            assert meta_name in meta_est_list, f'Unknown meta-estimator: {meta_name}'
-
-        run_number = td.get('run_number', 0)
-        model_key = f"{td['algorithm']}_{td['dataset']}_{td['score']}_{run_number}"
-        if model_key in metadata_dict:
-            raise Exception("{id_base} already exists. Give a unique `run_number` to avoid collisions.")
-        else:
-            td['run_number'] = run_number
-            metadata_dict[model_key] = td
-
     for model_key, td in metadata_dict.items():
         logger.debug(f'Creating model for {model_key}')
         ds_name = td['dataset']
         ds_opts = td.get('dataset_params', {})
         ds = datasets.load_dataset(ds_name, **ds_opts)
-        td['data_hash'] = joblib.hash(ds.data, hash_name=hash_type)
-        td['target_hash'] = joblib.hash(ds.target, hash_name=hash_type)
+        td['hash_type'] = hash_type
+        td['hash_format'] = _HASH_FORMAT
+        td['data_hash'] = ds.digest('data', hash_type=hash_type)
+        td['target_hash'] = ds.digest('target', hash_type=hash_type)
 
         alg_name = td['algorithm']
         alg_opts = td.get('algorithm_params', {})
-        alg = dr_algorithm_list[alg_name]
+        alg = dr_algorithm_list[alg_name]()
+
+        id_opts = td.get('intrinsic_dimension', None)
+        if id_opts is not None and \
+           isinstance(alg_opts.get('n_components'), list):
+            id_opts = id_opts.copy()
+            window = id_opts.pop('window', None)
+            estimate = estimate_intrinsic_dimension(ds, **id_opts)
+            alg_opts['n_components'] = order_n_components(
+                alg_opts['n_components'], estimate, window=window)
+            td['intrinsic_dimension_estimate'] = estimate
+            logger.debug(f"{model_key}: n_components candidates "
+                         f"{alg_opts['n_components']}")
 
         score_name = td.get('score', None)
         score_params = td.get('score_params', {})
@@ -129,16 +213,28 @@ def main(model_list, output_file='experiments.json', hash_type='sha1'):
 
             saved_meta[model_key] = save_model(model_name=model_key, model=best_est, metadata=td)
 
+            import pandas as pd
             cv_results = pd.DataFrame(grid_search.cv_results_).T # save this off as k.csv
             cv_results.index.name = 'grid_search_results'
             cv_results.to_csv(trained_model_path / f"{model_key}-gridsearch.csv")
 
         elif meta_name is None:
             logger.debug(f'Fitting {model_key}')
-            # Apply parameters straight to the estimator
+            # Apply parameters straight to the (fresh) estimator
             alg.set_params(**alg_opts)
-            alg.fit(ds.data)
-            saved_meta[model_key] = save_model(model_name=model_key, model=alg, metadata=td)
+            monitor_opts = td.get('monitor', None)
+            if monitor_opts is None:
+                alg.fit(ds.data)
+            else:
+                completed, td['monitor_history'] = _monitored_fit(
+                    alg, ds, monitor_opts, stopping_rules)
+                if not completed:
+                    logger.info(f'Abandoned {model_key}: '
+                                'worse than an earlier run')
+                    saved_meta[model_key] = {**td, 'aborted': True}
+                    continue
+            saved_meta[model_key] = save_model(model_name=model_key,
+                                               model=alg, metadata=td)
 
     save_json(model_path / output_file, saved_meta)
 
@@ -1,7 +1,11 @@
+import weakref
+
 import numpy as np
 from sklearn.metrics import pairwise_distances as sk_pairwise_distances
 from sklearn.neighbors import NearestNeighbors
 
+from .score_cache import cached_measure
+
 # from .logging import logger
 
 
@@ -24,6 +28,175 @@ def centering_matrix(N):
     return J
 
 
+# Metrics
+_FAST_METRICS = ['euclidean', 'sqeuclidean', 'cosine']
+_TILE_BYTES = 64 * 2**20
+_ROW_CACHE = {}
+
+
+def _cached_rows(X, kind, func):
+    '''
+    Return `func(X)`, caching the result for the lifetime of the array `X`.
+
+    Entries are keyed on the identity of `X`, and are dropped as soon as
+    `X` is garbage collected. Note that in-place modifications of `X` are
+    not detected; call `clear_metric_cache` after mutating cached data.
+    '''
+    if not isinstance(X, np.ndarray):
+        return func(np.asarray(X))
+    key = (id(X), kind)
+    entry = _ROW_CACHE.get(key, None)
+    if entry is not None:
+        ref, shape, value = entry
+        if ref() is X and shape == X.shape:
+            return value
+    value = func(X)
+    ref = weakref.ref(X, lambda _, key=key: _ROW_CACHE.pop(key, None))
+    _ROW_CACHE[key] = (ref, X.shape, value)
+    return value
+
+
+def clear_metric_cache():
+    '''
+    Drop all cached row norms and normalized copies.
+    '''
+    _ROW_CACHE.clear()
+
+
+def row_norms(X, squared=False):
+    '''
+    Return the (cached) euclidean norm of every row of X.
+
+    >>> row_norms(np.array([[3, 4], [0, 1]]))
+    array([5., 1.])
+    >>> row_norms(np.array([[3, 4], [0, 1]]), squared=True)
+    array([25.,  1.])
+    '''
+    def _sq_norms(A):
+        A = A.astype(np.float64, copy=False)
+        return np.einsum('ij,ij->i', A, A)
+    sq_norms = _cached_rows(X, 'sq_norms', _sq_norms)
+    if squared:
+        return sq_norms
+    return _cached_rows(X, 'norms', lambda A: np.sqrt(sq_norms))
+
+
+def normalized_rows(X):
+    '''
+    Return a (cached) copy of X with every row scaled to unit length.
+    Rows of all zeros (or with a norm that is zero to within machine
+    precision, as in sklearn) are left unscaled.
+
+    >>> normalized_rows(np.array([[3, 4], [0, 0]]))
+    array([[0.6, 0.8],
+           [0. , 0. ]])
+    '''
+    def _normalize(A):
+        norms = row_norms(A)
+        norms = np.where(norms < 10 * np.finfo(np.float64).eps, 1.0, norms)
+        return A / norms[:, np.newaxis]
+    return _cached_rows(X, 'normalized', _normalize)
+
+
+def _split_metric(metric):
+    '''
+    Split a metric specification into a (high_metric, low_metric) pair.
+
+    >>> _split_metric('cosine')
+    ('cosine', 'cosine')
+    >>> _split_metric(('precomputed', 'euclidean'))
+    ('precomputed', 'euclidean')
+    '''
+    if isinstance(metric, (tuple, list)):
+        if len(metric) != 2:
+            raise ValueError("metric must be a string or a "
+                             "(high_metric, low_metric) pair")
+        return tuple(metric)
+    return metric, metric
+
+
+def _check_precomputed(X, Y=None):
+    '''
+    Return X as an array, checking it is a (square) distance matrix
+    '''
+    X = np.asarray(X)
+    if Y is not None or X.ndim != 2 or X.shape[0] != X.shape[1]:
+        raise ValueError("A precomputed distance matrix must be square")
+    return X
+
+
+def pairwise_distances(X, Y=None, metric='euclidean', block_size=None):
+    '''
+    Compute the pairwise distance matrix between the rows of X and Y.
+
+    For the 'euclidean', 'sqeuclidean' and 'cosine' metrics, the distances
+    are computed from the cached row norms (or normalized rows) with a single
+    matrix product per tile of `block_size` rows. All other metrics are
+    handed off to sklearn. If `metric` is 'precomputed', X is assumed to
+    already be a distance matrix and is returned unchanged.
+
+    Parameters
+    ----------
+    X: np.array
+    Y: np.array or None
+        If None, compute the distances between the rows of X
+    metric: 'precomputed' or an sklearn metric
+    block_size: int or None
+        Number of rows of X to process per tile. If None, tiles are sized
+        to use roughly 64MB of working memory.
+
+    >>> a = np.array([[7, 4, 0], [4, 5, 2], [9, 4, 3]])
+    >>> pairwise_distances(a)
+    array([[0.        , 3.74165739, 3.60555128],
+           [3.74165739, 0.        , 5.19615242],
+           [3.60555128, 5.19615242, 0.        ]])
+    >>> pairwise_distances(a, metric='sqeuclidean', block_size=1)
+    array([[ 0., 14., 13.],
+           [14.,  0., 27.],
+           [13., 27.,  0.]])
+    >>> pairwise_distances(np.array([[1, 0], [0, 2]]), metric='cosine')
+    array([[0., 1.],
+           [1., 0.]])
+    '''
+    if metric == 'precomputed':
+        return _check_precomputed(X, Y)
+    if metric not in _FAST_METRICS:
+        return sk_pairwise_distances(X, Y, metric=metric)
+
+    symmetric = Y is None or Y is X
+    if Y is None:
+        Y = X
+    if metric == 'cosine':
+        X_rows, Y_rows = normalized_rows(X), normalized_rows(Y)
+    else:
+        X_rows = np.asarray(X, dtype=np.float64)
+        Y_rows = np.asarray(Y, dtype=np.float64)
+        XX, YY = row_norms(X, squared=True), row_norms(Y, squared=True)
+
+    n_x, n_y = X_rows.shape[0], Y_rows.shape[0]
+    if block_size is None:
+        block_size = max(1, _TILE_BYTES // (8 * max(n_y, 1)))
+    distances = np.empty((n_x, n_y), dtype=np.float64)
+    for start in range(0, n_x, block_size):
+        stop = min(start + block_size, n_x)
+        tile = distances[start:stop]
+        np.dot(X_rows[start:stop], Y_rows.T, out=tile)
+        if metric == 'cosine':
+            tile *= -1
+            tile += 1
+            np.clip(tile, 0, 2, out=tile)
+        else:
+            tile *= -2
+            tile += XX[start:stop, np.newaxis]
+            tile += YY[np.newaxis, :]
+            np.maximum(tile, 0, out=tile)
+    if symmetric:
+        np.fill_diagonal(distances, 0)
+    if metric == 'euclidean':
+        np.sqrt(distances, out=distances)
+    return distances
+
+
 def pairwise_distance_differences(high_distances=None, low_distances=None,
                                   high_data=None, low_data=None,
                                   metric='euclidean'):
@@ -31,6 +204,11 @@ def pairwise_distance_differences(high_distances=None, low_distances=None,
     Computes $d_{ij}-||x_{i}-x_{j}||$. Computes pairwise distances in the
     high space and low space if they weren't passed in.
 
+    metric: string or (high_metric, low_metric) tuple
+        Metric used to compute the distances (see `pairwise_distances`).
+        A tuple allows a different metric on each side; e.g.
+        ('precomputed', 'euclidean') treats `high_data` as a distance matrix.
+
     Returns: (high_distances, low_distances, distance_difference)
     -------
     high_distances: np array of pairwise distances between high_data points
@@ -66,15 +244,23 @@ def pairwise_distance_differences(high_distances=None, low_distances=None,
     array([[ 0,  0, -1],
            [ 0,  0,  1],
            [-1,  1,  0]])
+
+    >>> c = np.array([[0, 6], [7, 1], [4, 9]])
+    >>> pairwise_distance_differences(high_data=a, low_data=c,
+    ...                               metric=('precomputed', 'sqeuclidean'))[2]
+    array([[  0., -70., -18.],
+           [-70.,   0., -71.],
+           [-18., -71.,   0.]])
     '''
     if (high_distances is None) and (high_data is None):
         raise ValueError("One of high_distances or high_data is required")
     if (low_distances is None) and (low_data is None):
         raise ValueError("One of low_distances or low_data is required")
+    high_metric, low_metric = _split_metric(metric)
     if low_distances is None:
-        low_distances = sk_pairwise_distances(low_data, metric=metric)
+        low_distances = pairwise_distances(low_data, metric=low_metric)
     if high_distances is None:
-        high_distances = sk_pairwise_distances(high_data, metric=metric)
+        high_distances = pairwise_distances(high_data, metric=high_metric)
 
     difference_distances = high_distances-low_distances
 
@@ -427,6 +613,33 @@ def continuity(high_distances=None, low_distances=None,
     return 1 - sum(pt)
 
 
+def _kneighbors(data, *, n_neighbors, metric='euclidean'):
+    '''
+    Return the indices of the `n_neighbors` nearest neighbors of every row
+    of data (the first column is usually the row itself).
+    '''
+    if metric == 'cosine':
+        # cosine neighbors are euclidean neighbors of the normalized rows
+        data, metric = normalized_rows(data), 'euclidean'
+    elif metric == 'sqeuclidean':
+        metric = 'euclidean'
+    nbrs = NearestNeighbors(n_neighbors=n_neighbors, metric=metric).fit(data)
+    _, indices = nbrs.kneighbors(data)
+    return indices
+
+
+def _without_self(indices):
+    '''
+    Drop each row's own index from its neighbor indices. Rows with
+    duplicates need not list themselves at all; those drop their furthest
+    neighbor instead.
+    '''
+    n_points = indices.shape[0]
+    is_self = indices == np.arange(n_points)[:, None]
+    is_self[~is_self.any(axis=1), -1] = True
+    return indices[~is_self].reshape(n_points, -1)
+
+
 def point_generalized_1nn_error(*, data, classes, metric='euclidean'):
     '''
     Given data and associated classes (for each row), return an
@@ -437,16 +650,16 @@ def point_generalized_1nn_error(*, data, classes, metric='euclidean'):
     ----------
     data: np.array
     classes: 1d np.array
-    metric: an sklearn metric to use on the data to find nearest neighbors
+    metric: 'precomputed' or an sklearn metric to use on the data to find
+        nearest neighbors. If 'precomputed', data is a distance matrix.
 
     Returns
     -------
     point_generalized_1nn_error: 1d np.array
     '''
-    nbrs = NearestNeighbors(n_neighbors=2, metric=metric).fit(data)
-    _, indices = nbrs.kneighbors(data)
+    indices = _without_self(_kneighbors(data, n_neighbors=2, metric=metric))
     error = []
-    for a, b in indices:
+    for a, (b,) in enumerate(indices):
         if classes[a] == classes[b]:
             error.append(0)
         else:
@@ -506,13 +719,133 @@ def generalized_1nn_error_scorer(estimator, X, y=None, metric='euclidean'):
         data = estimator.transform(X)
     else:
         data = estimator.fit_transform(X)
-    point_error = point_generalized_1nn_error(data=data,
-                                              classes=y,
-                                              metric=metric)
-    error = np.sum(point_error)/len(point_error)
+    error = cached_measure('1nn-error', generalized_1nn_error)(
+        data=data, classes=y, metric=metric)
     return -1 * error
 
 
+def point_generalized_knn_error(*, data, classes, n_neighbors=25,
+                                metric='euclidean', block_size=4096):
+    '''
+    Given data and associated classes (for each row), return a
+    (n_points, n_neighbors) array whose (i, k-1) entry is 0 if the
+    majority vote of the k nearest neighbors of row i picks its class,
+    and 1 otherwise. Ties are broken in favour of the smallest class label
+    (as in sklearn's KNeighborsClassifier).
+
+    The neighbors are queried once, for the largest k, and the votes
+    for every k are obtained from a cumulative count over the neighbors.
+
+    Parameters
+    ----------
+    data: np.array
+    classes: 1d np.array
+    n_neighbors: int
+        Largest number of neighbors to vote with
+    metric: 'precomputed' or an sklearn metric to use on the data to find
+        nearest neighbors. If 'precomputed', data is a distance matrix.
+    block_size: int
+        Number of rows to count votes for at a time
+
+    Returns
+    -------
+    point_generalized_knn_error: 2d np.array
+
+    >>> data = np.array([[0], [1], [3], [10], [12]])
+    >>> classes = np.array(['a', 'a', 'b', 'b', 'b'])
+    >>> point_generalized_knn_error(data=data, classes=classes, n_neighbors=3)
+    array([[0, 0, 1],
+           [0, 0, 1],
+           [1, 1, 1],
+           [0, 0, 0],
+           [0, 0, 0]], dtype=int8)
+    '''
+    _, codes = np.unique(np.ravel(classes), return_inverse=True)
+    n_classes = codes.max() + 1
+    indices = _kneighbors(data, n_neighbors=n_neighbors + 1, metric=metric)
+    neighbor_codes = codes[_without_self(indices)]
+    count_dtype = np.min_scalar_type(n_neighbors)
+
+    n_points = neighbor_codes.shape[0]
+    error = np.empty((n_points, n_neighbors), dtype='int8')
+    for start in range(0, n_points, block_size):
+        stop = min(start + block_size, n_points)
+        block = neighbor_codes[start:stop]
+        votes = np.zeros((stop - start, n_neighbors, n_classes),
+                         dtype=count_dtype)
+        np.put_along_axis(votes, block[:, :, np.newaxis], 1, axis=2)
+        np.cumsum(votes, axis=1, out=votes)
+        predicted = np.argmax(votes, axis=2)
+        error[start:stop] = predicted != codes[start:stop, np.newaxis]
+    return error
+
+
+def generalized_knn_error(data=None, classes=None, point_error=None,
+                          n_neighbors=25, metric='euclidean'):
+    '''
+    Given either data and associated classes (for each row), or
+    point_error, return the k-NN majority vote classifier error for
+    every k from 1 to `n_neighbors`.
+
+    Parameters
+    ----------
+    data: np.array
+    classes: 1d np.array
+    point_error: 2d np.array
+        output from point_generalized_knn_error
+    n_neighbors: int
+        Largest number of neighbors to vote with
+    metric: an sklearn metric to use on the data to find nearest neighbors
+
+    Returns
+    -------
+    generalized_knn_error: 1d np.array, where entry k-1 is the error for k
+
+    >>> data = np.array([[0], [1], [3], [10], [12]])
+    >>> classes = np.array(['a', 'a', 'b', 'b', 'b'])
+    >>> generalized_knn_error(data=data, classes=classes, n_neighbors=3)
+    array([0.2, 0.2, 0.6])
+    '''
+    if point_error is None:
+        point_error = point_generalized_knn_error(data=data,
+                                                  classes=classes,
+                                                  n_neighbors=n_neighbors,
+                                                  metric=metric)
+    return np.mean(point_error, axis=0)
+
+
+def generalized_knn_error_scorer(estimator, X, y=None, n_neighbors=25,
+                                 metric='euclidean'):
+    '''
+    Given data, X, an estimator and associated classes, y, (for each row),
+    return the error of the `n_neighbors`-NN majority vote classifier
+    in the embedding.
+
+    Note: This returns the error times -1, as scorers get used in such a
+    way that "greater is better".
+
+    Parameters
+    ----------
+    estimator: sklearn estimator with a transform/fit_transform method
+    X: np.array
+    y: 1d np.array
+    n_neighbors: int
+        Number of neighbors to vote with
+    metric: an sklearn metric to use on the data to find nearest neighbors
+
+    Returns
+    -------
+    -1 * generalized_knn_error at k=n_neighbors: (float)
+    '''
+    if getattr(estimator, "transform", None) is not None:
+        data = estimator.transform(X)
+    else:
+        data = estimator.fit_transform(X)
+    error = cached_measure('knn-error', generalized_knn_error)(
+        data=data, classes=y, n_neighbors=n_neighbors, metric=metric)
+    return -1 * error[-1]
+
+
 def make_hi_lo_scorer(func, greater_is_better=True, **kwargs):
     """Make a sklearn-style scoring function for measures taking high/low data
     representations.
@@ -551,6 +884,7 @@ def available_quality_measures():
     metric           Function
     ============     ====================================
     '1nn-error'
+    'knn-error'
     'adj-kendall-tau'
     'continuity'
     'jaccard'
@@ -566,6 +900,7 @@ def available_quality_measures():
 
 DR_MEASURES = {
     "1nn-error": generalized_1nn_error,
+    "knn-error": generalized_knn_error,
 #    "adj-kendall-tau":None,
     "continuity": continuity,
 #    "jaccard":None,
@@ -574,6 +909,9 @@ DR_MEASURES = {
     "strain": strain,
     "trustworthiness": trustworthiness,
 }
+# consult the score cache (if one is set) before computing a measure
+DR_MEASURES = {name: cached_measure(name, func)
+               for name, func in DR_MEASURES.items()}
 
 
 def available_scorers():
@@ -596,6 +934,7 @@ def available_scorers():
     metric           Function
     ============     ====================================
     '1nn-error'
+    'knn-error'
     'adj-kendall-tau'
     'continuity'
     'jaccard'
@@ -611,12 +950,16 @@ def available_scorers():
 
 DR_SCORERS = {
     "1nn-error": generalized_1nn_error_scorer,
+    "knn-error": generalized_knn_error_scorer,
 #    "adj-kendall-tau":None,
-    "continuity": make_hi_lo_scorer(continuity, greater_is_better=True),
+    "continuity": make_hi_lo_scorer(DR_MEASURES["continuity"],
+                                    greater_is_better=True),
 #    "jaccard":None,
 #    "quality":None,
-    "stress": make_hi_lo_scorer(stress, greater_is_better=False),
-    "strain": make_hi_lo_scorer(strain, greater_is_better=False),
-    "trustworthiness": make_hi_lo_scorer(trustworthiness,
+    "stress": make_hi_lo_scorer(DR_MEASURES["stress"],
+                                greater_is_better=False),
+    "strain": make_hi_lo_scorer(DR_MEASURES["strain"],
+                                greater_is_better=False),
+    "trustworthiness": make_hi_lo_scorer(DR_MEASURES["trustworthiness"],
                                          greater_is_better=True),
 }
@@ -0,0 +1,195 @@
+import functools
+import inspect
+import os
+import pathlib
+import tempfile
+
+import joblib
+import numpy as np
+
+from .data.utils import hash_array
+from .paths import interim_data_path
+from .logging import logger
+
+__all__ = [
+    'ScoreCache',
+    'cached_measure',
+    'get_score_cache',
+    'set_score_cache',
+]
+
+_SCORE_CACHE = None
+
+
+class ScoreCache:
+    def __init__(self, cache_dir=None, max_bytes=256 * 2**20):
+        """
+        On-disk cache of quality measure results.
+
+        Each result is stored in its own file, named by a hash of the
+        measure name together with all of its (bound) arguments. Arrays
+        are hashed by content, so the key covers the high and low data
+        as well as the measure parameters.
+
+        Writes are atomic (write to a temporary file, then rename), and the
+        least recently used entries are evicted once the cache grows beyond
+        `max_bytes`.
+
+        cache_dir: path (default: `interim_data_path / 'score_cache'`)
+            Directory holding the cache entries
+        max_bytes: int or None
+            Size limit for the cache. If None, the cache is unbounded
+
+        >>> cache = ScoreCache(cache_dir=tempfile.mkdtemp())
+        >>> key = cache.key('stress', high_data=[[0, 1]], low_data=[[0]])
+        >>> cache.get(key) is None
+        True
+        >>> cache.put(key, 2.0)
+        >>> cache.get(key)
+        2.0
+        >>> cache.clear()
+        >>> len(cache)
+        0
+        """
+        if cache_dir is None:
+            cache_dir = interim_data_path / 'score_cache'
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.max_bytes = max_bytes
+
+    def _entries(self):
+        if not self.cache_dir.exists():
+            return []
+        return [e for e in os.scandir(self.cache_dir)
+                if e.name.endswith('.score')]
+
+    def __len__(self):
+        return len(self._entries())
+
+    @property
+    def size(self):
+        """Total size (in bytes) of the cached entries"""
+        return sum(e.stat().st_size for e in self._entries())
+
+    def key(self, measure_name, **kwargs):
+        """Hash a measure name and its arguments into a cache key
+
+        Array arguments enter the key through their content digest
+        (see `hash_array`), so they are hashed straight from their buffers.
+        """
+        arguments = {name: ('ndarray', hash_array(value))
+                     if isinstance(value, np.ndarray) else value
+                     for name, value in kwargs.items()}
+        return joblib.hash({'measure_name': measure_name, **arguments},
+                           hash_name='sha1')
+
+    def get(self, key, default=None):
+        """Return the cached value for `key`, or `default` on a miss
+
+        An entry that cannot be loaded (e.g. truncated or corrupt) is
+        treated as a miss, and removed.
+        """
+        path = self.cache_dir / f'{key}.score'
+        try:
+            value = joblib.load(path)
+        except FileNotFoundError:
+            return default
+        except Exception as e:
+            logger.warning(f"Discarding unreadable score cache entry {path}: "
+                           f"{e}")
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            return default
+        try:
+            # mark as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return value
+
+    def put(self, key, value):
+        """Atomically store `value` under `key`, then enforce the size limit
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fo:
+                joblib.dump(value, fo)
+            os.replace(tmp_name, self.cache_dir / f'{key}.score')
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+        self.evict()
+
+    def evict(self, max_bytes=None):
+        """Remove least recently used entries until the cache fits in
+        `max_bytes` (default: the cache's own limit)
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        if max_bytes is None:
+            return
+        entries = []
+        for entry in self._entries():
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        total = sum(e[1] for e in entries)
+        for _, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            logger.debug(f"Evicted {path} from score cache")
+
+    def clear(self):
+        """Remove every cached entry"""
+        self.evict(max_bytes=0)
+
+
+def set_score_cache(cache):
+    """Set the score cache consulted by `cached_measure`
+
+    cache: ScoreCache or None
+        If None, caching is disabled
+    """
+    global _SCORE_CACHE
+    _SCORE_CACHE = cache
+
+
+def get_score_cache():
+    """Return the score cache in use, or None if caching is disabled"""
+    return _SCORE_CACHE
+
+
+def cached_measure(measure_name, func):
+    """Wrap a quality measure so that results are looked up in (and
+    added to) the current score cache.
+
+    The wrapped function keeps the signature of `func`. Arguments are
+    bound (with defaults applied) before hashing, so equivalent calls
+    share a cache entry.
+    """
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapped(*args, **kwargs):
+        cache = _SCORE_CACHE
+        if cache is None:
+            return func(*args, **kwargs)
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        key = cache.key(measure_name, **bound.arguments)
+        score = cache.get(key)
+        if score is None:
+            score = func(*args, **kwargs)
+            cache.put(key, score)
+        return score
+    wrapped.__signature__ = signature
+    return wrapped
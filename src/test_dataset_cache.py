@@ -0,0 +1,66 @@
+import os
+
+import pytest
+
+from src.data.cache import DatasetCache
+
+
+def make_entry(cache_dir, file_base, size, mtime):
+    for suffix, n_bytes in [('dataset', 10), ('data.npy', size - 10)]:
+        path = cache_dir / f'{file_base}.{suffix}'
+        path.write_bytes(b'x' * n_bytes)
+        os.utime(path, (mtime, mtime))
+
+
+@pytest.fixture
+def cache(tmp_path):
+    # three 100 byte entries, oldest first
+    for i, file_base in enumerate(['a' * 40, 'b' * 40, 'c' * 40]):
+        make_entry(tmp_path, file_base, 100, mtime=1000 + i)
+    (tmp_path / 'not-a-cache-entry.txt').write_bytes(b'x' * 1000)
+    return DatasetCache(cache_dir=tmp_path)
+
+
+def test_entries_group_files(cache):
+    entries = cache.entries()
+    assert sorted(entries) == ['a' * 40, 'b' * 40, 'c' * 40]
+    assert entries['a' * 40]['size'] == 100
+    assert len(entries['a' * 40]['files']) == 2
+    assert cache.size == 300
+
+
+def test_prune_evicts_least_recently_used(cache):
+    cache.touch('a' * 40, dataset_name='first')
+    assert cache.prune(max_bytes=200) == ['b' * 40]
+    assert cache.prune(max_bytes=100) == ['c' * 40]
+    assert list(cache.entries()) == ['a' * 40]
+    assert not any(cache.cache_dir.glob('b*.npy'))
+
+
+def test_pins_and_keep_are_never_evicted(cache):
+    cache.touch('a' * 40, dataset_name='first')
+    cache.pin('first')
+    cache.pin('b' * 40)
+    assert cache.prune(max_bytes=0, keep=['c' * 40]) == []
+    assert cache.size == 300
+    cache.unpin('first')
+    assert cache.prune(max_bytes=0) == ['c' * 40, 'a' * 40]
+    assert list(cache.entries()) == ['b' * 40]
+
+
+def test_budget_is_stored_in_index(cache):
+    assert cache.prune() == []
+    cache.set_budget(250)
+    assert DatasetCache(cache_dir=cache.cache_dir).max_bytes == 250
+    assert cache.prune() == ['a' * 40]
+
+
+def test_corrupt_index_falls_back_to_mtime(cache):
+    cache.touch('a' * 40)
+    cache.index_file.write_text('{"entries": ')
+    entries = cache.entries()
+    assert entries['a' * 40]['last_access'] == 1000
+    assert cache.prune(max_bytes=200) == ['a' * 40]
+    # the index is rewritten and usable again
+    cache.touch('b' * 40, dataset_name='second')
+    assert cache.entries()['b' * 40]['dataset_name'] == 'second'
@@ -0,0 +1,190 @@
+import json
+import os
+from functools import partial
+
+import numpy as np
+import pytest
+
+from src.data import datasets
+from src.data.cache import DatasetCache
+from src.data.datasets import read_datasets, write_datasets
+
+
+@pytest.fixture
+def dataset_file(tmp_path):
+    entries = {
+        'first': {'action': 'fetch_and_process',
+                  'load_function_name': 'new_dataset',
+                  'load_function_module': 'src.data.datasets',
+                  'load_function_args': [],
+                  'load_function_kwargs': {'dataset_name': 'first'}},
+    }
+    with open(tmp_path / 'datasets.json', 'w') as fw:
+        json.dump(entries, fw)
+    return tmp_path
+
+
+def test_read_datasets_is_parsed_once(dataset_file, monkeypatch):
+    first = read_datasets(path=dataset_file)
+    monkeypatch.setattr(datasets.json, 'load', None)
+    second = read_datasets(path=dataset_file)
+    assert first == second
+    # every call hands out an independent copy
+    second['first']['action'] = 'generate'
+    reread = read_datasets(path=dataset_file)
+    assert reread['first']['action'] == 'fetch_and_process'
+
+
+def test_load_function_is_resolved_lazily(dataset_file):
+    dset_opts = read_datasets(path=dataset_file)['first']
+    assert 'load_function' in dset_opts
+    assert dict.get(dset_opts, 'load_function') is None
+    func = dset_opts['load_function']
+    assert isinstance(func, partial)
+    assert func.func is datasets.new_dataset
+    assert func.keywords == {'dataset_name': 'first'}
+
+
+def test_write_datasets_invalidates(dataset_file):
+    ds = read_datasets(path=dataset_file)
+    ds['second'] = {'load_function': partial(datasets.new_dataset,
+                                             dataset_name='second')}
+    write_datasets(ds, path=dataset_file)
+    reread = read_datasets(path=dataset_file)
+    assert sorted(reread) == ['first', 'second']
+    assert reread['second']['load_function_name'] == 'new_dataset'
+
+
+def test_modified_file_is_reparsed(dataset_file):
+    fq_path = dataset_file / 'datasets.json'
+    read_datasets(path=dataset_file)
+    stat = os.stat(fq_path)
+    # same size, different contents: only the mtime gives it away
+    contents = fq_path.read_text().replace('first', 'third')
+    fq_path.write_text(contents)
+    os.utime(fq_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert os.stat(fq_path).st_size == stat.st_size
+    assert list(read_datasets(path=dataset_file)) == ['third']
+
+
+CALLS = []
+
+
+def process_toy(dataset_name='toy', metadata=None, target_kind='alternating'):
+    CALLS.append(dataset_name)
+    targets = {
+        'alternating': np.array(list('ab') * 20),
+        'imbalanced': np.repeat([0, 1], [32, 8]),
+        'continuous': np.linspace(0, 1, 40),
+    }
+    return {'dataset_name': dataset_name, 'metadata': metadata,
+            'data': np.arange(80.).reshape(40, 2),
+            'target': targets[target_kind]}
+
+
+@pytest.fixture
+def toy_dataset(monkeypatch):
+    raw_digests = [('toy.csv', 'sha1', 'a' * 40)]
+    dset_opts = {'action': 'fetch_and_process',
+                 'load_function': partial(process_toy, dataset_name='toy')}
+    monkeypatch.setattr(datasets, 'read_datasets', lambda: {'toy': dset_opts})
+    monkeypatch.setattr(datasets, 'fetch_and_unpack', lambda name: None)
+    monkeypatch.setattr(datasets, '_raw_file_digests',
+                        lambda opts: raw_digests)
+    CALLS.clear()
+    return raw_digests
+
+
+def test_processing_is_reused_from_the_dataset_cache(toy_dataset, tmp_path):
+    first = datasets.load_dataset('toy', cache_dir=tmp_path)
+    assert CALLS == ['toy']
+    # a variant differing only after processing doesn't reprocess
+    mapped = datasets.load_dataset('toy', cache_dir=tmp_path, map_labels=True)
+    assert CALLS == ['toy']
+    assert np.array_equal(mapped.data, first.data)
+    assert mapped.target.tolist() == [0, 1] * 20
+    # the processed arrays live only in (budgeted) dataset cache entries
+    cache = DatasetCache(cache_dir=tmp_path)
+    assert len(cache.entries()) == 2
+    assert sorted(p.name for p in tmp_path.iterdir() if p.is_dir()) == []
+
+    dset_opts = datasets.read_datasets()['toy']
+    _, key = datasets._create_dataset('toy', dset_opts, dataset_cache=cache)
+    assert CALLS == ['toy']
+    # changed raw files are reprocessed
+    toy_dataset[0] = ('toy.csv', 'sha1', 'b' * 40)
+    _, new_key = datasets._create_dataset('toy', dset_opts,
+                                          dataset_cache=cache)
+    assert new_key != key
+    assert CALLS == ['toy', 'toy']
+
+
+def test_evicted_processing_is_redone(toy_dataset, tmp_path):
+    datasets.load_dataset('toy', cache_dir=tmp_path)
+    cache = DatasetCache(cache_dir=tmp_path)
+    cache.prune(max_bytes=0)
+    assert cache.entries() == {}
+    assert cache._read_index()['sources'] == {}
+    datasets.load_dataset('toy', cache_dir=tmp_path, map_labels=True)
+    assert CALLS == ['toy', 'toy']
+
+
+def test_subsets_are_cached_separately(toy_dataset, tmp_path):
+    full = datasets.load_dataset('toy', cache_dir=tmp_path)
+    sub = datasets.load_dataset('toy', cache_dir=tmp_path, subset=slice(2, 6))
+    assert np.array_equal(sub.data, full.data[2:6])
+    assert sub.metadata['subset']['parent_data_hash'] == full.digest('data')
+    cache = DatasetCache(cache_dir=tmp_path)
+    assert len(cache.entries()) == 2
+
+    again = datasets.load_dataset('toy', cache_dir=tmp_path,
+                                  subset=slice(2, 6), mmap_mode='r')
+    assert isinstance(again.data, np.memmap)
+    assert np.array_equal(again.data, sub.data)
+    assert len(cache.entries()) == 2
+    other = datasets.load_dataset('toy', cache_dir=tmp_path, subset=[1, 3])
+    assert other.target.tolist() == ['b', 'b']
+    assert len(cache.entries()) == 3
+    assert CALLS == ['toy']
+
+
+def test_subsamples_are_nested_and_stratified(toy_dataset, tmp_path):
+    small, large = [datasets.load_dataset('toy', cache_dir=tmp_path,
+                                          target_kind='imbalanced',
+                                          subsample={'size': size, 'seed': 1})
+                    for size in [10, 20]]
+    assert np.bincount(small.target).tolist() == [8, 2]
+    assert np.bincount(large.target).tolist() == [16, 4]
+    # smaller subsamples are prefixes of larger ones
+    assert set(small.data[:, 0]) <= set(large.data[:, 0])
+    assert np.all(np.diff(large.data[:, 0]) > 0)
+    assert small.metadata['subsample'] == {'size': 10, 'stratify': True,
+                                           'seed': 1}
+
+    same = datasets.load_dataset('toy', cache_dir=tmp_path, subsample=10,
+                                 target_kind='imbalanced')
+    assert len(DatasetCache(cache_dir=tmp_path).entries()) == 4
+    assert CALLS == ['toy']
+    assert same.n_points == 10
+    with pytest.raises(Exception):
+        datasets.load_dataset('toy', cache_dir=tmp_path, subsample=41)
+
+
+def test_continuous_targets_are_not_stratified(toy_dataset, tmp_path,
+                                               monkeypatch):
+    seen = []
+    order = datasets.nested_subsample_order
+
+    def spy(n_points, labels=None, random_state=0):
+        seen.append(labels)
+        return order(n_points, labels=labels, random_state=random_state)
+    monkeypatch.setattr(datasets, 'nested_subsample_order', spy)
+
+    datasets.load_dataset('toy', cache_dir=tmp_path, target_kind='continuous',
+                          subsample=8)
+    datasets.load_dataset('toy', cache_dir=tmp_path, target_kind='imbalanced',
+                          subsample=8)
+    assert seen[0] is None
+    assert seen[1] is not None
+    assert datasets._is_categorical(np.array(['a']))
+    assert not datasets._is_categorical(np.linspace(0, 1, 3))
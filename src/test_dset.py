@@ -0,0 +1,168 @@
+import joblib
+import numpy as np
+import pytest
+
+from src.data import Dataset
+
+
+@pytest.fixture
+def dset():
+    generator = np.random.RandomState(0)
+    return Dataset(dataset_name='round-trip',
+                   data=generator.rand(50, 3),
+                   target=generator.randint(4, size=50),
+                   metadata={'descr': 'test data'})
+
+
+def test_npy_round_trip(dset, tmp_path):
+    dset.dump(data_path=tmp_path)
+    assert (tmp_path / 'round-trip.data.npy').exists()
+    assert (tmp_path / 'round-trip.target.npy').exists()
+    loaded = Dataset.load('round-trip', data_path=tmp_path)
+    assert not isinstance(loaded.data, np.memmap)
+    assert np.array_equal(loaded.data, dset.data)
+    assert np.array_equal(loaded.target, dset.target)
+    assert loaded.metadata['descr'] == 'test data'
+    # digests written by dump are reused, and agree with the data
+    copy = Dataset('copy', data=dset.data)
+    assert loaded.digest('data') == copy.digest('data')
+
+
+@pytest.mark.parametrize('mmap_mode', ['r', 'c'])
+def test_npy_mmap_round_trip(dset, tmp_path, mmap_mode):
+    dset.dump(data_path=tmp_path)
+    loaded = Dataset.load('round-trip', data_path=tmp_path,
+                          mmap_mode=mmap_mode)
+    assert isinstance(loaded.data, np.memmap)
+    assert loaded.data.mode == mmap_mode
+    assert np.array_equal(loaded.data, dset.data)
+    assert np.array_equal(loaded.target, dset.target)
+
+
+def test_redump_keeps_existing_maps_valid(dset, tmp_path):
+    dset.dump(data_path=tmp_path)
+    mapped = Dataset.load('round-trip', data_path=tmp_path, mmap_mode='r')
+    changed = Dataset('round-trip', data=dset.data + 1, target=dset.target)
+    changed.dump(data_path=tmp_path)
+    assert np.array_equal(mapped.data, dset.data)
+    reloaded = Dataset.load('round-trip', data_path=tmp_path, mmap_mode='r')
+    assert np.array_equal(reloaded.data, dset.data + 1)
+
+
+def test_joblib_round_trip(dset, tmp_path):
+    dset.dump(data_path=tmp_path, storage='joblib')
+    assert not (tmp_path / 'round-trip.data.npy').exists()
+    loaded = Dataset.load('round-trip', data_path=tmp_path, mmap_mode='r')
+    assert isinstance(joblib.load(tmp_path / 'round-trip.dataset'), Dataset)
+    assert np.array_equal(loaded.data, dset.data)
+    assert np.array_equal(loaded.target, dset.target)
+
+
+@pytest.mark.parametrize('storage', ['npy', 'joblib'])
+def test_metadata_file_has_digests(dset, tmp_path, storage):
+    dset.dump(data_path=tmp_path, storage=storage)
+    sidecar = joblib.load(tmp_path / 'round-trip.metadata')
+    pickled = Dataset.load('round-trip', data_path=tmp_path).metadata
+    for key in ['data_hash', 'target_hash', 'hash_type', 'hash_format']:
+        assert sidecar[key] == pickled[key]
+
+
+@pytest.fixture
+def big_metadata(dset):
+    from src.data.dset import _LAZY_METADATA_BYTES
+    n_rows = _LAZY_METADATA_BYTES // (8 * 50) + 1
+    coords = np.arange(n_rows * 50, dtype=np.float64).reshape(50, n_rows)
+    dset.metadata['coords'] = coords
+    dset.metadata['small'] = np.arange(3)
+    return dset
+
+
+def test_large_metadata_arrays_are_split(big_metadata, tmp_path):
+    big_metadata.dump(data_path=tmp_path)
+    assert (tmp_path / 'round-trip.metadata.coords.npy').exists()
+    assert not (tmp_path / 'round-trip.metadata.small.npy').exists()
+    meta = Dataset.load('round-trip', data_path=tmp_path, metadata_only=True)
+    assert not meta.is_loaded('coords')
+    assert np.array_equal(meta['coords'], big_metadata.metadata['coords'])
+
+
+def test_lazy_placeholders_resolve(big_metadata, tmp_path):
+    big_metadata.dump(data_path=tmp_path)
+    lazy = Dataset.load('round-trip', data_path=tmp_path, lazy=True,
+                        mmap_mode='r')
+    assert not lazy.is_loaded('data')
+    assert not lazy.metadata.is_loaded('coords')
+    assert 'data.shape=(50, 3)' in str(lazy)
+    assert lazy.metadata['small'].tolist() == [0, 1, 2]
+    assert isinstance(lazy.data, np.memmap)
+    assert lazy.is_loaded('data')
+    assert np.array_equal(lazy.data, big_metadata.data)
+    assert np.array_equal(lazy.metadata['coords'],
+                          big_metadata.metadata['coords'])
+    assert lazy.metadata.is_loaded('coords')
+
+
+def test_lazy_dataset_dumps_with_joblib(big_metadata, tmp_path):
+    big_metadata.dump(data_path=tmp_path / 'npy')
+    lazy = Dataset.load('round-trip', data_path=tmp_path / 'npy', lazy=True)
+    lazy.dump(data_path=tmp_path / 'joblib', storage='joblib')
+    loaded = Dataset.load('round-trip', data_path=tmp_path / 'joblib')
+    assert np.array_equal(loaded.data, big_metadata.data)
+    assert np.array_equal(loaded.metadata['coords'],
+                          big_metadata.metadata['coords'])
+    meta = Dataset.load('round-trip', data_path=tmp_path / 'joblib',
+                        metadata_only=True)
+    assert np.array_equal(meta['coords'], big_metadata.metadata['coords'])
+
+
+def test_subset_is_view_backed(dset, tmp_path):
+    dset.metadata['filenames'] = np.array([f'{i}.png' for i in range(50)])
+    dset.dump(data_path=tmp_path)
+    parent = Dataset.load('round-trip', data_path=tmp_path, mmap_mode='r')
+
+    sub = parent.subset(slice(10, 20))
+    assert np.shares_memory(sub.data, parent.data)
+    assert np.array_equal(sub.target, dset.target[10:20])
+    assert sub.metadata['filenames'].tolist()[0] == '10.png'
+    assert 'data_hash' not in sub.metadata
+    assert sub.metadata['subset']['slice'] == (10, 20, 1)
+    assert sub.metadata['subset']['parent_data_hash'] == parent.digest('data')
+
+    # indices in a regular progression are views too
+    stepped = parent.subset([0, 5, 10, 15])
+    assert np.shares_memory(stepped.data, parent.data)
+    assert stepped.metadata['subset']['slice'] == (0, 16, 5)
+
+    # other selections are gathered on first access
+    gathered = parent.subset([3, 1, 4])
+    assert not gathered.is_loaded('data')
+    assert gathered.n_points == 3
+    assert np.array_equal(gathered.data, dset.data[[3, 1, 4]])
+    assert gathered.is_loaded('data')
+
+
+def test_subset_provenance(dset):
+    sub = dset.subset(dset.target == 0, dataset_name='zeros')
+    assert sub.name == 'zeros'
+    assert (sub.target == 0).all()
+    same = dset.subset(np.flatnonzero(dset.target == 0))
+    assert (same.metadata['subset']['index_hash']
+            == sub.metadata['subset']['index_hash'])
+    nested = sub.subset(slice(0, 2))
+    assert nested.metadata['subset']['parent_subset'] == sub.metadata['subset']
+    with pytest.raises(Exception):
+        dset.subset([50])
+    with pytest.raises(Exception):
+        dset.subset(np.ones(3, dtype=bool))
+
+
+def test_subset_dumped_over_its_parent(dset, tmp_path):
+    dset.dump(data_path=tmp_path)
+    parent = Dataset.load('round-trip', data_path=tmp_path, mmap_mode='r')
+    parent.subset(slice(0, 3)).dump(data_path=tmp_path, file_base='round-trip')
+    # the parent's maps still see the old files
+    assert parent.data.shape == (50, 3)
+    reloaded = Dataset.load('round-trip', data_path=tmp_path)
+    assert np.array_equal(reloaded.data, dset.data[:3])
+    assert np.array_equal(reloaded.target, dset.target[:3])
+    assert reloaded.metadata['subset']['n_points'] == 3
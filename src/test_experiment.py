@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+from sklearn.decomposition import PCA
+
+from src.data import Dataset
+from src.data.experiment import run_algorithm
+
+
+@pytest.fixture
+def dset():
+    generator = np.random.RandomState(0)
+    return Dataset(dataset_name='points', data=generator.rand(30, 4),
+                   target=generator.randint(2, size=30))
+
+
+def test_experiment_is_cached(dset, tmp_path):
+    first = run_algorithm(dset, PCA(2), data_path=tmp_path)
+    assert first.metadata['experiment']['hash_format'] == 'raw'
+    second = run_algorithm(dset, PCA(2), data_path=tmp_path)
+    assert second.metadata['experiment']['start_time'] == \
+        first.metadata['experiment']['start_time']
+    with pytest.raises(Exception):
+        run_algorithm(dset, PCA(3), data_path=tmp_path, file_base=first.name)
+
+
+def test_old_format_experiment_is_rerun(dset, tmp_path):
+    first = run_algorithm(dset, PCA(2), data_path=tmp_path)
+    # as written before hashes were computed from array buffers
+    old = Dataset.load(first.name, data_path=tmp_path)
+    experiment = old.metadata['experiment']
+    del experiment['hash_format']
+    experiment['data_hash'] = 'joblib-style-hash'
+    old.dump(file_base=first.name, data_path=tmp_path)
+    assert 'hash_format' not in Dataset.load(
+        first.name, data_path=tmp_path, metadata_only=True)['experiment']
+
+    rerun = run_algorithm(dset, PCA(2), data_path=tmp_path)
+    assert rerun.metadata['experiment']['hash_format'] == 'raw'
+    assert rerun.metadata['experiment']['data_hash'] == dset.digest('data')
+    cached = Dataset.load(first.name, data_path=tmp_path, metadata_only=True)
+    assert cached['experiment']['data_hash'] == dset.digest('data')
@@ -0,0 +1,529 @@
+import base64
+import gzip
+import hashlib
+import http.server
+import io
+import pathlib
+import tarfile
+import threading
+import time
+
+import pytest
+
+from src.data import fetch, mirror
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    """Serve the byte strings in `server.files`, keyed by path
+
+    If `server.accept_ranges` is set, `Range: bytes=N-` requests are
+    honoured. If `server.truncate_after` is set, the next response is
+    cut off after that many bytes.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        self.server.ranges.append(self.headers.get('Range'))
+        body = self.server.files.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        time.sleep(self.server.delay)
+        etag = f'"{sha1(body)}"'
+        byte_range = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        start = 0
+        if (self.server.accept_ranges and byte_range is not None
+                and if_range in (None, etag)):
+            start = int(byte_range[len('bytes='):].split('-')[0])
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(body)}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             f'bytes {start}-{len(body) - 1}/{len(body)}')
+        else:
+            self.send_response(200)
+        if self.server.accept_ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body) - start))
+        self.end_headers()
+        payload = body[start:]
+        if self.server.truncate_after is not None:
+            payload = payload[:self.server.truncate_after]
+            self.server.truncate_after = None
+            self.close_connection = True
+        self.wfile.write(payload)
+
+
+@pytest.fixture(autouse=True)
+def no_raw_mirror(monkeypatch):
+    monkeypatch.setattr(mirror, '_RAW_MIRROR', None)
+
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    httpd.files = {}
+    httpd.requests = []
+    httpd.ranges = []
+    httpd.delay = 0
+    httpd.accept_ranges = False
+    httpd.truncate_after = None
+    httpd.url = f'http://127.0.0.1:{httpd.server_address[1]}'
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def sha1(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def test_fetch_file_streams_to_disk(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(fetch, '_CHUNK_SIZE', 1000)
+    body = bytes(range(256)) * 100
+    server.files['/data.bin'] = body
+
+    status, filename, hashval = fetch.fetch_file(
+        url=f'{server.url}/data.bin', dst_dir=tmp_path, hash_value=sha1(body))
+    assert status == 200
+    assert filename.read_bytes() == body
+    assert hashval == sha1(body)
+    # no temporary files are left behind
+    assert sorted(p.name for p in tmp_path.iterdir()) == \
+        ['.file_hashes.json', 'data.bin']
+
+    # existing file with a valid hash is not downloaded again
+    status, _, _ = fetch.fetch_file(
+        url=f'{server.url}/data.bin', dst_dir=tmp_path, hash_value=sha1(body))
+    assert status is True
+    assert server.requests == ['/data.bin']
+
+
+def test_fetch_file_bad_hash(server, tmp_path):
+    server.files['/data.bin'] = b'not what we expected'
+    status, filename, hashval = fetch.fetch_file(
+        url=f'{server.url}/data.bin', dst_dir=tmp_path, hash_value=sha1(b''))
+    assert status is False
+    assert hashval == sha1(b'not what we expected')
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_fetch_file_http_error(server, tmp_path):
+    status, err, _ = fetch.fetch_file(url=f'{server.url}/missing.bin',
+                                      dst_dir=tmp_path)
+    assert status is False
+    assert '404' in str(err)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_fetch_files_concurrent(server, tmp_path):
+    server.delay = 0.5
+    url_list = []
+    for i in range(4):
+        body = f'file {i}'.encode() * 1000
+        server.files[f'/file{i}.txt'] = body
+        url_list.append({'url': f'{server.url}/file{i}.txt',
+                         'hash_type': 'sha1', 'hash_value': sha1(body)})
+
+    start = time.time()
+    status, results = fetch.fetch_files(url_list=url_list, dst_dir=tmp_path,
+                                        n_workers=4)
+    elapsed = time.time() - start
+    assert status
+    # results come back in url_list order
+    assert [r[1].name for r in results] == [f'file{i}.txt' for i in range(4)]
+    assert [r[2] for r in results] == [u['hash_value'] for u in url_list]
+    # four half-second downloads ran side by side, not one after another
+    assert elapsed < 1.5
+
+
+def test_fetch_file_resumes_interrupted_download(server, tmp_path,
+                                                 monkeypatch):
+    monkeypatch.setattr(fetch, '_CHUNK_SIZE', 1000)
+    body = bytes(range(256)) * 400
+    server.files['/big.bin'] = body
+    server.accept_ranges = True
+    server.truncate_after = 30000
+
+    status, filename, hashval = fetch.fetch_file(
+        url=f'{server.url}/big.bin', dst_dir=tmp_path, hash_value=sha1(body))
+    assert status == 206
+    assert hashval == sha1(body)
+    assert filename.read_bytes() == body
+    assert server.ranges == [None, 'bytes=30000-']
+    assert sorted(p.name for p in tmp_path.iterdir()) == \
+        ['.file_hashes.json', 'big.bin']
+
+
+def test_partial_download_survives_between_calls(server, tmp_path,
+                                                 monkeypatch):
+    monkeypatch.setattr(fetch, '_CHUNK_SIZE', 1000)
+    monkeypatch.setattr(fetch, '_FETCH_RETRIES', 0)
+    body = bytes(range(256)) * 400
+    server.files['/big.bin'] = body
+    server.accept_ranges = True
+    server.truncate_after = 50000
+
+    with pytest.raises(fetch.requests.exceptions.RequestException):
+        fetch.fetch_file(url=f'{server.url}/big.bin', dst_dir=tmp_path,
+                         hash_value=sha1(body))
+    assert not (tmp_path / 'big.bin').exists()
+    assert (tmp_path / 'big.bin.part').stat().st_size == 50000
+
+    status, filename, hashval = fetch.fetch_file(
+        url=f'{server.url}/big.bin', dst_dir=tmp_path, hash_value=sha1(body))
+    assert status == 206
+    assert filename.read_bytes() == body
+    assert server.ranges == [None, 'bytes=50000-']
+
+
+def test_resume_without_range_support(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(fetch, '_CHUNK_SIZE', 1000)
+    body = bytes(range(256)) * 100
+    server.files['/big.bin'] = body
+    server.truncate_after = 10000
+
+    status, filename, hashval = fetch.fetch_file(
+        url=f'{server.url}/big.bin', dst_dir=tmp_path, hash_value=sha1(body))
+    assert status == 200
+    assert filename.read_bytes() == body
+    assert server.ranges == [None, 'bytes=10000-']
+
+
+def test_truncated_raw_file_is_completed(server, tmp_path):
+    body = bytes(range(256)) * 100
+    server.files['/big.bin'] = body
+    server.accept_ranges = True
+    (tmp_path / 'big.bin').write_bytes(body[:20000])
+
+    status, filename, hashval = fetch.fetch_file(
+        url=f'{server.url}/big.bin', dst_dir=tmp_path, hash_value=sha1(body))
+    assert status == 206
+    assert filename.read_bytes() == body
+    assert server.ranges == ['bytes=20000-']
+
+
+def test_corrupt_raw_file_is_refetched(server, tmp_path):
+    body = bytes(range(256)) * 100
+    server.files['/big.bin'] = body
+    server.accept_ranges = True
+    (tmp_path / 'big.bin').write_bytes(b'x' * len(body))
+
+    status, filename, hashval = fetch.fetch_file(
+        url=f'{server.url}/big.bin', dst_dir=tmp_path, hash_value=sha1(body))
+    assert status == 200
+    assert filename.read_bytes() == body
+    assert server.ranges == [f'bytes={len(body)}-', None]
+    assert sorted(p.name for p in tmp_path.iterdir()) == \
+        ['.file_hashes.json', 'big.bin']
+
+
+def leave_partial_download(tmp_path, url, data):
+    (tmp_path / 'big.bin.part').write_bytes(data)
+    (tmp_path / 'big.bin.part.json').write_text(f'{{"url": "{url}"}}')
+
+
+def test_complete_partial_download_is_finished(server, tmp_path):
+    body = bytes(range(256)) * 100
+    server.files['/big.bin'] = body
+    server.accept_ranges = True
+    url = f'{server.url}/big.bin'
+    leave_partial_download(tmp_path, url, body)
+
+    # no hash to check: the size reported with the 416 confirms it
+    status, filename, hashval = fetch.fetch_file(url=url, dst_dir=tmp_path)
+    assert status == 200
+    assert hashval == sha1(body)
+    assert filename.read_bytes() == body
+    assert server.ranges == [f'bytes={len(body)}-']
+    assert sorted(p.name for p in tmp_path.iterdir()) == \
+        ['.file_hashes.json', 'big.bin']
+
+    # with a matching hash, the server is not asked at all
+    filename.unlink()
+    leave_partial_download(tmp_path, url, body)
+    status, filename, hashval = fetch.fetch_file(url=url, dst_dir=tmp_path,
+                                                 hash_value=sha1(body))
+    assert status == 200
+    assert filename.read_bytes() == body
+    assert len(server.ranges) == 1
+
+
+def test_overlong_partial_download_is_restarted(server, tmp_path):
+    body = bytes(range(256)) * 100
+    server.files['/big.bin'] = body
+    server.accept_ranges = True
+    url = f'{server.url}/big.bin'
+    leave_partial_download(tmp_path, url, body + b'stale')
+
+    status, filename, hashval = fetch.fetch_file(url=url, dst_dir=tmp_path)
+    assert status == 200
+    assert filename.read_bytes() == body
+    assert server.ranges == [f'bytes={len(body) + 5}-', None]
+
+
+def test_hash_index(tmp_path, monkeypatch):
+    calls = []
+    hash_file = fetch.hash_file
+
+    def counting_hash_file(fname, **kwargs):
+        calls.append(pathlib.Path(fname).name)
+        return hash_file(fname, **kwargs)
+    monkeypatch.setattr(fetch, 'hash_file', counting_hash_file)
+
+    files = []
+    for i in range(5):
+        files.append(tmp_path / f'file{i}.bin')
+        files[-1].write_bytes(f'contents {i}'.encode() * 1000)
+    expected = [sha1(f.read_bytes()) for f in files]
+
+    assert fetch.hash_files(files, n_workers=3) == expected
+    assert sorted(calls) == [f.name for f in files]
+    # unchanged files are not reread
+    assert fetch.hash_files(files) == expected
+    assert fetch.cached_hash_file(files[0]) == expected[0]
+    assert len(calls) == 5
+    # a different algorithm, or a modified file, is
+    md5 = hashlib.md5(files[0].read_bytes()).hexdigest()
+    assert fetch.cached_hash_file(files[0], algorithm='md5') == md5
+    files[1].write_bytes(b'new contents')
+    assert fetch.cached_hash_file(files[1]) == sha1(b'new contents')
+    assert calls[5:] == ['file0.bin', 'file1.bin']
+    assert fetch.cached_hash_file(files[0], algorithm='md5') == md5
+    assert len(calls) == 7
+
+
+def test_downloads_are_indexed(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(fetch, 'hash_file', None)
+    body = b'some data' * 1000
+    server.files['/data.bin'] = body
+    for _ in range(2):
+        status, filename, hashval = fetch.fetch_file(
+            url=f'{server.url}/data.bin', dst_dir=tmp_path,
+            hash_value=sha1(body))
+        assert status
+    # downloaded once; the digest was recorded while downloading
+    assert server.requests == ['/data.bin']
+
+
+# `compress` output for bytes(range(256)) * 3. Long enough for the code
+# width to grow from 9 to 10 bits
+COMPRESSED_Z = base64.b64decode("""
+H52QAAIIGECggIEDCBIoWMCggYMHECJImEChgoULGDJo2MChg4cPIEKIGEGihIkT
+KFKoWMGihYsXMGLImEGjho0bOHLo2MGjh48fQIIIGUKkiJEjSJIoWcKkiZMnUKJI
+mUKlipUrWLJo2cKli5cvYMKIGUOmjJkzaNKoWcOmjZs3cOLImUOnjp07ePLo2cOn
+j58/gAIJGkSokKFDiBIpWsSokaNHkCJJmkSpkqVLmDJp2sSpk6dPoEKJGkWqlKlT
+qFKpWsWqlatXsGLJmkWrlq1buHLp2sWrl69fwIIJG0asmLFjyJIpW8asmbNn0KJJ
+m0atmrVr2LJp28atm7dv4MKJG0eunLlz6NKpW8eunbt38OLJm0evnr17+PLp28ev
+n79/AQ1U0EEJLdTQQxFNVNFFGW3U0UchjVTSSSmt1NJLMc1U00057dTTT0ENVdRR
+SS3V1FNRTVXVVVlt1dVXYY1V1llprdXWW3HNVdddee3V11+BDVbYYYkt1thjkU1W
+2WWZbdbZZ6GNVtppqa3W2muxzVbbbbnt1ttvwQ1X3HHJLdfcc9FNV9112W3X3Xfh
+jVfeeemt19578c1X33357dfffwESZBBCCjHkEEQSUWQRRhpx5BFIIpFkEkoqseQS
+TDLRZBNOOvHkE1BCEWUUUkox5RRUUlFlFVZaceUVWGKRZRZaarHlFlxy0WUXXnrx
+5RdgghFmGGKKMeYYZJJRZhlmmnHmGWiikWYaaqqx5hpsstFmG2668eYbcMIRZxxy
+yjHnHHTSUWcddtpx5x144pFnHnrqsecefPLRZx9++vHn3z8=""")
+
+
+# The same, from `compress -b9`: once its table is full, codes are written
+# 10 bits wide
+COMPRESSED_Z_9BIT = base64.b64decode("""
+H52JAAIIGECggIEDCBIoWMCggYMHECJImEChgoULGDJo2MChg4cPIEKIGEGihIkT
+KFKoWMGihYsXMGLImEGjho0bOHLo2MGjh48fQIIIGUKkiJEjSJIoWcKkiZMnUKJI
+mUKlipUrWLJo2cKli5cvYMKIGUOmjJkzaNKoWcOmjZs3cOLImUOnjp07ePLo2cOn
+j58/gAIJGkSokKFDiBIpWsSokaNHkCJJmkSpkqVLmDJp2sSpk6dPoEKJGkWqlKlT
+qFKpWsWqlatXsGLJmkWrlq1buHLp2sWrl69fwIIJG0asmLFjyJIpW8asmbNn0KJJ
+m0atmrVr2LJp28atm7dv4MKJG0eunLlz6NKpW8eunbt38OLJm0evnr17+PLp28ev
+n79/AQ1U0EEJLdTQQxFNVNFFGW3U0UchjVTSSSmt1NJLMc1U00057dTTT0ENVdRR
+SS3V1FNRTVXVVVlt1dVXYY1V1llprdXWW3HNVdddee3V11+BDVbYYYkt1thjkU1W
+2WWZbdbZZ6GNVtppqa3W2muxzVbbbbnt1ttvwQ1X3HHJLdfcc9FNV9112W3X3Xfh
+jVfeeemt19578c1X33357dfffwENVNBBCS3U0EMRTVTRRRlt1NFHIY1U0kkprdTS
+SzHNVNNNOe3U009BDVXUUUkt1dRTUU1V1VVZbdXVV2GNVdZZaa3V1ltxzVXXXXnt
+1ddfgQ1W2GGJLdbYY5FNVtllmW3W2WehjVbaaamt1tprsc1W22257dbbb8ENV9xx
+yS3X3HPRTVfdddlt19134Y1X3nnprdfee/HNV999+e3X338=""")
+
+
+@pytest.mark.parametrize('compressed', [
+    COMPRESSED_Z,
+    COMPRESSED_Z[:2] + bytes([0x8c]) + COMPRESSED_Z[3:],  # compress -b12
+    COMPRESSED_Z_9BIT,
+])
+def test_lzw_decompress(compressed):
+    out = io.BytesIO()
+    fetch._lzw_decompress(io.BytesIO(compressed), out)
+    assert out.getvalue() == bytes(range(256)) * 3
+
+
+def test_unpack_Z_leaves_raw_file(tmp_path):
+    raw = tmp_path / 'raw'
+    raw.mkdir()
+    (raw / 'data.txt.Z').write_bytes(COMPRESSED_Z)
+    files = fetch.unpack(raw / 'data.txt.Z', dst_dir=tmp_path / 'interim')
+    assert files == {'data.txt': 768}
+    assert (tmp_path / 'interim' / 'data.txt').read_bytes() == \
+        bytes(range(256)) * 3
+    assert (raw / 'data.txt.Z').read_bytes() == COMPRESSED_Z
+
+
+def make_tarball(path, members):
+    with tarfile.open(path, 'w:gz') as tar:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+
+def test_unpack_is_idempotent(tmp_path, monkeypatch):
+    dst_dir = tmp_path / 'interim'
+    archive = tmp_path / 'archive.tar.gz'
+    make_tarball(archive, {'a/one.txt': b'1' * 100, 'two.txt': b'2' * 200})
+
+    assert fetch.unpack(archive, dst_dir=dst_dir) == \
+        {'a/one.txt': 100, 'two.txt': 200}
+    assert (dst_dir / 'a' / 'one.txt').read_bytes() == b'1' * 100
+
+    opened = []
+    tar_open = tarfile.open
+
+    def counting_open(name, mode='r', *args, **kwargs):
+        if mode.startswith('r'):
+            opened.append(name)
+        return tar_open(name, mode, *args, **kwargs)
+    monkeypatch.setattr(fetch.tarfile, 'open', counting_open)
+
+    fetch.unpack(archive, dst_dir=dst_dir)
+    assert opened == []
+    # a damaged output is noticed, and the archive unpacked again
+    (dst_dir / 'two.txt').write_bytes(b'2')
+    fetch.unpack(archive, dst_dir=dst_dir)
+    assert len(opened) == 1
+    assert (dst_dir / 'two.txt').read_bytes() == b'2' * 200
+    # as is a changed archive
+    make_tarball(archive, {'two.txt': b'3' * 300})
+    assert fetch.unpack(archive, dst_dir=dst_dir) == {'two.txt': 300}
+    assert len(opened) == 2
+    fetch.unpack(archive, dst_dir=dst_dir, force=True)
+    assert len(opened) == 3
+
+
+def test_unpack_files(tmp_path):
+    dst_dir = tmp_path / 'interim'
+    file_list = []
+    for i in range(4):
+        file_list.append(tmp_path / f'part{i}.gz')
+        file_list[-1].write_bytes(gzip.compress(f'part {i}'.encode() * 1000))
+    results = fetch.unpack_files(file_list, dst_dir=dst_dir, n_workers=4)
+    assert results == [{f'part{i}': 6000} for i in range(4)]
+    manifest = fetch._read_json(dst_dir / fetch._UNPACK_MANIFEST)
+    assert sorted(manifest) == [f'part{i}.gz' for i in range(4)]
+
+
+def test_raw_mirror(server, tmp_path):
+    body = b'mirrored data' * 1000
+    server.files['/data.bin'] = body
+    raw_mirror = mirror.RawMirror(tmp_path / 'mirror')
+    mirror.set_raw_mirror(raw_mirror)
+
+    # a miss fills the mirror
+    status, filename, _ = fetch.fetch_file(url=f'{server.url}/data.bin',
+                                           dst_dir=tmp_path / 'raw1',
+                                           hash_value=sha1(body))
+    assert status == 200
+    assert f'sha1:{sha1(body)}' in raw_mirror
+
+    # another checkout gets it (hardlinked) from the mirror
+    status, filename, hashval = fetch.fetch_file(url=f'{server.url}/data.bin',
+                                                 dst_dir=tmp_path / 'raw2',
+                                                 hash_value=sha1(body))
+    assert status is True
+    assert hashval == sha1(body)
+    assert filename.read_bytes() == body
+    assert filename.stat().st_ino == \
+        raw_mirror.path('sha1', sha1(body)).stat().st_ino
+    assert server.requests == ['/data.bin']
+
+    # existing raw files are added to the mirror too
+    (tmp_path / 'raw3').mkdir()
+    (tmp_path / 'raw3' / 'other.bin').write_bytes(b'other')
+    fetch.fetch_file(file_name='other.bin', dst_dir=tmp_path / 'raw3',
+                     hash_value=sha1(b'other'))
+    assert len(raw_mirror) == 2
+
+    time.sleep(0.01)
+    raw_mirror.get('sha1', sha1(body), tmp_path / 'copy.bin')
+    assert raw_mirror.prune(max_bytes=len(body)) == [f'sha1:{sha1(b"other")}']
+    assert raw_mirror.size == len(body)
+
+
+def test_raw_mirror_entries_owned_by_others(tmp_path, monkeypatch):
+    raw_mirror = mirror.RawMirror(tmp_path / 'mirror')
+    for name in ['old', 'new']:
+        (tmp_path / name).write_bytes(name.encode() * 100)
+        raw_mirror.put('sha1', name, tmp_path / name)
+        time.sleep(0.01)
+
+    def not_owner(path, mode):
+        raise PermissionError(1, 'Operation not permitted', str(path))
+    monkeypatch.setattr(mirror.os, 'chmod', not_owner)
+
+    # the access is recorded beside the entry instead
+    assert raw_mirror.get('sha1', 'old', tmp_path / 'copy')
+    raw_mirror.put('sha1', 'old', tmp_path / 'old')
+    assert mirror._used_marker(raw_mirror.path('sha1', 'old')).exists()
+    assert len(raw_mirror) == 2
+    assert raw_mirror.prune(max_bytes=300) == ['sha1:new']
+    assert raw_mirror.prune(max_bytes=0) == ['sha1:old']
+    assert list((tmp_path / 'mirror' / 'sha1').iterdir()) == []
+
+
+def test_corrupt_raw_mirror_entry_is_evicted(server, tmp_path):
+    body = b'mirrored data' * 1000
+    server.files['/data.bin'] = body
+    raw_mirror = mirror.RawMirror(tmp_path / 'mirror')
+    mirror.set_raw_mirror(raw_mirror)
+    (tmp_path / 'bad.bin').write_bytes(b'corrupt')
+    raw_mirror.put('sha1', sha1(body), tmp_path / 'bad.bin')
+
+    status, filename, hashval = fetch.fetch_file(url=f'{server.url}/data.bin',
+                                                 dst_dir=tmp_path / 'raw',
+                                                 hash_value=sha1(body))
+    assert status == 200
+    assert filename.read_bytes() == body
+    assert server.requests == ['/data.bin']
+    assert fetch.cached_hash_file(filename) == sha1(body)
+    # the good download replaced the bad entry
+    assert raw_mirror.path('sha1', sha1(body)).read_bytes() == body
+    assert (tmp_path / 'bad.bin').read_bytes() == b'corrupt'
+
+
+def test_resuming_a_mirrored_file_leaves_the_mirror_alone(server, tmp_path):
+    body = bytes(range(256)) * 100
+    old = body[:20000]
+    server.files['/big.bin'] = body
+    server.accept_ranges = True
+    raw_mirror = mirror.RawMirror(tmp_path / 'mirror')
+    mirror.set_raw_mirror(raw_mirror)
+    (tmp_path / 'old.bin').write_bytes(old)
+    raw_mirror.put('sha1', sha1(old), tmp_path / 'old.bin')
+    (tmp_path / 'raw').mkdir()
+    assert raw_mirror.get('sha1', sha1(old), tmp_path / 'raw' / 'big.bin')
+
+    # the file has since grown upstream
+    status, filename, hashval = fetch.fetch_file(
+        url=f'{server.url}/big.bin', dst_dir=tmp_path / 'raw',
+        hash_value=sha1(body))
+    assert status == 206
+    assert filename.read_bytes() == body
+    assert server.ranges == ['bytes=20000-']
+    assert raw_mirror.path('sha1', sha1(old)).read_bytes() == old
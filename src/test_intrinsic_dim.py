@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from src.data import Dataset
+from src.data.intrinsic_dim import (estimate_intrinsic_dimension,
+                                    knn_distances, mle_intrinsic_dimension,
+                                    order_n_components,
+                                    twonn_intrinsic_dimension)
+
+
+@pytest.fixture
+def plane():
+    """A 2-dimensional plane, randomly embedded in 5 dimensions"""
+    generator = np.random.RandomState(0)
+    coords = generator.rand(2000, 2)
+    embedding, _ = np.linalg.qr(generator.randn(5, 2))
+    return coords @ embedding.T
+
+
+@pytest.mark.parametrize('estimator', [mle_intrinsic_dimension,
+                                       twonn_intrinsic_dimension])
+def test_estimators_recover_plane_dimension(plane, estimator):
+    distances = knn_distances(plane, n_neighbors=10, block_size=256)
+    assert distances.shape == (2000, 10)
+    assert np.all(np.diff(distances, axis=1) >= 0)
+    assert abs(estimator(distances, n_neighbors=10) - 2) < 0.25
+
+
+@pytest.mark.parametrize('estimator', [mle_intrinsic_dimension,
+                                       twonn_intrinsic_dimension])
+def test_estimators_ignore_repeated_points(plane, estimator):
+    repeated = np.vstack([plane, plane[:200], plane[:50]])
+    distances = knn_distances(repeated, n_neighbors=10)
+    assert np.any(distances[:, 1] == 0)
+    assert abs(estimator(distances, n_neighbors=10) - 2) < 0.25
+    # rows are dropped wherever their zero distances are
+    distances = distances[distances[:, 0] > 0]
+    with_zeros = np.vstack([distances, distances[:10]])
+    with_zeros[-10:, 1:] = 0
+    assert estimator(with_zeros, n_neighbors=10) == \
+        estimator(distances, n_neighbors=10)
+
+
+def test_order_n_components():
+    assert order_n_components([16, 2, 8, 3], 2.5) == [2, 3, 8, 16]
+    assert order_n_components([16, 2, 8, 3], 7, window=2) == [8]
+    assert order_n_components([16, 32], 3, window=2) == [16]
+
+
+def test_estimate_is_persisted_by_data_digest(plane, tmp_path):
+    dset = Dataset(dataset_name='plane', data=plane)
+    estimate = estimate_intrinsic_dimension(dset, n_neighbors=10,
+                                            cache_dir=tmp_path)
+    assert dset.metadata['intrinsic_dimension']['estimate'] == estimate
+    stem = dset.digest('data')
+    assert (tmp_path / f'{stem}.intrinsic_dim.json').exists()
+    assert (tmp_path / f'{stem}.knn_distances.euclidean.npy').exists()
+
+    # a fresh dataset with the same data reuses the estimate...
+    reloaded = Dataset(dataset_name='plane', data=plane.copy())
+    assert estimate_intrinsic_dimension(reloaded, n_neighbors=10,
+                                        cache_dir=tmp_path) == estimate
+    # ...and the stored neighbors serve other estimators
+    twonn = estimate_intrinsic_dimension(reloaded, method='twonn',
+                                         n_neighbors=10, cache_dir=tmp_path)
+    assert twonn == twonn_intrinsic_dimension(knn_distances(plane, 10))
+
+
+def test_estimate_not_persisted_when_disabled(plane, tmp_path):
+    dset = Dataset(dataset_name='plane', data=plane[:200])
+    estimate_intrinsic_dimension(dset, n_neighbors=5, cache_dir=False)
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,25 @@
+import importlib
+
+import pytest
+
+import src.data
+import src.models
+
+
+def test_data_exports_match_submodules():
+    for module_name, names in src.data._SUBMODULE_EXPORTS.items():
+        module = importlib.import_module(module_name, 'src.data')
+        assert sorted(names) == sorted(module.__all__), module_name
+    assert sorted(src.data.__all__) == sorted(
+        name for names in src.data._SUBMODULE_EXPORTS.values()
+        for name in names)
+
+
+@pytest.mark.parametrize('package', [src.data, src.models])
+def test_lazy_attributes_resolve(package):
+    for name, module_name in package._LAZY_ATTRIBUTES.items():
+        module = importlib.import_module(module_name, package.__name__)
+        assert getattr(package, name) is getattr(module, name)
+        assert name in getattr(module, '__all__', [name])
+    with pytest.raises(AttributeError):
+        package.no_such_attribute
@@ -0,0 +1,136 @@
+import numpy as np
+import pytest
+from sklearn.base import BaseEstimator
+from sklearn.decomposition import PCA
+from sklearn.manifold import TSNE, _t_sne
+
+from src.models.monitor import (QualityMonitor, StoppingRule,
+                                monitored_fit_transform)
+
+
+@pytest.fixture
+def blobs():
+    generator = np.random.RandomState(0)
+    centers = generator.rand(3, 5) * 10
+    classes = np.repeat(np.arange(3), 20)
+    X = centers[classes] + generator.randn(60, 5)
+    return X, classes
+
+
+def make_tsne():
+    return TSNE(n_iter=300, perplexity=10, init='random', method='exact',
+                random_state=0)
+
+
+def test_monitored_tsne_is_the_unmonitored_run(blobs):
+    X, classes = blobs
+    monitor = QualityMonitor(X, classes=classes, n_neighbors=5, n_probe=40)
+    estimator = make_tsne()
+    embedding, completed = monitored_fit_transform(estimator, X,
+                                                   monitor=monitor,
+                                                   n_stages=4)
+    reference = make_tsne()
+    expected = reference.fit_transform(X)
+
+    assert completed
+    assert np.allclose(embedding, expected)
+    assert estimator.n_iter_ == reference.n_iter_
+    assert [h['stage'] for h in monitor.history] == [0, 1, 2, 3]
+    assert _t_sne._gradient_descent.__name__ == '_gradient_descent'
+
+
+def test_stopping_rule_aborts_run(blobs):
+    X, classes = blobs
+    rule = StoppingRule(score='trustworthiness', tolerance=0.0, min_stage=1)
+    rule.best = [1.0, 1.0, 1.0, 1.0]
+    monitor = QualityMonitor(X, n_neighbors=5, n_probe=40,
+                             stopping_rule=rule)
+    embedding, completed = monitored_fit_transform(make_tsne(), X,
+                                                   monitor=monitor,
+                                                   n_stages=4)
+    assert not completed
+    assert embedding.shape == (60, 2)
+    assert len(monitor.history) == 2
+    # an aborted run never becomes the best
+    assert rule.best == [1.0, 1.0, 1.0, 1.0]
+    assert _t_sne._gradient_descent.__name__ == '_gradient_descent'
+
+
+def test_stopping_rule_keeps_best_run():
+    rule = StoppingRule(score='1nn-error', tolerance=0.1)
+    rule.update([{'1nn-error': 0.5}, {'1nn-error': 0.3}])
+    rule.update([{'1nn-error': 0.4}, {'1nn-error': 0.35}])
+    assert rule.best == [0.5, 0.3]
+    assert not rule.should_stop([{'1nn-error': 0.9}])
+    assert not rule.should_stop([{'1nn-error': 0.9}, {'1nn-error': 0.35}])
+    assert rule.should_stop([{'1nn-error': 0.9}, {'1nn-error': 0.45}])
+
+
+def test_stage_count_must_fit_budget(blobs):
+    X, _ = blobs
+    monitor = QualityMonitor(X, n_neighbors=5, n_probe=40)
+    with pytest.raises(ValueError):
+        monitored_fit_transform(make_tsne(), X, monitor=monitor, n_stages=301)
+    with pytest.raises(ValueError):
+        monitored_fit_transform(make_tsne(), X, monitor=monitor, n_stages=0)
+
+
+def test_between_run_probe(blobs):
+    X, _ = blobs
+    monitor = QualityMonitor(X, n_neighbors=5, n_probe=40)
+    with pytest.raises(ValueError):
+        monitored_fit_transform(PCA(2), X, monitor=monitor, n_stages=2)
+    embedding, completed = monitored_fit_transform(PCA(2), X, monitor=monitor,
+                                                   n_stages=1)
+    assert completed
+    assert len(monitor.history) == 1
+    assert np.allclose(embedding, PCA(2).fit_transform(X))
+
+
+def test_other_tsne_fits_are_unaffected(blobs):
+    X, classes = blobs
+    expected = make_tsne().fit_transform(X)
+    inner = []
+
+    class FitDuringRun(QualityMonitor):
+        def __call__(self, low_data, stage=None):
+            # an unmonitored fit while the monitored one is in progress
+            inner.append(make_tsne().fit_transform(X))
+            return super().__call__(low_data, stage=stage)
+
+    monitor = FitDuringRun(X, n_neighbors=5, n_probe=40)
+    embedding, completed = monitored_fit_transform(make_tsne(), X,
+                                                   monitor=monitor,
+                                                   n_stages=2)
+    assert completed
+    assert len(inner) == 2
+    assert all(np.allclose(e, expected) for e in inner)
+    assert len(monitor.history) == 2
+
+
+class Drift(BaseEstimator):
+    """Stand-in for UMAP: moves the initial embedding by 0.1 per epoch"""
+    def __init__(self, n_epochs=None, init='spectral'):
+        self.n_epochs = n_epochs
+        self.init = init
+
+    def fit_transform(self, X):
+        start = X[:, :2] if isinstance(self.init, str) else self.init
+        self.embedding_ = start + 0.1 * self.n_epochs
+        return self.embedding_
+
+
+def test_epoch_estimators_are_staged(blobs):
+    X, _ = blobs
+    monitor = QualityMonitor(X, n_neighbors=5, n_probe=40)
+    estimator = Drift(n_epochs=10)
+    embedding, completed = monitored_fit_transform(estimator, X,
+                                                   monitor=monitor,
+                                                   n_stages=3)
+    assert completed
+    assert np.allclose(embedding, X[:, :2] + 1.0)
+    assert estimator.embedding_ is embedding
+    assert [h['stage'] for h in monitor.history] == [0, 1, 2]
+    with pytest.raises(ValueError):
+        monitored_fit_transform(Drift(n_epochs=2), X, monitor=monitor,
+                                n_stages=3)
@@ -5,8 +5,10 @@ import unittest
 import numpy as np
 from sklearn.base import BaseEstimator
 import inspect
+import tempfile
 
 import src.quality_measures as qm
+from src.score_cache import ScoreCache, set_score_cache
 from .logging import logger
 
 
@@ -365,6 +367,9 @@ def test_scorers(hd, ld, target, n_neighbors):
         elif key == '1nn-error':
             m = measure(data=ld, classes=target)
             s = scorer(estimator, hd, y=target)
+        elif key == 'knn-error':
+            m = measure(data=ld, classes=target, n_neighbors=2)[-1]
+            s = scorer(estimator, hd, y=target, n_neighbors=2)
         else:
             logger.debug("Untested measure:{key}. Add me to test_scorers")
             assert False
@@ -375,6 +380,104 @@ def test_scorers(hd, ld, target, n_neighbors):
             assert s == m
 
 
+@given(arrays(np.float, (5, 3), elements=st.floats(min_value=-100,
+                                                   max_value=100)),
+       st.sampled_from(['euclidean', 'sqeuclidean', 'cosine']),
+       st.integers(min_value=1, max_value=5))
+def test_pairwise_distances_fast_metrics(data, metric, block_size):
+    fast = qm.pairwise_distances(data, metric=metric, block_size=block_size)
+    slow = qm.sk_pairwise_distances(data, metric=metric)
+    assert fast.shape == (5, 5)
+    assert np.allclose(fast, slow, atol=1e-6)
+
+
+def test_metric_cache():
+    data = np.array([[3., 4.], [0., 2.]])
+    assert qm.normalized_rows(data) is qm.normalized_rows(data)
+    assert qm.row_norms(data) is qm.row_norms(data)
+    qm.clear_metric_cache()
+    assert (qm.row_norms(data) == np.array([5., 2.])).all()
+
+
+@given(arrays(np.float, (4, 3), elements=st.floats(min_value=-100,
+                                                   max_value=100)),
+       arrays(np.float, (4, 2), elements=st.floats(min_value=-100,
+                                                   max_value=100)),
+       st.integers(min_value=1, max_value=3))
+def test_precomputed_metric(high_data, low_data, n_neighbors):
+    hd = qm.pairwise_distances(high_data)
+    expected = qm.trustworthiness(high_data=high_data, low_data=low_data,
+                                  n_neighbors=n_neighbors)
+    new = qm.trustworthiness(high_data=hd, low_data=low_data,
+                             metric=('precomputed', 'euclidean'),
+                             n_neighbors=n_neighbors)
+    assert new == expected
+
+
+@given(st.integers(min_value=0, max_value=2**16),
+       st.integers(min_value=2, max_value=5))
+def test_knn_error_matches_1nn_error(seed, n_classes):
+    generator = np.random.RandomState(seed)
+    data = generator.rand(20, 2)
+    classes = generator.randint(n_classes, size=20)
+    knn = qm.generalized_knn_error(data=data, classes=classes, n_neighbors=4)
+    assert knn.shape == (4,)
+    assert np.isclose(knn[0], qm.generalized_1nn_error(data=data,
+                                                       classes=classes))
+
+
+@given(st.integers(min_value=0, max_value=2**16),
+       st.integers(min_value=2, max_value=4))
+def test_knn_error_with_duplicate_points(seed, n_copies):
+    # every point's duplicates are its nearest neighbors, all of another class
+    points = np.random.RandomState(seed).rand(20, 2)
+    data = np.vstack([points] * n_copies)
+    classes = np.repeat(np.arange(n_copies), 20)
+    knn = qm.point_generalized_knn_error(data=data, classes=classes,
+                                         n_neighbors=n_copies - 1)
+    assert np.all(knn == 1)
+    assert np.all(qm.point_generalized_1nn_error(data=data,
+                                                 classes=classes) == 1)
+
+
+def test_score_cache():
+    high_data = np.array([[7, 4, 0], [4, 5, 2], [9, 4, 3]])
+    low_data = np.array([[0, 6], [7, 1], [4, 9]])
+    stress = qm.available_quality_measures()['stress']
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = ScoreCache(cache_dir=cache_dir)
+        set_score_cache(cache)
+        try:
+            first = stress(high_data=high_data, low_data=low_data)
+            assert len(cache) == 1
+            # equivalent call (explicit default) hits the same entry
+            second = stress(high_data=high_data, low_data=low_data,
+                            metric='euclidean')
+            assert len(cache) == 1
+            assert first == second
+            stress(high_data=high_data, low_data=low_data + 1)
+            assert len(cache) == 2
+            cache.evict(max_bytes=cache.size - 1)
+            assert len(cache) == 1
+        finally:
+            set_score_cache(None)
+
+
+def test_score_cache_discards_unreadable_entries():
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = ScoreCache(cache_dir=cache_dir)
+        key = cache.key('stress', high_data=np.eye(3), low_data=np.eye(3))
+        # arrays are keyed by content, not identity
+        assert key == cache.key('stress', high_data=np.eye(3),
+                                low_data=np.eye(3))
+        assert key != cache.key('stress', high_data=np.eye(3),
+                                low_data=np.eye(3)[::-1])
+        cache.put(key, 1.5)
+        with open(cache.cache_dir / f'{key}.score', 'wb') as fw:
+            fw.write(b'not a pickle')
+        assert cache.get(key, default=-1) == -1
+        assert len(cache) == 0
+
 
 @given(arrays(np.float, (3, 3), elements=st.floats(min_value=-100,
                                                    max_value=100)))
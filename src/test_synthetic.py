@@ -0,0 +1,40 @@
+from functools import partial
+
+import numpy as np
+import pytest
+
+from src.data import Dataset
+from src.data.synthetic import (helix, synthetic_blocks, synthetic_data,
+                                write_synthetic_dataset)
+
+
+def test_output_is_independent_of_n_jobs(tmp_path):
+    func = partial(synthetic_data, kind='swiss_roll')
+    dsets = [write_synthetic_dataset('roll', func, 1000, block_size=128,
+                                     random_state=3, n_jobs=n_jobs,
+                                     data_path=tmp_path / str(n_jobs))
+             for n_jobs in [1, 2]]
+    for key in ['data', 'target']:
+        assert np.array_equal(dsets[0][key], dsets[1][key])
+    assert np.array_equal(dsets[0].metadata['manifold_coords'],
+                          dsets[1].metadata['manifold_coords'])
+    assert dsets[0].data.shape == (1000, 3)
+
+    blocks = list(synthetic_blocks(func, 1000, block_size=128,
+                                   random_state=3))
+    assert np.array_equal(np.vstack([X for _, X, _, _ in blocks]),
+                          dsets[0].data)
+    reloaded = Dataset.load('roll', data_path=tmp_path / '1')
+    assert np.array_equal(reloaded.target, dsets[1].target)
+
+
+def test_grid_kinds_are_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        synthetic_blocks(synthetic_data, 100, kind='difficult')
+    with pytest.raises(ValueError):
+        write_synthetic_dataset('grid',
+                                partial(synthetic_data, kind='difficult'),
+                                100, data_path=tmp_path)
+    assert list(tmp_path.iterdir()) == []
+    # other generators are fine
+    assert len(list(synthetic_blocks(helix, 10, block_size=5))) == 2